@@ -0,0 +1,193 @@
+"""
+This script benchmarks the reach averaged forest resistance model on synthetic forests. Each
+layer of a model run (tree database read, cached read, forest geometry, single velocity solve,
+full sweep and result writing) is timed for forests of 10^2 to 10^6 trees and for depth/slope
+grids of different sizes. Run times, throughput and peak memory are written to a json report, and the
+run fails (exit code 1) if any layer is slower than a stored baseline by more than a threshold.
+
+Example:
+python Benchmark.py --sizes 100,1000,10000 --grids 25x3,100x7 --report bench.json
+python Benchmark.py --report bench_new.json --baseline bench.json --threshold 0.25
+"""
+from Channel import RectChannel
+from Solver import BatchSolver
+from Results import ResultStore
+from Logger import LogFile
+from Logger import WARNING
+import numpy as np
+import pandas as pd
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Dayboro_WTP has 53 tree groups on a 35.54 m x 1000 m reach; synthetic reaches keep this density
+reference_groups = 53
+reference_width = 35.54
+reference_length = 1000.0
+
+
+def synthetic_database(file_name, size, seed=0):
+    # a tree database with the same columns and value ranges as the Dayboro_WTP model
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'ID': np.arange(1, size + 1),
+                       'Height': np.round(rng.uniform(2.0, 28.0, size), 1),
+                       'Population': rng.integers(1, 300, size),
+                       'GroundLevel': np.round(rng.normal(42.8, 0.44, size), 2),
+                       'Type': 'Casuarina-overstory'})
+    df.to_csv(file_name, index=False)
+
+
+def synthetic_channel(size):
+    channel = RectChannel(reference_width, reference_length * size / reference_groups)
+    channel.n = 0.045
+    channel.forest.plan_area = channel.plan_area
+    return channel
+
+
+def measure_time(function, repeat):
+    # best of repeat run times of function(), to reduce timing noise
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def measure_memory(function):
+    # peak traced memory (MB) of function(), measured in a separate (slower) run
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark_layers(size, depth_count, slope_count, folder, repeat=3):
+    depths = np.linspace(0.1, 10.0, depth_count)
+    slopes = 1 / (np.geomspace(0.25, 5.0, slope_count) * 1000)
+    database = os.path.join(folder, 'trees_{}.csv'.format(size))
+    synthetic_database(database, size)
+    channel = synthetic_channel(size)
+    state = {}
+
+    def read_database():
+        channel.forest.database_cache = False
+        channel.forest.read_database(database)
+
+    def read_database_cached():
+        channel.forest.database_cache = True
+        channel.forest.read_database(database)
+
+    def geometry():
+        channel.forest.geometry_cache.clear()
+        for depth in depths:
+            channel.forest.set_flow_depth(depth)
+
+    def single_solve():
+        channel.forest.geometry_cache.clear()
+        channel.set_bed_slope(slopes[slopes.size // 2])
+        for depth in depths:
+            channel.set_water_depth(depth)
+            channel.resolve_velocity()
+
+    def full_sweep():
+        channel.forest.geometry_cache.clear()
+        state['results'] = BatchSolver(channel).solve(depths, slopes)
+
+    def write_binary():
+        store = ResultStore(os.path.join(folder, 'results_{}.bin'.format(size)))
+        store.create()
+        for j, slope in enumerate(slopes):
+            records = {name: state['results'][name][:, j] for name in state['results']}
+            records['Channel_Slope'] = 1 / (slope * 1000)
+            store.append(records)
+
+    def write_csv():
+        for j, slope in enumerate(slopes):
+            df = pd.DataFrame({name: state['results'][name][:, j] for name in state['results']})
+            df.to_csv(os.path.join(folder, 'results_{}_{}.csv'.format(size, j)))
+
+    grid = depth_count * slope_count
+    read_database_cached()  # write the parsed database sidecar
+    layers = [('read_database', read_database, size, 'trees/s'),
+              ('read_database_cached', read_database_cached, size, 'trees/s'),
+              ('geometry', geometry, size * depth_count, 'tree depths/s'),
+              ('single_solve', single_solve, depth_count, 'solves/s'),
+              ('full_sweep', full_sweep, grid, 'solves/s'),
+              ('write_binary', write_binary, grid, 'records/s'),
+              ('write_csv', write_csv, grid, 'records/s')]
+    results = []
+    for name, function, count, unit in layers:
+        seconds = measure_time(function, repeat)
+        peak_memory = measure_memory(function)
+        results.append({'trees': size, 'depths': depth_count, 'slopes': slope_count, 'layer': name,
+                        'seconds': seconds, 'throughput': count / seconds, 'unit': unit,
+                        'peak_memory_mb': peak_memory})
+        print('{0:>8} trees  {1:>4} x {2:<3} {3:<20} {4:>9.4f} s  {5:>12.1f} {6:<14} {7:>8.1f} MB'
+              .format(size, depth_count, slope_count, name, seconds, count / seconds, unit, peak_memory))
+    return results
+
+
+def key(result):
+    return result['trees'], result['depths'], result['slopes'], result['layer']
+
+
+def check_regressions(results, baseline_file, threshold):
+    # layers that take longer than (1 + threshold) times the baseline
+    with open(baseline_file) as bf:
+        baseline = {key(result): result for result in json.load(bf)['results']}
+    regressions = []
+    for result in results:
+        reference = baseline.get(key(result))
+        if reference is not None and result['seconds'] > reference['seconds'] * (1 + threshold):
+            regressions.append((result, reference))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the forest resistance model on synthetic forests.')
+    parser.add_argument('--sizes', default='100,1000,10000,100000',
+                        help='comma separated numbers of trees, e.g. 100,1000,1000000')
+    parser.add_argument('--grids', default='25x3,100x7', help='comma separated depths x slopes grids')
+    parser.add_argument('--report', default='benchmark_report.json', help='json report file to write')
+    parser.add_argument('--baseline', default='', help='json report to compare against')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each layer (best is kept)')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slow down relative to the baseline (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    LogFile.configure(console_level=WARNING)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    grids = [[int(value) for value in grid.lower().split('x')] for grid in args.grids.split(',')]
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for size in sizes:
+            for depth_count, slope_count in grids:
+                results.extend(benchmark_layers(size, depth_count, slope_count, folder, args.repeat))
+
+    report = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+              'cpu_count': os.cpu_count(), 'results': results}
+    with open(args.report, 'w') as rf:
+        json.dump(report, rf, indent=1)
+    print('Benchmark report written to: {}'.format(os.path.abspath(args.report)))
+
+    if args.baseline:
+        regressions = check_regressions(results, args.baseline, args.threshold)
+        for result, reference in regressions:
+            print('!!!REGRESSION: {} trees, {} x {} grid, {}: {:.4f} s (baseline {:.4f} s)'
+                  .format(result['trees'], result['depths'], result['slopes'], result['layer'],
+                          result['seconds'], reference['seconds']))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against: {}'.format(os.path.abspath(args.baseline)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+This script contains the inverse calibration of the drag parameters of the reach averaged
+forest resistance model. Cd0 and the Vogel exponent (and the ruptured Cd0 and Vogel
+exponent) are fitted to the Manning's n and/or velocity in an observations file by
+minimising the misfit with a differential evolution search (scipy). Only the drag
+parameters change between evaluations, so the tree geometry of each observation is
+computed once and rescaled: the rigid drag is proportional to Cd0 and the threshold
+velocity to 1/sqrt(Cd0). All candidates of a generation are solved in one batch, or the
+generation is split over a process pool. The classes are used in the Hydraulics.py script.
+"""
+import numpy as np
+import pandas as pd
+from scipy.optimize import differential_evolution
+from Forest import DepthGeometry
+from Forest import species_parameter_columns
+from Solver import BatchSolver
+from Solver import ParallelSweep
+from Instrumentation import instruments
+
+# calibrated parameters, in the order of the parameter vector
+parameter_names = ['Cd0', 'Vogel', 'Ruptured_Cd0', 'Ruptured_Vogel']
+
+'''
+Forward model for the observations of a RectChannel(). The observations file (csv) has
+the columns Flow_Depth, Slope (energy slope, m/m), Mannings_n and/or Velocity (blank where
+not observed) and optionally Ruptured (True for observations of a ruptured forest). The
+same Cd0 and Vogel exponent are used for every species of the forest. Each candidate
+parameter set is a row of a BatchSolver() solve, with the stored geometry of its
+observation rescaled to its Cd0.
+'''
+
+
+class CalibrationModel:
+    def __init__(self, channel, observations):
+        self.channel = channel
+        self.solver = BatchSolver(channel, mode='newton')
+        forest = channel.forest
+        self.trees = forest.tree_arrays()
+        self.observations = observations
+        self.depths = observations['Flow_Depth'].to_numpy(dtype=float)
+        self.slopes = observations['Slope'].to_numpy(dtype=float)
+        self.mannings_n = self.observed('Mannings_n')
+        self.velocity = self.observed('Velocity')
+        ruptured = observations['Ruptured'] if 'Ruptured' in observations else pd.Series(False, observations.index)
+        self.ruptured = ruptured.astype(str).str.strip().str.upper().isin(['TRUE', '1']).to_numpy()
+
+        # parameters fitted for the observed forest states
+        self.fitted = []
+        if np.any(~self.ruptured):
+            self.fitted += [0, 1]
+        if np.any(self.ruptured):
+            self.fitted += [2, 3]
+
+        # geometry of each observation at the current Cd0 (full tree height when submerged)
+        self.cd_base = np.array(self.trees.drag_parameters[0], dtype=float)
+        self.canopy_heights = np.array([forest.canopy_height(is_ruptured) for is_ruptured in self.ruptured])
+        self.geometries = [forest.depth_geometry(999.0 if depth - canopy_height > 0.001 else depth)
+                           for depth, canopy_height in zip(self.depths, self.canopy_heights)]
+        # observations solved together (same slope and forest state)
+        keys = list(zip(self.slopes, self.ruptured))
+        self.groups = [np.array([i for i, other in enumerate(keys) if other == key]) for key in dict.fromkeys(keys)]
+
+    def observed(self, column):
+        if column not in self.observations:
+            return np.full(self.depths.size, np.nan)
+        return pd.to_numeric(self.observations[column], errors='coerce').to_numpy(dtype=float)
+
+    def parameters(self, x):
+        # the full (candidate, 4) parameter array from the fitted values (others are not used)
+        x = np.atleast_2d(x)
+        parameters = np.zeros((x.shape[0], len(parameter_names)))
+        parameters[:, self.fitted] = x
+        return parameters
+
+    def candidate_geometry(self, observation, cd, vogel_exp):
+        # the observation geometry for each candidate Cd0 and Vogel exponent
+        base = self.geometries[observation]
+        scale = cd[:, None] / self.cd_base
+        rigid_drag = base.rigid_drag * scale
+        threshold_u = base.threshold_u / np.sqrt(scale)
+        total_rigid_drag = np.sum(rigid_drag * self.trees.population, axis=1)
+        geometries = []
+        for k in range(cd.size):
+            geometry = DepthGeometry(self.trees, base.flow_depth,
+                                     (base.wet, base.area_h, base.first_area_h, threshold_u[k], rigid_drag[k]),
+                                     (base.total_plan_area, base.volume, base.total_frontal_area,
+                                      total_rigid_drag[k]))
+            geometry.vogel_exp = np.full(self.trees.size, vogel_exp[k])
+            geometries.append(geometry)
+        return geometries
+
+    def forward(self, x):
+        # modelled Mannings n and velocity, as (observation, candidate) arrays
+        parameters = self.parameters(x)
+        candidates = parameters.shape[0]
+        mannings_n = np.empty((self.depths.size, candidates))
+        velocity = np.empty((self.depths.size, candidates))
+        for group in self.groups:
+            observation = group[0]
+            cd, vogel_exp = (parameters[:, 2], parameters[:, 3]) if self.ruptured[observation] else (
+                parameters[:, 0], parameters[:, 1])
+            geometries = []
+            for i in group:
+                geometries += self.candidate_geometry(i, cd, vogel_exp)
+            results = self.solver.solve_canopy(np.repeat(self.depths[group], candidates),
+                                               self.slopes[observation:observation + 1], None,
+                                               self.canopy_heights[observation], geometries)
+            mannings_n[group] = results['Mannings_n'].reshape(group.size, candidates)
+            velocity[group] = results['Velocity'].reshape(group.size, candidates)
+        instruments.count('calibration_evaluations', candidates)
+        return mannings_n, velocity
+
+    def misfit(self, x):
+        # mean squared relative error of the observed Mannings n and velocities for each candidate
+        mannings_n, velocity = self.forward(x)
+        observed = np.concatenate([self.mannings_n, self.velocity])
+        errors = np.concatenate([mannings_n, velocity]) / observed[:, None] - 1
+        return np.mean(errors[~np.isnan(observed)] ** 2, axis=0)
+
+
+'''
+Differential evolution search for the drag parameters. The bounds are (min, max) of Cd0
+and of the Vogel exponent (also used for the ruptured parameters). Each generation is
+evaluated in one call of the vectorised objective; with processes, the candidates are
+split between the workers, which hold their own copy of the CalibrationModel().
+'''
+
+
+class Calibration:
+    def __init__(self, model, cd_bounds=(0.01, 2.0), vogel_bounds=(-1.5, 0.0), processes=1, seed=None,
+                 max_generations=200, tolerance=1e-6, mp_context=None):
+        self.model = model
+        self.bounds = [[cd_bounds, vogel_bounds, cd_bounds, vogel_bounds][k] for k in model.fitted]
+        self.processes = processes
+        self.seed = seed
+        self.max_generations = max_generations
+        self.tolerance = tolerance
+        self.mp_context = mp_context
+        self.result = None
+
+    def run(self):
+        # the fitted parameters (dict); the optimiser result is kept
+        with instruments.timer('calibration'):
+            if self.processes > 1:
+                sweep = ParallelSweep(self.model.channel, self.processes, mp_context=self.mp_context)
+                with sweep.pool(init_worker, (sweep.worker_channel(), self.model.observations)) as executor:
+                    self.result = self.optimise(lambda x: np.concatenate(list(executor.map(
+                        worker_misfit, np.array_split(x.T, min(self.processes, x.shape[1]))))))
+            else:
+                self.result = self.optimise(lambda x: self.model.misfit(x.T))
+        parameters = self.model.parameters(self.result.x)[0]
+        return {parameter_names[k]: parameters[k] for k in self.model.fitted}
+
+    def optimise(self, objective):
+        return differential_evolution(objective, self.bounds, seed=self.seed, maxiter=self.max_generations,
+                                      tol=self.tolerance, updating='deferred', vectorized=True, polish=False)
+
+    def species_table(self, fitted):
+        # species parameter file rows (see Forest.read_species_parameters()) with the fitted drag parameters
+        forest = self.model.channel.forest
+        rows = []
+        for tree_type, species in forest.species_types.items():
+            if not any(species is group or species.ruptured is group for group, start, stop in self.model.trees.groups):
+                continue
+            row = {'Type': tree_type, 'Name': species.name}
+            for column, (name, count) in species_parameter_columns.items():
+                values = species.ruptured.drag_parameters if column == 'Ruptured_drag' else getattr(species, name)
+                row[column] = ' '.join(str(value) for value in values)
+            if 'Cd0' in fitted:
+                row['Drag'] = '{} {}'.format(fitted['Cd0'], fitted['Vogel'])
+            if 'Ruptured_Cd0' in fitted:
+                row['Ruptured_drag'] = '{} {}'.format(fitted['Ruptured_Cd0'], fitted['Ruptured_Vogel'])
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+
+# worker process state for Calibration()
+worker_model = None
+
+
+def init_worker(channel, observations):
+    global worker_model
+    worker_model = CalibrationModel(channel, observations)
+
+
+def worker_misfit(x):
+    return worker_model.misfit(x)
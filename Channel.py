@@ -2,13 +2,18 @@
 This script contains a channel object for the reach averaged forest resistance model.
 The class is used in the Hydraulics.py script.
 """
-from scipy import optimize
 from Forest import Forest
-from Forest import CasOver
+from Forest import Tree
+from Solver import PiecewiseSolver
+from Solver import VelocitySolver
 import pandas as pd
+import numpy as np
 import os
 from Logger import LogFile
+from Logger import DEBUG
+from Instrumentation import instruments
 import math
+import time
 
 # Global variables
 water_density = 998.0  # kg/m3
@@ -32,6 +37,7 @@ class RectChannel:
         self.forest_depth = 0.0
         self.submergence_depth = 0.0
         self.water_level = 0.0
+        self.level_mode = False  # the last flow set was a level (each tree wetted from its ground level)
         self.friction_slope = 0.0
         self.drag_slope = 0.0
         self.energy_slope = slope
@@ -42,11 +48,14 @@ class RectChannel:
         self.reconfiguration_velocity = 0.0
         self.plan_area = width * length
         self.forest = Forest(self.plan_area)
+        self.velocity_solver = VelocitySolver()
         self.initial_u = 0.5
         self.all_slopes = []
         self.hydraulics_df_file = pd.DataFrame()
+        self.hydraulics_levels_df_file = ''
         self.flow_depths = []
         self.flow_levels = []
+        self.bed_level = None
         self.home_path = ''
         self.logger = LogFile()
         self.use_flow_depths = False
@@ -57,6 +66,32 @@ class RectChannel:
         self.is_ruptured = False
         self.blockage = True
         self.result_suffix_decimals = 0
+        self.solver_mode = 'newton'
+        self.results_format = 'csv'
+        self.surface_file = ''
+        self.surface_resolution = [200, 50]
+        self.adaptive_tolerance = 0.0
+        self.adaptive_regime_tolerance = 5.0
+        self.adaptive_resolution = [11, 0.01]
+        self.ensemble_file = ''
+        self.ensemble_members = 200
+        self.ensemble_seed = None
+        self.ensemble_percentiles = [5, 50, 95]
+        self.calibration_file = ''
+        self.calibration_bounds = [0.01, 2.0, -1.5, 0.0]
+        self.calibration_seed = None
+        self.tree_db_file = ''
+        self.cells_file = ''
+        self.hydrograph_file = ''
+        self.hydrograph_resolution = 0.001
+        self.hydrograph_chunk = 100000
+        self.hydrograph_interpolation = False
+        self.result_cache = False
+        self.result_cache_size = 1024.0
+        self.processes = 1
+        self.depth_chunk = 0
+        self.start_method = None
+        self.aggregates = None
 
     def read_ufm_file(self, ufm):
         self.logger.set_log_file_name(ufm)
@@ -67,7 +102,10 @@ class RectChannel:
             f = open(ufm, 'r')  # 'r' = read
             lines = f.readlines()
             lines = self.strip_comments(lines)
+            # timed by hand, since the instrumentation is switched on while the lines are read
+            start = time.perf_counter()
             self.read_ufm_lines(lines)
+            instruments.add_time('parsing', time.perf_counter() - start)
         except IOError:
             self.logger.log('the file could not be accessed: {}'.format(ufm))
         finally:
@@ -96,6 +134,13 @@ class RectChannel:
             if 'Trees Ruptured == True'.upper() in line.upper():
                 self.is_ruptured = True
                 self.logger.log('The forest is ruptured!')
+            if 'Canopy height == Bent'.upper() in line.upper():
+                self.forest.canopy_bending = True
+                self.logger.log('The canopy height follows the bent height of the trees')
+            if 'Bending slices =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.forest.bending_slices = int(str_parse[1].strip())
+                self.logger.log('Number of stem slices for tree bending: {}'.format(self.forest.bending_slices))
             if 'Channel Mannings n =='.upper() in line.upper():
                 str_parse = line.split('==')
                 self.n = float(str_parse[1].strip())
@@ -123,15 +168,25 @@ class RectChannel:
                 str_parse = line.split('==')
                 flow_depth_file = '{}\\{}'.format(self.home_path, str_parse[1].strip())
                 self.logger.log('Flow depths file: {}'.format(flow_depth_file))
+            if 'Bed level =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.bed_level = float(str_parse[1].strip())
+                self.logger.log('Channel bed level: {} m'.format(self.bed_level))
             if 'Flow levels =='.upper() in line.upper():
                 self.use_flow_levels = True
                 str_parse = line.split('==')
                 flow_level_file = '{}\\{}'.format(self.home_path, str_parse[1].strip())
                 self.logger.log('Flow levels file: {}'.format(flow_level_file))
+            if 'Species parameters =='.upper() in line.upper():
+                str_parse = line.split('==')
+                species_file = '{}\\{}'.format(self.home_path, str_parse[1].strip())
+                self.logger.log('Species parameter file: {}'.format(species_file))
+                self.forest.read_species_parameters(species_file)
             if 'Tree DB =='.upper() in line.upper():
                 self.use_tree_database = True
                 str_parse = line.split('==')
                 tree_db_file = '{}\\{}'.format(self.home_path, str_parse[1].strip())
+                self.tree_db_file = tree_db_file
                 self.logger.log('Tree database file: {}'.format(tree_db_file))
             if 'Blockage == None'.upper() in line.upper():
                 self.blockage = False
@@ -141,6 +196,143 @@ class RectChannel:
                 self.result_suffix_decimals = int(str_parse[1].strip())
                 self.logger.log('Number of decimals to use in the suffix of the results file: {}'
                                 .format(self.result_suffix_decimals))
+            if 'Log level =='.upper() in line.upper():
+                str_parse = line.split('==')
+                LogFile.configure(file_level=str_parse[1].strip())
+                self.logger.summary('Log file level: {}'.format(str_parse[1].strip()))
+            if 'Console level =='.upper() in line.upper():
+                str_parse = line.split('==')
+                LogFile.configure(console_level=str_parse[1].strip())
+                self.logger.summary('Console level: {}'.format(str_parse[1].strip()))
+            if 'Log flush lines =='.upper() in line.upper():
+                str_parse = line.split('==')
+                LogFile.configure(flush_lines=int(str_parse[1].strip()))
+                self.logger.log('Log file lines per write: {}'.format(LogFile.flush_lines))
+            if 'Log writer thread == True'.upper() in line.upper():
+                LogFile.configure(background=True)
+                self.logger.log('Writing the log file on a background thread')
+            if 'Tree DB cache == False'.upper() in line.upper():
+                self.forest.database_cache = False
+                self.logger.log('The parsed tree database is not cached')
+            if 'Instrumentation == True'.upper() in line.upper():
+                instruments.enable()
+                self.logger.log('Instrumentation is on (counters, timers and per-solve trace columns)')
+            if 'Results format =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.results_format = str_parse[1].strip().lower()
+                self.logger.log('Results format: {}'.format(self.results_format))
+            if 'Solver =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.solver_mode = str_parse[1].strip().lower()
+                self.logger.log('Velocity solver: {}'.format(self.solver_mode))
+            if 'Roughness surface =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.surface_file = '{}\\{}'.format(self.home_path, str_parse[1].strip())
+                self.logger.log('Roughness surface file: {}'.format(self.surface_file))
+            if 'Surface resolution =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.surface_resolution = [int(value) for value in str_parse[1].split(',')]
+                self.logger.log('Roughness surface resolution (depths, slopes): {}'.format(self.surface_resolution))
+            if 'Adaptive depths =='.upper() in line.upper():
+                str_parse = line.split('==')
+                values = [float(value) for value in str_parse[1].split(',')]
+                self.adaptive_tolerance = values[0]
+                if len(values) > 1:
+                    self.adaptive_regime_tolerance = values[1]
+                self.logger.log('Adaptive flow depths, Mannings n tolerance: {:.2%}    regime tolerance: {}%'
+                                .format(self.adaptive_tolerance, self.adaptive_regime_tolerance))
+            if 'Adaptive resolution =='.upper() in line.upper():
+                str_parse = line.split('==')
+                values = str_parse[1].split(',')
+                self.adaptive_resolution = [int(values[0]), float(values[1])]
+                self.logger.log('Adaptive flow depths (coarse depths, minimum spacing): {}'
+                                .format(self.adaptive_resolution))
+            if 'Ensemble parameters =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.ensemble_file = '{}\\{}'.format(self.home_path, str_parse[1].strip())
+                self.logger.log('Ensemble parameter file: {}'.format(self.ensemble_file))
+            if 'Ensemble members =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.ensemble_members = int(str_parse[1].strip())
+                self.logger.log('Number of ensemble members: {}'.format(self.ensemble_members))
+            if 'Ensemble seed =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.ensemble_seed = int(str_parse[1].strip())
+                self.logger.log('Ensemble seed: {}'.format(self.ensemble_seed))
+            if 'Ensemble percentiles =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.ensemble_percentiles = [float(value) for value in str_parse[1].split(',')]
+                self.logger.log('Ensemble percentiles: {}'.format(self.ensemble_percentiles))
+            if 'Calibration observations =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.calibration_file = '{}\\{}'.format(self.home_path, str_parse[1].strip())
+                self.logger.log('Calibration observations file: {}'.format(self.calibration_file))
+            if 'Calibration bounds =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.calibration_bounds = [float(value) for value in str_parse[1].split(',')]
+                self.logger.log('Calibration bounds (Cd0 min, max, Vogel exponent min, max): {}'
+                                .format(self.calibration_bounds))
+            if 'Calibration seed =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.calibration_seed = int(str_parse[1].strip())
+                self.logger.log('Calibration seed: {}'.format(self.calibration_seed))
+            if 'Cells =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.cells_file = '{}\\{}'.format(self.home_path, str_parse[1].strip())
+                self.logger.log('Cells file: {}'.format(self.cells_file))
+            if 'Height classes =='.upper() in line.upper():
+                str_parse = line.split('==')
+                values = [value.strip() for value in str_parse[1].split(',')]
+                if values[0].upper() == 'AUTO':
+                    self.forest.height_class_error = float(values[1]) if len(values) > 1 else 0.01
+                    self.logger.log('Height classes chosen for a Mannings n error of {:.2%}'
+                                    .format(self.forest.height_class_error))
+                else:
+                    self.forest.height_classes = int(values[0])
+                    self.logger.log('Height classes per species: {}'.format(self.forest.height_classes))
+            if 'Hydrograph =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.hydrograph_file = '{}\\{}'.format(self.home_path, str_parse[1].strip())
+                self.logger.log('Hydrograph file: {}'.format(self.hydrograph_file))
+            if 'Hydrograph resolution =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.hydrograph_resolution = float(str_parse[1].strip())
+                self.logger.log('Hydrograph resolution: {} m'.format(self.hydrograph_resolution))
+            if 'Hydrograph chunk =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.hydrograph_chunk = int(str_parse[1].strip())
+                self.logger.log('Hydrograph time steps per chunk: {}'.format(self.hydrograph_chunk))
+            if 'Hydrograph interpolation =='.upper() in line.upper():
+                str_parse = line.split('==')
+                if str_parse[1].strip().upper() == "TRUE":
+                    self.hydrograph_interpolation = True
+                self.logger.log('Interpolate the hydrograph results: {}'.format(str(self.hydrograph_interpolation)))
+            if 'Result cache =='.upper() in line.upper():
+                str_parse = line.split('==')
+                if str_parse[1].strip().upper() == "TRUE":
+                    self.result_cache = True
+                self.logger.log('Use the result cache: {}'.format(str(self.result_cache)))
+            if 'Result cache size (MB) =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.result_cache_size = float(str_parse[1].strip())
+                self.logger.log('Result cache size: {} MB'.format(self.result_cache_size))
+            if 'Processes =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.processes = int(str_parse[1].strip())
+                self.logger.log('Number of processes: {}'.format(self.processes))
+            if 'Geometry cache size =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.forest.geometry_cache.max_size = int(str_parse[1].strip())
+                self.logger.log('Number of flow depths in the geometry cache: {}'
+                                .format(self.forest.geometry_cache.max_size))
+            if 'Depth chunk =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.depth_chunk = int(str_parse[1].strip())
+                self.logger.log('Number of depths per parallel task: {}'.format(self.depth_chunk))
+            if 'Start method =='.upper() in line.upper():
+                str_parse = line.split('==')
+                self.start_method = str_parse[1].strip().lower()
+                self.logger.log('Worker process start method: {}'.format(self.start_method))
 
         # set up the forest
         self.plan_area = self.width * self.length
@@ -148,10 +340,13 @@ class RectChannel:
         if self.use_tree_database:
             self.forest.read_database(tree_db_file)
         else:
-            if tree_type == 'Casuarina-overstory':
-                self.forest.add_tree(CasOver(height=tree_height,
-                                             number_of_specimens=tree_population,
-                                             canopy_width=tree_width))
+            if tree_type in self.forest.species_types:
+                self.forest.add_tree(Tree(height=tree_height,
+                                          number_of_specimens=tree_population,
+                                          canopy_width=tree_width,
+                                          species=self.forest.species_types[tree_type]))
+            else:
+                self.logger.log('Error: !!! tree type not recognised !!!')
 
         # get the slopes
         self.logger.log(' ')
@@ -176,10 +371,11 @@ class RectChannel:
         if self.use_flow_levels:
             self.logger.log(' ')
             self.logger.log('opening hydraulics template file...')
-            self.logger.log(os.path.abspath(flow_depth_file))
-            self.hydraulics_df_file = flow_level_file
+            self.logger.log(os.path.abspath(flow_level_file))
+            self.hydraulics_levels_df_file = flow_level_file
             df = pd.read_csv(flow_level_file, index_col=0)
             self.flow_levels = df['Flow_Level'].values
+            self.set_default_bed_level()
 
         # print some info
         self.set_water_depth(1)
@@ -202,19 +398,32 @@ class RectChannel:
 
     def set_mannings_n(self, n):
         self.n = n
+        self.aggregates = None
 
     def set_sidewalls(self, choice):
         self.sidewalls = choice
 
+    def set_default_bed_level(self):
+        # without a bed level, flow depths are measured from the lowest tree ground level
+        if self.bed_level is None:
+            self.bed_level = float(np.min(self.forest.tree_arrays().ground_level))
+            self.logger.log('Channel bed level (lowest ground level): {} m'.format(self.bed_level))
+
     def set_water_depth(self, h):
         if not self.use_flow_depths and self.use_flow_levels:
-            self.set_water_level(h)
+            self.set_water_level(h + self.bed_level if self.bed_level is not None else h)
         else:
             self.water_depth = h
+            self.level_mode = False
+            self.aggregates = None
             self.forest.set_flow_depth(h)
 
     def set_water_level(self, h):
         self.water_level = h
+        self.level_mode = True
+        self.aggregates = None
+        if self.bed_level is not None:
+            self.water_depth = h - self.bed_level
         self.forest.set_flow_level(h)
 
     def channel_volume(self):
@@ -228,87 +437,175 @@ class RectChannel:
     def wet_perimeter(self):
         return self.width + 2 * self.water_depth
 
+    def depth_aggregates(self):
+        # the aggregates of the current depth, canopy height and forest geometry (computed once)
+        if self.aggregates is None or not self.aggregates.is_current(self):
+            self.aggregates = DepthAggregates(self)
+        return self.aggregates
+
     def hydraulic_radius(self):
         # this is for the forest layer only
-        hyd_radius = self.forest_depth * (1.0 - self.cell_width_factor())
-        if self.submergence == 'submerged':
-            hyd_radius = hyd_radius + self.submergence_depth
-        return hyd_radius
+        return self.depth_aggregates().hydraulic_radius
 
     def bed_shear_stress(self, u):
         # this is for the forest layer only
-        return (water_density * g * self.n**2.0 * self.theta()
-                / self.forest_depth ** (1.0 / 3.0)
-                * u**2.0)
+        return self.depth_aggregates().bed_coefficient * u**2.0
 
     def total_shear_stress(self):
-        R = self.forest_depth * (1.0 - self.storage_reduction_factor())
-        if self.submergence == 'submerged':
-            R = R + self.submergence_depth
-        return water_density * g * R * self.energy_slope
+        return water_density * g * self.depth_aggregates().shear_radius * self.energy_slope
 
     def rupture_forest(self):
-        for tree in self.forest.trees:
-            tree.rupture_tree()
+        self.forest.rupture_trees()
 
     def resolve_velocity(self):
+        # returns a SolveResult() with the reported metrics of the solved depth and slope
+        with instruments.timer('solving'):
+            result = self.resolve_forest_velocity()
+        instruments.count('solves')
+        return result
+
+    def resolve_forest_velocity(self):
 
         #  check if ruptured
         if self.is_ruptured:
             self.rupture_forest()
-            print('Forest is ruptured...')
+            self.logger.debug('Forest is ruptured...')
+
+        #  get the forest canopy height (a bending canopy is iterated with the forest velocity); for
+        #  a flow level it is the average canopy level above the bed level, as BatchSolver().solve_levels()
+        if self.level_mode:
+            canopy_height = self.forest.canopy_level(self.is_ruptured) - self.bed_level
+        else:
+            canopy_height = self.forest.canopy_height(self.is_ruptured)
+        for iteration in range(self.forest.canopy_iterations):
+            self.resolve_forest_layer(canopy_height)
+            if not self.canopy_bends():
+                break
+            bent_height = float(self.forest.canopy_height(self.is_ruptured, self.forest_velocity, self.water_depth))
+            converged = abs(bent_height - canopy_height) < self.forest.canopy_tolerance
+            canopy_height = bent_height
+            if converged:
+                break
+        else:
+            self.logger.warning('!!!WARNING: bent canopy height did not converge, value is {0:0.3f} m'
+                                .format(canopy_height))
+
+        # Set the drag regime of each tree at the solved velocity (the only pass over the trees after the solve)
+        drag_shear = self.forest.drag_shear(self.forest_velocity)
+        aggregates = self.depth_aggregates()
 
-        #  get the forest canopy height
-        self.forest_depth = self.forest.canopy_height(self.is_ruptured)
+        # Print some metrics to the console for checking
+        if self.logger.enabled(DEBUG):
+            trees = self.forest.tree_arrays()
+            self.logger.debug('bed stress: {0:0.2f} forest stress: {1:0.2f} total stress: {2:0.3f} drag: {3:0.3f} '
+                              'area: {4:0.3f}'.format(self.bed_shear_stress(self.forest_velocity),
+                                                      drag_shear,
+                                                      self.total_shear_stress(),
+                                                      trees.drag_force(self.forest_velocity)[0],
+                                                      trees.area_h[0]))
+
+        # Submergence layer
+        if self.submergence_depth > 0.001:
+            #print('The canopy is submerged by a depth of {0:.3f} m'.format(self.submergence_depth))
+            self.submergence = 'submerged'
+            self.submergence_velocity = self.submergence_layer_velocity(self.forest_velocity)
+            self.flow_velocity = ((self.forest_depth * self.forest_velocity * (1 - aggregates.cwf)
+                                  + self.submergence_depth * self.submergence_velocity) /
+                                  self.water_depth)
+        else:
+            self.submergence_velocity = 0.0
+            self.flow_velocity = self.forest_velocity
+        # print('velocity found: {0:.3f}'.format(self.flow_velocity))
+        return self.solve_result(drag_shear, aggregates)
+
+    def solve_result(self, drag_shear, aggregates):
+        # the reported metrics from the solved state, without further passes over the trees
+        trees = self.forest.tree_arrays()
+        geometry = trees.depth_geometry
+        u = self.forest_velocity
+        submerged = self.submergence == 'submerged'
+        bed_shear = aggregates.bed_coefficient * u ** 2.0
+        total_shear = water_density * g * aggregates.shear_radius * self.energy_slope
+        reconfiguration = np.count_nonzero(trees.wet & (u >= trees.threshold_u))
+        flow_u = self.flow_velocity
+        return SolveResult(Flow_Depth=self.water_depth,
+                           Velocity=flow_u,
+                           Bare_U=self.mannings_u(),
+                           Mannings_n=aggregates.hydraulic_radius ** (2 / 3) * self.energy_slope ** (1 / 2) / flow_u,
+                           Slope=self.energy_slope,
+                           Q_unblocked=self.water_depth * flow_u,
+                           Q_blocked=(self.channel_volume() - geometry.volume) / self.length * flow_u / self.width,
+                           Regime=int(round(reconfiguration / trees.size * 100)),
+                           Error=int(round((bed_shear + drag_shear - total_shear) / total_shear * 100)),
+                           U0=float(self.forest.average_threshold_velocity(999.0 if submerged else self.water_depth)),
+                           forest_u=u,
+                           submergence_u=self.submergence_velocity,
+                           CWF=aggregates.cwf,
+                           SRF=aggregates.srf,
+                           Tot_Af=geometry.total_frontal_area,
+                           Submerged=submerged)
+
+    def canopy_bends(self):
+        # the bent canopy is used for flow depths (the ruptured canopy is already flattened)
+        return self.forest.canopy_bending and not self.is_ruptured and not self.level_mode
+
+    def resolve_forest_layer(self, canopy_height):
+        self.forest_depth = canopy_height
 
         #  set emergence state
         self.submergence = 'emergent'
         self.submergence_depth = self.water_depth - self.forest_depth
         if self.submergence_depth > 0.001:
             self.submergence = 'submerged'
-            self.forest.set_flow_depth(999.0)  # set flow depth to tree height
+            if not self.level_mode:
+                self.forest.set_flow_depth(999.0)  # set flow depth to tree height
+        elif self.canopy_bends():
+            self.forest.set_flow_depth(self.water_depth)
 
-        print('Water depth: {0:0.2f}    Canopy height: {1:0.2f}    State: {2}'.
-              format(self.water_depth, self.forest_depth, self.submergence))
+        self.logger.debug('Water depth: {0:0.2f}    Canopy height: {1:0.2f}    State: {2}'.
+                          format(self.water_depth, self.forest_depth, self.submergence))
 
         if self.submergence == 'emergent':
             self.forest_depth = self.water_depth
 
         # Get the rigid velocity and check if there is reconfiguration
-        R = self.forest_depth*(1-self.cell_width_factor())
-        rigid_u = 1/self.rigid_composite_n() * R**(2.0/3.0) * math.sqrt(self.energy_slope)
-        print('Rigid_velocity: {0:0.3f}m/s Mannings n: {1:0.3f}  theta_a: {2:0.2f}'
-              .format(rigid_u, self.rigid_composite_n(), self.cell_width_factor()))
+        aggregates = self.depth_aggregates()
+        R = self.forest_depth*(1-aggregates.cwf)
+        rigid_u = 1/aggregates.rigid_composite_n * R**(2.0/3.0) * math.sqrt(self.energy_slope)
+        self.logger.debug('Rigid_velocity: {0:0.3f}m/s Mannings n: {1:0.3f}  theta_a: {2:0.2f}'
+                          .format(rigid_u, aggregates.rigid_composite_n, aggregates.cwf))
         if self.forest.check_if_rigid(rigid_u):
             self.forest_velocity = rigid_u
         # Get the reconfiguration velocity if needed
         else:
-            opt_result = optimize.newton(
-                lambda u: (self.bed_shear_stress(u)
-                           + self.forest.drag_shear(u)
-                           - self.total_shear_stress()), 1)
-            self.forest_velocity = opt_result
-
-        # Print some metrics to the console for checking
-        tree = self.forest.trees[0]
-        print('bed stress: {0:0.2f} forest stress: {1:0.2f} total stress: {2:0.3f} drag: {3:0.3f} area: {4:0.3f}'
-              .format(self.bed_shear_stress(self.forest_velocity),
-                      self.forest.drag_shear(self.forest_velocity),
-                      self.total_shear_stress(),
-                      tree.drag_force(self.forest_velocity),
-                      tree.area_h()))
-
-        # Submergence layer
-        if self.submergence_depth > 0.001:
-            #print('The canopy is submerged by a depth of {0:.3f} m'.format(self.submergence_depth))
-            self.submergence = 'submerged'
-            self.submergence_velocity = self.submergence_layer_velocity(self.forest_velocity)
-            self.flow_velocity = ((self.forest_depth * self.forest_velocity * (1 - self.cell_width_factor())
-                                  + self.submergence_depth * self.submergence_velocity) /
-                                  self.water_depth)
-        else:
-            self.flow_velocity = self.forest_velocity
-        # print('velocity found: {0:.3f}'.format(self.flow_velocity))
+            # the rigid velocity is a lower bound (rigid drag is the largest drag) and the
+            # velocity without any tree drag is an upper bound; warm start from the last solution
+            upper_u = math.sqrt(self.total_shear_stress() / self.bed_shear_stress(1.0))
+            if self.solver_mode == 'piecewise':
+                solver = PiecewiseSolver()
+                u, converged = solver.solve(self.forest.sorted_drag(), self.bed_shear_stress(1.0),
+                                            self.total_shear_stress(), self.plan_area, rigid_u, upper_u)
+                instruments.count('newton_iterations', int(solver.iterations[0]))
+                instruments.count('bisections', int(solver.bisections[0]))
+                if not converged[0]:
+                    raise RuntimeError('Velocity failed to converge, value is {}'.format(u[0]))
+                self.forest_velocity = u[0]
+            else:
+                bisections = self.velocity_solver.bisections
+                self.forest_velocity = self.velocity_solver.solve(self.velocity_residual, rigid_u, upper_u,
+                                                                  self.forest_velocity)
+                instruments.count('newton_iterations', self.velocity_solver.iterations)
+                instruments.count('bisections', self.velocity_solver.bisections - bisections)
+
+    def velocity_residual(self, u):
+        # force balance residual and its derivative with respect to u
+        instruments.count('residual_evaluations')
+        # only the drag depends on u; the depth aggregates are computed once per depth
+        aggregates = self.aggregates
+        drag_shear, drag_shear_du = self.forest.drag_shear_and_derivative(u)
+        bed_shear = aggregates.bed_coefficient * u**2.0
+        total_shear = water_density * g * aggregates.shear_radius * self.energy_slope
+        return bed_shear + drag_shear - total_shear, 2.0 * bed_shear / u + drag_shear_du
 
     def submergence_layer_velocity(self, uf):
         shear_u = math.sqrt(g * self.submergence_depth * self.energy_slope)
@@ -342,33 +639,90 @@ class RectChannel:
         return 1/self.n*self.water_depth**(2.0/3.0)*self.energy_slope**0.5
 
     def cell_width_factor(self):
-        if self.blockage:
-            cwf = math.sqrt(self.storage_reduction_factor())
-        else:
-            cwf = 0.0
-
-        return cwf
+        return self.depth_aggregates().cwf
 
     def storage_reduction_factor(self):
-        if self.blockage:
-            srf = self.forest.total_plan_area()/self.plan_area
+        return self.depth_aggregates().srf
+
+    def theta(self):
+        return self.depth_aggregates().theta
+
+    def rigid_forest_n(self):
+        return self.depth_aggregates().rigid_forest_n
+
+    def rigid_composite_n(self):
+        return self.depth_aggregates().rigid_composite_n
+
+
+'''
+Aggregates of a RectChannel() that only depend on the flow depth: the storage reduction
+and cell width factors, theta, the hydraulic and shear radii, the canopy (forest layer)
+height and the rigid Manning's n. They are computed from the forest geometry the first
+time they are needed after the depth is set, and recomputed if the depth, emergence
+state, canopy height or forest geometry change (e.g. a submerged or bent canopy).
+'''
+
+
+class DepthAggregates:
+    def __init__(self, channel):
+        self.key = self.state(channel)
+        geometry = channel.forest.tree_arrays().depth_geometry
+        if channel.blockage:
+            srf = geometry.total_plan_area / channel.plan_area
         else:
             srf = 0.0
         if srf > 0.9:
             srf = 0.9
-            print('!!!WARNING: Storage reduction factor is large!')
-        return srf
+            channel.logger.warning('!!!WARNING: Storage reduction factor is large!')
+        self.srf = srf
+        self.cwf = math.sqrt(srf)
+        self.theta = (1.0 - srf) / (1.0 - self.cwf)**(4.0/3.0)
+        self.canopy_height = channel.forest_depth
+        submergence_depth = channel.submergence_depth if channel.submergence == 'submerged' else 0.0
+        self.hydraulic_radius = channel.forest_depth * (1.0 - self.cwf) + submergence_depth
+        self.shear_radius = channel.forest_depth * (1.0 - srf) + submergence_depth
+        self.bed_coefficient = water_density * g * channel.n**2.0 * self.theta / channel.forest_depth**(1.0/3.0)
+        self.rigid_forest_n = math.sqrt(channel.forest_depth**(1.0/3.0) * geometry.total_rigid_drag
+                                        / (water_density * g * channel.plan_area * self.theta))
+        self.rigid_composite_n = math.sqrt(channel.n**2 + self.rigid_forest_n**2)
+        instruments.count('depth_aggregates')
+
+    @staticmethod
+    def state(channel):
+        return (channel.water_depth, channel.forest_depth, channel.submergence, channel.submergence_depth,
+                channel.forest.tree_arrays().depth_geometry, channel.n, channel.blockage, channel.plan_area)
+
+    def is_current(self, channel):
+        return self.key == self.state(channel)
 
-    def theta(self):
-        exp = 4.0/3.0
-        numerator = 1.0 - self.storage_reduction_factor()
-        denominator = (1.0 - self.cell_width_factor())**exp
-        return numerator / denominator
 
-    def rigid_forest_n(self):
-        numerator = self.forest_depth**(1.0/3.0) * self.forest.total_rigid_speed_specific_drag()
-        denominator = water_density * g * self.plan_area * self.theta()
-        return math.sqrt(numerator/denominator)
+'''
+Metrics of one RectChannel.resolve_velocity() solve, named as the result columns. The
+values are set once when the solve finishes and cannot be changed afterwards.
+'''
 
-    def rigid_composite_n(self):
-        return math.sqrt(self.n**2 + self.rigid_forest_n()**2)
+
+class SolveResult:
+    __slots__ = ('Flow_Depth', 'Velocity', 'Bare_U', 'Mannings_n', 'Slope', 'Q_unblocked', 'Q_blocked', 'Regime',
+                 'Error', 'U0', 'forest_u', 'submergence_u', 'CWF', 'SRF', 'Tot_Af', 'Submerged')
+
+    def __init__(self, **values):
+        for key in self.__slots__:
+            object.__setattr__(self, key, values[key])
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Solve results cannot be changed: {}'.format(key))
+
+    def __reduce__(self):
+        return (SolveResult.from_dict, (self.as_dict(),))
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self):
+        return 'SolveResult: h = {0:.3f} m, U = {1:.3f} m/s, n = {2:.4f}'.format(self.Flow_Depth, self.Velocity,
+                                                                                 self.Mannings_n)
@@ -0,0 +1,206 @@
+"""
+This script contains a Monte Carlo ensemble for the reach averaged forest resistance model.
+Species coefficients (e.g. Cd0, the Vogel exponent or the modulus) are sampled from the
+distributions in an ensemble parameter file. The sampled coefficients are columns with one
+row per member, so the tree geometry of all members is computed in one go, and the members
+are solved together as extra rows of the BatchSolver() grid. Batches of members can be
+solved on a process pool. The output is percentiles of Manning's n and velocity for each
+depth and slope. The classes are used in the Hydraulics.py script.
+"""
+import copy
+import numpy as np
+import pandas as pd
+from Forest import DepthGeometry
+from Forest import Species
+from Forest import species_parameter_columns
+from Solver import BatchSolver
+from Solver import ParallelSweep
+from Instrumentation import instruments
+
+distribution_types = ('normal', 'lognormal', 'uniform')
+
+'''
+Parameter distributions from an ensemble parameter file (csv), one row per sampled
+coefficient. *Type* is the tree type (blank for all types), *Parameter* a species
+parameter file column (e.g. Drag), *Index* the coefficient (from 0) and *Distribution*
+normal, lognormal or uniform with *Spread* the standard deviation, the standard deviation
+of the log or the half width. Each distribution is centred on the species coefficient.
+'''
+
+
+class ParameterDistributions:
+    def __init__(self, rows):
+        self.rows = rows
+
+    @classmethod
+    def read(cls, file_name):
+        df = pd.read_csv(file_name, dtype=str, keep_default_na=False)
+        rows = []
+        for row in df.to_dict('records'):
+            parameter = row['Parameter'].strip()
+            distribution = row['Distribution'].strip().lower()
+            if parameter not in species_parameter_columns or parameter == 'Ruptured_drag':
+                raise ValueError('Unknown ensemble parameter: {}'.format(parameter))
+            name, count = species_parameter_columns[parameter]
+            index = int(row['Index'])
+            if not 0 <= index < count:
+                raise ValueError('{} parameters have {} values, index {} is not valid'.format(parameter, count, index))
+            if distribution not in distribution_types:
+                raise ValueError('Unknown distribution for {}: {}'.format(parameter, distribution))
+            rows.append({'type': row.get('Type', '').strip(), 'name': name, 'index': index,
+                         'distribution': distribution, 'spread': float(row['Spread'])})
+        return cls(rows)
+
+    def sample(self, rng, members):
+        # standard draws (one column per row): standard normal, or uniform on [-1, 1]
+        draws = np.empty((members, len(self.rows)))
+        for k, row in enumerate(self.rows):
+            if row['distribution'] == 'uniform':
+                draws[:, k] = rng.uniform(-1.0, 1.0, members)
+            else:
+                draws[:, k] = rng.standard_normal(members)
+        return draws
+
+    def member_species(self, species, tree_types, draws):
+        # the species with each coefficient as a (member, 1) column, sampled for the rows of its tree types
+        parameters = {name: [np.full((draws.shape[0], 1), float(value)) for value in getattr(species, name)]
+                      for name, count in species_parameter_columns.values() if name != 'ruptured_drag_parameters'}
+        for k, row in enumerate(self.rows):
+            if row['type'] and row['type'] not in tree_types:
+                continue
+            values = parameters[row['name']][row['index']]
+            if row['distribution'] == 'lognormal':
+                values *= np.exp(row['spread'] * draws[:, k:k + 1])
+            else:
+                values += row['spread'] * draws[:, k:k + 1]
+        return Species(species.name, **parameters)
+
+
+'''
+Monte Carlo ensemble solver. The parameter draws are made up front from a seeded
+generator (numpy SeedSequence), so a run is reproduced by its seed whatever the number of
+processes. The members are split into batches that keep the (depth, member, slope, tree)
+arrays within max_elements, and the batches are solved in order (or on a process pool).
+'''
+
+
+class EnsembleSolver:
+    def __init__(self, channel, distributions, members=200, seed=None, percentiles=(5, 50, 95), processes=1,
+                 max_elements=2**22, mp_context=None):
+        self.channel = channel
+        self.distributions = distributions
+        self.members = members
+        self.seed = seed
+        self.percentiles = list(percentiles)
+        self.processes = processes
+        self.max_elements = max_elements
+        self.mp_context = mp_context
+
+    def sample(self):
+        # the seed is kept (random when not given) so the run can be repeated
+        seed_sequence = np.random.SeedSequence(self.seed)
+        self.seed = seed_sequence.entropy
+        return self.distributions.sample(np.random.default_rng(seed_sequence), self.members)
+
+    def solve(self, depths, slopes):
+        # Mannings n and velocity of every member, as (depth, slope, member) arrays
+        depths = np.asarray(depths, dtype=float)
+        slopes = np.asarray(slopes, dtype=float)
+        channel = self.channel
+        if channel.is_ruptured:
+            channel.rupture_forest()
+        draws = self.sample()
+        trees = channel.forest.tree_arrays()
+        batch = max(1, self.max_elements // (depths.size * slopes.size * max(1, trees.size)))
+        tasks = [(depths, slopes, draws[start:start + batch]) for start in range(0, self.members, batch)]
+
+        with instruments.timer('ensemble'):
+            if self.processes > 1:
+                sweep = ParallelSweep(channel, self.processes, mp_context=self.mp_context)
+                with sweep.pool(init_worker, (sweep.worker_channel(), self.distributions)) as executor:
+                    batches = list(executor.map(solve_task, tasks))
+            else:
+                members = EnsembleMembers(channel, self.distributions)
+                batches = [members.solve(*task) for task in tasks]
+        instruments.count('ensemble_members', self.members)
+        return {key: np.concatenate([batch_results[key] for batch_results in batches], axis=2)
+                for key in batches[0]}
+
+    def summary(self, results):
+        # percentiles (and mean) of each result over the members, as (depth, slope) arrays
+        summary = {}
+        for key, values in results.items():
+            summary['{}_mean'.format(key)] = np.mean(values, axis=2)
+            for percentile, percentile_values in zip(self.percentiles,
+                                                     np.percentile(values, self.percentiles, axis=2)):
+                summary['{}_p{:g}'.format(key, percentile)] = percentile_values
+        return summary
+
+
+'''
+A batch of ensemble members for a RectChannel(). The geometry of the forest at each
+depth is computed for all members at once, and each (depth, member) pair is one row of a
+BatchSolver() solve with the member's geometry and Vogel exponents.
+'''
+
+
+class EnsembleMembers:
+    def __init__(self, channel, distributions):
+        self.channel = channel
+        self.distributions = distributions
+        self.solver = BatchSolver(channel, mode='newton')
+
+    def member_trees(self, draws):
+        # a copy of the forest arrays with the sampled species of each group
+        forest = self.channel.forest
+        trees = forest.tree_arrays()
+        members = copy.copy(trees)
+        groups = []
+        for species, start, stop in trees.groups:
+            tree_types = [tree_type for tree_type, type_species in forest.species_types.items()
+                          if species is type_species or species is type_species.ruptured]
+            groups.append((self.distributions.member_species(species, tree_types, draws), start, stop))
+        members.groups = groups
+        return members
+
+    def solve(self, depths, slopes, draws):
+        channel = self.channel
+        trees = channel.forest.tree_arrays()
+        members = self.member_trees(draws)
+        member_count = draws.shape[0]
+        vogel_exp = np.concatenate([np.broadcast_to(species.drag_parameters[1], (member_count, stop - start))
+                                    for species, start, stop in members.groups], axis=1)
+
+        # geometry of all members at each depth (full tree height when the canopy is submerged)
+        canopy_height = channel.forest.canopy_height(channel.is_ruptured)
+        geometries = []
+        for depth in depths:
+            if depth - canopy_height > 0.001:
+                flow_depth = trees.height
+            else:
+                flow_depth = np.where(trees.height > depth, depth, trees.height)
+            wet, area_h, first_area_h, threshold_u, rigid_drag = members.geometry(flow_depth)
+            totals = np.sum(DepthGeometry.tree_totals(trees.population, flow_depth, area_h, rigid_drag), axis=2)
+            for m in range(member_count):
+                geometry = DepthGeometry(trees, flow_depth, (wet, area_h[m], first_area_h[m], threshold_u[m],
+                                                             rigid_drag[m]), totals[:, m])
+                geometry.vogel_exp = vogel_exp[m]
+                geometries.append(geometry)
+
+        results = self.solver.solve_canopy(np.repeat(depths, member_count), slopes, None, canopy_height,
+                                           geometries)
+        shape = (depths.size, member_count, slopes.size)
+        return {key: results[key].reshape(shape).transpose(0, 2, 1) for key in ('Mannings_n', 'Velocity')}
+
+
+# worker process state for EnsembleSolver()
+worker_members = None
+
+
+def init_worker(channel, distributions):
+    global worker_members
+    worker_members = EnsembleMembers(channel, distributions)
+
+
+def solve_task(task):
+    return worker_members.solve(*task)
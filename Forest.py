@@ -2,8 +2,13 @@
 The classes include Forest(), which is a container of the Tree() class. Forest() is passed
 to the Channel.py file to be included in a channel object.
 """
+from collections import OrderedDict
+import copy
 import math
+import os
 from Logger import LogFile
+from Instrumentation import instruments
+from TreeDatabase import TreeDatabase
 import pandas as pd
 import numpy as np
 
@@ -14,7 +19,9 @@ delta_U0_threshold = 0.001  # m/s -- used to stop bouncing around U0
 '''
 This class is a container for individual trees (Tree() class), and is passed to the channel 
 class. The total drag stress is computed. The forest is set up using a uniform flow model
-(ufm) file, which is passed to the python script using a batch file.
+(ufm) file, which is passed to the python script using a batch file. A forest read from
+a tree database only holds the array store (TreeArrays()), so self.trees is empty and
+get_tree() makes the Tree() objects from the arrays.
 '''
 
 
@@ -22,140 +29,203 @@ class Forest:
     def __init__(self, plan_area=1.0):
         self.plan_area = plan_area
         self.trees = []
+        self.arrays = None
         self.flow_depth = 0.0
         self.flow_level = 0.0
         self.u0 = 0.0
+        self.is_ruptured = False
+        self.geometry_cache = GeometryCache()
+        self.database_cache = True
+        self.species_types = dict(species_types)
+        # the canopy height follows the bent height of the trees (iterated with the velocity)
+        self.canopy_bending = False
+        self.bending_slices = 50
+        self.canopy_tolerance = 0.001  # m
+        self.canopy_iterations = 20
+        # height class approximation: classes per species (0 = individual trees), or chosen for a
+        # target relative error in Mannings n
+        self.height_classes = 0
+        self.height_class_error = 0.0
+        self.exact_arrays = None
         self.logger = LogFile()
         self.Cu = 1 # Yang and Choi (2010) = 1 if a < 5 m-1
 
     def read_database(self, filename):
-        df = pd.read_csv(filename)
+        # the trees are read into the array store (no Tree() objects are made)
         self.logger.log('Reading tree database...')
-        # print(df)
+        database = TreeDatabase(filename, list(self.species_types))
+        columns = database.read(self.database_cache)
+        if database.from_cache:
+            self.logger.log('Opened the parsed tree database: {}'.format(os.path.abspath(database.cache_file)))
+        if database.skipped > 0:
+            self.logger.log('Error: !!! tree type not recognised !!! ({} trees skipped)'.format(database.skipped))
+        self.trees = []
+        self.exact_arrays = None
+        self.arrays = TreeArrays.from_columns(columns['height'], columns['population'], columns['ground_level'],
+                                              np.zeros(columns['height'].size), columns['species'],
+                                              list(self.species_types.values()), self.logger)
+        self.geometry_cache.clear()
+
+    def read_species_parameters(self, filename):
+        # add (or replace) tree types from a species parameter file (csv), one row per tree type
+        df = pd.read_csv(filename, dtype=str, keep_default_na=False)
+        for row in df.to_dict('records'):
+            parameters = {}
+            for column, (name, count) in species_parameter_columns.items():
+                values = [float(value) for value in row.get(column, '').replace(',', ' ').split()]
+                if len(values) != count and not (column == 'Ruptured_drag' and not values):
+                    raise ValueError('{} parameters of tree type {} need {} values, found {}'
+                                     .format(column, row['Type'], count, len(values)))
+                parameters[name] = values if values else None
+            self.species_types[row['Type'].strip()] = Species(row['Name'].strip(), **parameters)
+            self.logger.log('Tree type: {} ({})'.format(row['Type'].strip(), row['Name'].strip()))
 
-        for index, row in df.iterrows():
-            if row.Type == 'Casuarina-overstory':
-                # self.logger.log(row)
-                self.add_tree(CasOver(row.Height, row.Population, row.GroundLevel))
-            else:
-                self.logger.log('Error: !!! tree type not recognised !!!')
     def assign_ufm(self, ufm):
         self.logger.set_log_file_name(ufm)
 
+    def tree_arrays(self):
+        # the array store is (re)built from the trees the first time it is needed
+        if self.arrays is None:
+            self.arrays = TreeArrays(self.trees, self.logger)
+        return self.arrays
+
     def average_tree_height(self):
-        cumulator = 0
-        counter = 0
-        for tree in self.trees:
-            if tree.height > 0.001:
-                counter += tree.number_of_specimens
-                cumulator += tree.height * tree.number_of_specimens
-        return cumulator / counter
+        arrays = self.tree_arrays()
+        mask = arrays.height > 0.001
+        return np.sum(arrays.height[mask] * arrays.population[mask]) / np.sum(arrays.population[mask])
 
     def average_canopy_width(self):
-        cumulator = 0
-        counter = 0
-        for tree in self.trees:
-            if tree.canopy_width > 0.001:
-                counter += tree.number_of_specimens
-                cumulator += tree.canopy_width * tree.number_of_specimens
-        return cumulator / counter
+        arrays = self.tree_arrays()
+        mask = arrays.canopy_width > 0.001
+        return np.sum(arrays.canopy_width[mask] * arrays.population[mask]) / np.sum(arrays.population[mask])
 
-    def canopy_height(self, is_ruptured):
+    def canopy_height(self, is_ruptured, u=None, flow_depth=None):
+        # with canopy bending, the bent height at the forest velocity u (and flow depth), which
+        # can be arrays (e.g. one per depth and slope)
         if is_ruptured:
             return self.average_canopy_width() / 2
+        elif self.canopy_bending and u is not None:
+            return self.tree_arrays().average_bent_height(u, flow_depth, self.bending_slices)
         else:
             return self.average_tree_height()
 
     def add_tree(self, new_tree):
         self.trees.append(new_tree)
+        self.arrays = None
+        self.exact_arrays = None
+        self.geometry_cache.clear()
+
+    def use_height_classes(self, classes):
+        # solve on height classes of the trees (the individual trees are kept, 0 restores them)
+        if self.exact_arrays is None:
+            self.exact_arrays = self.tree_arrays()
+        self.arrays = self.exact_arrays if classes <= 0 else self.exact_arrays.height_classes(classes)
+        self.geometry_cache.clear()
 
     def get_tree(self, ind):
-        return self.trees[ind]
+        if self.trees:
+            return self.trees[ind]
+        arrays = self.exact_arrays if self.exact_arrays is not None else self.tree_arrays()
+        return arrays.tree(ind)
 
     def population(self):
-        population = 0
-        for tree in self.trees:
-            population += tree.number_of_specimens
-        return population
+        return np.sum(self.tree_arrays().population)
 
     def density(self):
         return self.population() / self.plan_area
 
     def set_flow_depth(self, h):
         self.flow_depth = h
-        for tree in self.trees:
-            if tree.height > h:
-                tree.flow_depth = h
-            else:
-                tree.flow_depth = tree.height
+        self.tree_arrays().set_geometry(self.depth_geometry(h))
 
     def set_flow_level(self, h):
         self.flow_level = h
+        self.tree_arrays().set_geometry(self.level_geometry(h))
+
+    def depth_geometry(self, h):
+        # tree geometry for a flow depth, from the cache if this depth has been seen before
+        arrays = self.tree_arrays()
+        return self.geometry_cache.get(
+            ('depth', h, self.is_ruptured),
+            lambda: DepthGeometry(arrays, np.where(arrays.height > h, h, arrays.height)))
+
+    def level_geometry(self, h):
+        # tree geometry for a flow level (each tree is wetted from its ground level), from the
+        # cache or the wetting index of the trees
+        arrays = self.tree_arrays()
+        return self.geometry_cache.get(('level', h, self.is_ruptured), lambda: arrays.level_geometry(h))
+
+    def canopy_level(self, is_ruptured):
+        # average level of the canopy top (the ruptured canopy is half the canopy width high)
+        arrays = self.tree_arrays()
+        top = arrays.canopy_width / 2 if is_ruptured else arrays.height
+        mask = top > 0.001
+        return np.sum((arrays.ground_level[mask] + top[mask]) * arrays.population[mask]) / np.sum(
+            arrays.population[mask])
+
+    def rupture_trees(self):
+        if self.is_ruptured:
+            return
+        self.is_ruptured = True
         for tree in self.trees:
-            tree.flow_depth = h - tree.ground_level
-            if tree.flow_depth > tree.height:
-                tree.flow_depth = tree.height
-            elif tree.flow_depth < 0.001:
-                tree.flow_depth = 0.0001
+            tree.rupture_tree()
+        self.tree_arrays().rupture()
 
     def total_drag(self, u):
-        cumulative_drag = 0.0
-        for tree in self.trees:
-            if tree.flow_depth > 0.001:  # using depth of 0.001m as a threshold for computing drag
-                cumulative_drag += tree.drag_force(u) * tree.number_of_specimens
-        return cumulative_drag
+        arrays = self.tree_arrays()
+        return np.sum(arrays.drag_force(u) * arrays.population)
 
     def total_rigid_speed_specific_drag(self):
-        cumulative_drag = 0.0
-        for tree in self.trees:
-            if tree.flow_depth > 0.001:  # using depth of 0.001m as a threshold for computing drag
-                cumulative_drag += tree.rigid_speed_specific_drag() * tree.number_of_specimens
-        return cumulative_drag
+        return self.tree_arrays().depth_geometry.total_rigid_drag
 
     def check_if_rigid(self, u):
-        rigid = True
-        for tree in self.trees:
-            # print('Transition u: {}'.format(tree.threshold_velocity()))
-            if (u / tree.threshold_velocity()) > 0.001:
-                rigid = False
-        return rigid
+        return not np.any(u / self.tree_arrays().threshold_u > 0.001)
 
     def drag_shear(self, u):
         return self.total_drag(u) / self.plan_area
 
+    def drag_shear_and_derivative(self, u):
+        # one pass over the trees for the drag shear and its derivative with respect to u
+        arrays = self.tree_arrays()
+        drag = arrays.drag_force(u) * arrays.population
+        derivative = arrays.drag_force_derivative(u, drag)
+        return np.sum(drag) / self.plan_area, np.sum(derivative) / self.plan_area
+
     def get_average_threshold_velocity(self):
-        tree = self.trees[0]
-        tree.height = self.average_tree_height()
-        return tree.threshold_velocity()
+        return float(self.average_threshold_velocity(self.flow_depth))
+
+    def average_threshold_velocity(self, flow_depth):
+        # threshold velocity of the first tree at the average tree height, for one or more flow
+        # depths (a copy of the first tree is used, the trees are not modified)
+        tree = self.tree_arrays().take([0])
+        tree.height = np.array([self.average_tree_height()])
+        flow_depth = np.minimum(np.asarray(flow_depth, dtype=float), tree.height[0])
+        return tree.geometry(flow_depth[..., None])[3][..., 0]
 
     def get_reconfiguration_regime_proportion(self):
-        hit_counter = 0
-        total_counter = 0
-        for tree in self.trees:
-            total_counter += 1
-            if tree.drag_regime == 'reconfiguration':
-                hit_counter += 1
-        return round(hit_counter / total_counter * 100)
+        arrays = self.tree_arrays()
+        return round(np.count_nonzero(arrays.reconfiguration) / arrays.size * 100)
 
     def volume(self):
-        cumulative_volume = 0.0
-        for tree in self.trees:
-            ave_diameter = tree.area_h()/tree.flow_depth
-            cumulative_volume += math.pi*ave_diameter**2/4 * tree.flow_depth
-        return cumulative_volume
+        return self.tree_arrays().depth_geometry.volume
 
     def total_frontal_area(self):
-        cumulative_area = 0.0
-        for tree in self.trees:
-            cumulative_area += tree.area_h() * tree.number_of_specimens
-        return cumulative_area
+        return self.tree_arrays().depth_geometry.total_frontal_area
 
     def total_plan_area(self):
-        cumulative_area = 0.0
-        for tree in self.trees:
-            ave_diameter = tree.area_h() / tree.flow_depth
-            cumulative_area += math.pi * ave_diameter ** 2 / 4 * tree.number_of_specimens
-        return cumulative_area
+        return self.tree_arrays().depth_geometry.total_plan_area
+
+    def sorted_drag(self, depth_geometry=None):
+        # the trees sorted by threshold velocity, built once for each cached depth
+        if depth_geometry is None:
+            depth_geometry = self.tree_arrays().depth_geometry
+        if depth_geometry.sorted_drag is None:
+            depth_geometry.sorted_drag = SortedDrag(self.tree_arrays(), depth_geometry)
+        return depth_geometry.sorted_drag
+
+    def output_cache_summary(self):
+        self.logger.summary('Geometry cache: {} hits, {} misses, {} depths stored'.format(
+            self.geometry_cache.hits, self.geometry_cache.misses, len(self.geometry_cache.entries)))
 
     def output_geometry(self):
         self.logger.log(' ')
@@ -169,6 +239,576 @@ class Forest:
         return ''
 
 
+'''
+This class stores the trees of a Forest() as a struct of numpy arrays (one column per
+tree property). The trees are kept grouped by species (in order of first appearance, so
+the first tree stays first), and the forest geometry is computed with one whole-array
+kernel per species group using the shared Species() coefficients, which mirror the
+Tree() methods. A mixed forest costs about the same as a forest of one species. The
+geometry only depends on the flow depth, so it is computed once when the flow depth is
+set and reused for every velocity evaluation.
+'''
+
+
+class TreeArrays:
+    def __init__(self, trees, logger=None):
+        self.logger = logger if logger is not None else LogFile()
+        self.size = len(trees)
+        self.height = np.array([tree.height for tree in trees], dtype=float)
+        self.population = np.array([tree.number_of_specimens for tree in trees], dtype=float)
+        self.ground_level = np.array([tree.ground_level for tree in trees], dtype=float)
+        self.canopy_width = np.array([tree.canopy_width for tree in trees], dtype=float)
+        self.flow_depth = np.array([tree.flow_depth for tree in trees], dtype=float)
+        self.reconfiguration = np.zeros(self.size, dtype=bool)
+        species_codes = {}
+        species = [species_codes.setdefault(tree.species, len(species_codes)) for tree in trees]
+        self.species = np.array(species, dtype=np.int32)
+        self.species_table = list(species_codes)
+        self.level_index = None
+        self.group_species()
+        self.update_geometry()
+
+    @classmethod
+    def from_columns(cls, height, population, ground_level, canopy_width, species, species_table, logger=None):
+        # a store filled straight from database columns; species holds an index into species_table
+        arrays = cls.__new__(cls)
+        arrays.logger = logger if logger is not None else LogFile()
+        arrays.size = height.size
+        arrays.height = height
+        arrays.population = population
+        arrays.ground_level = ground_level
+        arrays.canopy_width = canopy_width
+        arrays.flow_depth = np.zeros(height.size)
+        arrays.reconfiguration = np.zeros(height.size, dtype=bool)
+        arrays.species = species
+        arrays.species_table = species_table
+        arrays.level_index = None
+        arrays.group_species()
+        arrays.update_geometry()
+        return arrays
+
+    def group_species(self):
+        # sort the trees by species (groups in order of first appearance) and set the groups
+        codes, first, counts = np.unique(self.species, return_index=True, return_counts=True)
+        appearance = np.argsort(first)
+        codes, counts = codes[appearance], counts[appearance]
+        rank = np.zeros(len(self.species_table), dtype=np.int32)
+        rank[codes] = np.arange(codes.size)
+        order = np.argsort(rank[self.species], kind='stable')
+        self.order = None
+        if np.any(order != np.arange(self.size)):
+            # arrays index i holds the tree at position order[i] of the input
+            self.order = order
+            for name in ['height', 'population', 'ground_level', 'canopy_width', 'flow_depth', 'reconfiguration',
+                         'species']:
+                setattr(self, name, getattr(self, name)[order])
+        stops = np.cumsum(counts)
+        self.groups = [(self.species_table[code], int(stop - count), int(stop))
+                       for code, count, stop in zip(codes, counts, stops)]
+        self.set_drag_parameters()
+
+    def set_drag_parameters(self):
+        # Cd0 and Vogel exponent of each tree (rows), used by the velocity kernels
+        columns = [np.broadcast_to(np.array(species.drag_parameters[:2], dtype=float)[:, None], (2, stop - start))
+                   for species, start, stop in self.groups]
+        if len(columns) == 1:
+            self.drag_parameters = columns[0]
+        else:
+            self.drag_parameters = np.concatenate(columns, axis=1) if columns else np.zeros((2, 0))
+
+    def rupture(self):
+        self.species_table = [species.ruptured for species in self.species_table]
+        self.groups = [(species.ruptured, start, stop) for species, start, stop in self.groups]
+        self.set_drag_parameters()
+        self.level_index = None
+        self.update_geometry()
+
+    def height_classes(self, classes):
+        # a store with up to classes height classes per species: each class holds an equal share
+        # of the species population, at the population weighted mean height, ground level and
+        # canopy width of its trees
+        columns = {name: [] for name in ('height', 'population', 'ground_level', 'canopy_width', 'species')}
+        for species, start, stop in self.groups:
+            order = start + np.argsort(self.height[start:stop], kind='stable')
+            population = self.population[order]
+            total = np.sum(population)
+            share = (np.cumsum(population) - population / 2) / total if total > 0 else np.zeros(order.size)
+            index = np.minimum((share * classes).astype(int), classes - 1)
+            class_population = np.bincount(index, weights=population, minlength=classes)
+            keep = class_population > 0
+            for name in ('height', 'ground_level', 'canopy_width'):
+                weighted = np.bincount(index, weights=population * getattr(self, name)[order], minlength=classes)
+                columns[name].append(weighted[keep] / class_population[keep])
+            columns['population'].append(class_population[keep])
+            columns['species'].append(np.full(np.count_nonzero(keep), self.species[start], dtype=np.int32))
+        columns = {name: np.concatenate(values) if values else np.zeros(0) for name, values in columns.items()}
+        return TreeArrays.from_columns(columns['height'], columns['population'], columns['ground_level'],
+                                       columns['canopy_width'], columns['species'].astype(np.int32),
+                                       self.species_table, self.logger)
+
+    def take(self, index):
+        # a new store holding a subset of the trees
+        subset = copy.copy(self)
+        for name, values in vars(self).items():
+            if isinstance(values, np.ndarray) and name != 'order':
+                setattr(subset, name, values[..., index])
+        subset.size = subset.height.size
+        subset.level_index = None
+        subset.group_species()
+        subset.update_geometry()
+        return subset
+
+    def tree(self, index):
+        # a Tree() copy of the tree at position index of the input (e.g. the database row), at its
+        # current flow depth
+        index = range(self.size)[index]
+        position = index if self.order is None else int(np.flatnonzero(self.order == index)[0])
+        tree = Tree(float(self.height[position]), float(self.population[position]),
+                    float(self.ground_level[position]), float(self.canopy_width[position]), str(index),
+                    self.species_table[self.species[position]])
+        tree.flow_depth = float(self.flow_depth[position])
+        return tree
+
+    def set_flow_depth(self, flow_depth):
+        self.set_geometry(DepthGeometry(self, np.asarray(flow_depth, dtype=float)))
+
+    def update_geometry(self):
+        self.set_geometry(DepthGeometry(self, self.flow_depth))
+
+    def set_geometry(self, depth_geometry):
+        self.depth_geometry = depth_geometry
+        self.flow_depth = depth_geometry.flow_depth
+        self.wet = depth_geometry.wet
+        self.area_h = depth_geometry.area_h
+        self.first_area_h = depth_geometry.first_area_h
+        self.threshold_u = depth_geometry.threshold_u
+        self.rigid_drag = depth_geometry.rigid_drag
+
+    def geometry(self, flow_depth):
+        # flow_depth can be one value per tree or a stack of them (one row per flow depth)
+        instruments.count('tree_kernel_calls', np.size(flow_depth))
+        wet = flow_depth > 0.001
+        groups = [self.species_geometry(species, self.height[start:stop], flow_depth[..., start:stop])
+                  for species, start, stop in self.groups]
+        if len(groups) == 1:
+            area_h, first_area_h, threshold_u, rigid_drag = groups[0]
+        else:
+            area_h, first_area_h, threshold_u, rigid_drag = [
+                np.concatenate([group[k] for group in groups], axis=-1) if groups else np.zeros(np.shape(flow_depth))
+                for k in range(4)]
+        return wet, area_h, first_area_h, threshold_u, rigid_drag
+
+    def subset_geometry(self, index, flow_depth):
+        # geometry of the trees at index (in increasing order) for their flow_depth, as geometry()
+        instruments.count('tree_kernel_calls', index.size)
+        if len(self.groups) == 1:
+            return [flow_depth > 0.001] + list(self.species_geometry(self.groups[0][0], self.height[index], flow_depth))
+        geometry = [np.empty(index.size) for _ in range(4)]
+        for species, start, stop in self.groups:
+            select = (index >= start) & (index < stop)
+            if np.any(select):
+                group = self.species_geometry(species, self.height[index[select]], flow_depth[select])
+                for values, group_values in zip(geometry, group):
+                    values[select] = group_values
+        return [flow_depth > 0.001] + geometry
+
+    def level_geometry(self, level):
+        if self.level_index is None:
+            self.level_index = LevelIndex(self)
+        return self.level_index.geometry(level)
+
+    def species_geometry(self, species, height, flow_depth):
+        # geometry of the trees of one species (scalar coefficients)
+        area_h = self.compute_area_h(species, height, flow_depth)
+        first_area_h = self.compute_first_area_h(species, height, flow_depth, area_h)
+        threshold_u = self.compute_threshold_velocity(species, height, flow_depth, first_area_h)
+        rigid_drag = np.where(flow_depth > 0.001, 0.5 * water_density * species.drag_parameters[0] * area_h, 0.0)
+        return area_h, first_area_h, threshold_u, rigid_drag
+
+    @staticmethod
+    def power_func(height, a, b):
+        return a * height ** b
+
+    def compute_area_h(self, species, height, flow_depth):
+        i, j, k, l, m = species.area_h_parameters
+        x = flow_depth / height
+        a = -i / (j * (k + x ** m)) + l
+        a = np.where(a > 1.0, 1.0, a)
+        area = a * self.power_func(height, *species.area_parameters)
+        return np.where(area > 0.001, area, 0.0001)
+
+    def compute_first_area_h(self, species, height, flow_depth, area_h):
+        a = area_h / self.power_func(height, *species.area_parameters)
+        z = species.first_area_h_parameters[0] * a ** 2 + species.first_area_h_parameters[1] * a
+        z_h = z * self.power_func(height, *species.first_area_parameters)
+        shallow = (flow_depth > 0.001) & (flow_depth < 0.01)
+        if np.any(shallow):
+            self.logger.debug('Shallow depth... modifying first moment of area')
+            z_h = np.where(shallow, area_h * flow_depth / 2, z_h)
+        return np.where(z_h > 0.001, z_h, 0.0001)
+
+    def compute_threshold_velocity(self, species, height, flow_depth, first_area_h):
+        modulus = self.power_func(height, *species.modulus_parameters)
+        cd = species.drag_parameters[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            threshold_u = np.sqrt(2 * modulus / (water_density * cd * first_area_h * flow_depth))
+        return np.where(flow_depth > 0.001, threshold_u, 99999)
+
+    def bending(self, u, flow_depth, slices=50):
+        # bent height, tip deflection and base curvature of each tree (last axis) for the
+        # velocities u and flow depths, which are broadcast together (e.g. one per depth and slope)
+        u = np.asarray(u, dtype=float)[..., None]
+        flow_depth = np.asarray(flow_depth, dtype=float)[..., None]
+        shape = np.broadcast(u, flow_depth).shape[:-1]
+        results = [np.empty(shape + (self.size,)) for _ in range(3)]
+        for start, stop, chunk in self.bending_chunks(u, flow_depth, slices):
+            for values, chunk_values in zip(results, chunk):
+                values[..., start:stop] = chunk_values
+        return results
+
+    def average_bent_height(self, u, flow_depth, slices=50):
+        # population weighted average bent height of the trees (as average_tree_height)
+        u = np.asarray(u, dtype=float)[..., None]
+        flow_depth = np.asarray(flow_depth, dtype=float)[..., None]
+        weights = np.where(self.height > 0.001, self.population, 0.0)
+        total = 0.0
+        for start, stop, chunk in self.bending_chunks(u, flow_depth, slices):
+            total = total + np.sum(chunk[0] * weights[start:stop], axis=-1)
+        return total / np.sum(weights)
+
+    def bending_chunks(self, u, flow_depth, slices, max_elements=2**21):
+        # the bending kernel on chunks of trees of one species, so the (velocity, tree, slice)
+        # arrays stay within max_elements
+        count = int(np.prod(np.broadcast(u, flow_depth).shape[:-1]))
+        chunk = max(1, max_elements // (max(1, count) * (slices + 1)))
+        instruments.count('bending_kernel_calls', count * self.size)
+        for species, start, stop in self.groups:
+            for first in range(start, stop, chunk):
+                last = min(first + chunk, stop)
+                yield first, last, self.species_bending(species, self.height[first:last], flow_depth, u, slices)
+
+    def species_bending(self, species, height, flow_depth, u, slices):
+        # the stem is a cantilever split into slices along its height. The drag of the wetted
+        # stem is spread over the slices in proportion to their frontal area, and the bending
+        # stiffness is the modulus (EI at the base) reduced with the trunk diameter (I ~ d^4).
+        # The curvature M/EI is integrated to the slope angle, which is capped at 90 degrees,
+        # and the slope to the height and deflection of the tree top
+        loaded = np.where(flow_depth < height, flow_depth, height)
+        area_h, first_area_h, threshold_u, rigid_drag = self.species_geometry(species, height, loaded)
+        ratio = u / threshold_u
+        force = rigid_drag * u ** 2.0 * np.where(ratio >= 1, ratio, 1.0) ** species.drag_parameters[1]
+
+        fraction = np.linspace(0.0, 1.0, slices + 1)
+        s = height[:, None] * fraction
+        ds = height / slices
+        wetted = self.compute_area_h(species, height[:, None], np.minimum(s, loaded[..., None]))
+        slice_area = np.diff(wetted, axis=-1)
+        total_area = np.sum(slice_area, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            load = np.where(total_area > 0, force / total_area, 0.0)[..., None] * slice_area
+        centre = (s[:, :-1] + s[:, 1:]) / 2
+        shear = np.cumsum(load[..., ::-1], axis=-1)[..., ::-1]
+        load_moment = np.cumsum((load * centre)[..., ::-1], axis=-1)[..., ::-1]
+        moment = np.concatenate([load_moment - s[:, :-1] * shear, np.zeros(load.shape[:-1] + (1,))], axis=-1)
+
+        a, b = species.diameter_h_parameters
+        taper = np.maximum(1 - (a * fraction ** 2 + b * fraction), 0.01)
+        stiffness = self.power_func(height, *species.modulus_parameters)[:, None] * taper ** 4
+        curvature = moment / stiffness
+        slope = np.cumsum((curvature[..., 1:] + curvature[..., :-1]) / 2, axis=-1) * ds[:, None]
+        slope = np.minimum(np.concatenate([np.zeros(slope.shape[:-1] + (1,)), slope], axis=-1), np.pi / 2)
+        mid_slope = (slope[..., 1:] + slope[..., :-1]) / 2
+        bent_height = np.sum(np.cos(mid_slope), axis=-1) * ds
+        deflection = np.sum(np.sin(mid_slope), axis=-1) * ds
+        return bent_height, deflection, curvature[..., 0]
+
+    def rigid_speed_specific_drag(self):
+        return self.rigid_drag
+
+    def drag_force(self, u):
+        instruments.count('tree_drag_evaluations', self.size)
+        vogel_exp = self.drag_parameters[1]
+        reconfiguration_term = u / self.threshold_u
+        reconfiguration = reconfiguration_term >= 1
+        self.reconfiguration = np.where(self.wet, reconfiguration, self.reconfiguration)
+        reconfiguration_term = np.where(reconfiguration, reconfiguration_term, 1.0) ** vogel_exp
+        return self.rigid_drag * u ** 2.0 * reconfiguration_term
+
+    def drag_force_derivative(self, u, drag_force):
+        # d(drag)/du: 2F/u in the rigid regime and (2 + Vogel exponent)F/u when reconfiguring
+        exponent = np.where(u >= self.threshold_u, 2.0 + self.drag_parameters[1], 2.0)
+        return exponent * drag_force / u
+
+
+'''
+The geometry of every tree in a TreeArrays() store at one flow depth, with the forest
+totals that only depend on the flow depth (not on the velocity or slope).
+'''
+
+
+class DepthGeometry:
+    def __init__(self, trees, flow_depth, geometry=None, totals=None):
+        # the tree geometry and forest totals can be given (e.g. from a LevelIndex())
+        self.flow_depth = flow_depth
+        with instruments.timer('geometry'):
+            if geometry is None:
+                geometry = trees.geometry(flow_depth)
+            self.wet, self.area_h, self.first_area_h, self.threshold_u, self.rigid_drag = geometry
+            if totals is None:
+                totals = np.sum(self.tree_totals(trees.population, flow_depth, self.area_h, self.rigid_drag), axis=1)
+            self.total_plan_area, self.volume, self.total_frontal_area, self.total_rigid_drag = totals
+        self.sorted_drag = None
+        # Vogel exponent of each tree when it differs from the trees' drag parameters (e.g. ensemble members)
+        self.vogel_exp = None
+
+    @staticmethod
+    def tree_totals(population, flow_depth, area_h, rigid_drag):
+        # each tree's share of the plan area, volume, frontal area and rigid drag totals
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ave_diameter = area_h / flow_depth
+            return np.stack([math.pi * ave_diameter ** 2 / 4 * population,
+                             math.pi * ave_diameter ** 2 / 4 * flow_depth,
+                             area_h * population,
+                             rigid_drag * population])
+
+
+'''
+Wetting index for flow levels over trees on uneven ground. The trees are sorted by
+ground level and by top level (ground level + height). At a flow level the trees with
+their ground above the level are dry and the trees with their top below it are fully
+submerged. The geometry of both is fixed, so it is computed once, and their share of
+the forest totals comes from cumulative sums in sorted order. The dry and submerged
+trees are found by binary search and only the partly wet trees are computed, so the
+totals are updated incrementally as the level rises.
+'''
+
+
+class LevelIndex:
+    def __init__(self, trees):
+        self.trees = trees
+        self.ground_order = np.argsort(trees.ground_level, kind='stable')
+        self.ground = trees.ground_level[self.ground_order]
+        self.tree_top = trees.ground_level + trees.height
+        self.top_order = np.argsort(self.tree_top, kind='stable')
+        self.top = self.tree_top[self.top_order]
+
+        # dry trees (flow depth of 0.0001 m) and fully submerged trees (flow depth = height)
+        dry_depth = np.full(trees.size, 0.0001)
+        self.dry = trees.geometry(dry_depth)
+        self.full = trees.geometry(trees.height)
+        dry_totals = DepthGeometry.tree_totals(trees.population, dry_depth, self.dry[1], self.dry[4])
+        full_totals = DepthGeometry.tree_totals(trees.population, trees.height, self.full[1], self.full[4])
+        # totals of the dry trees from the highest ground down and of the submerged trees from the lowest top up
+        self.dry_totals = self.cumulative(dry_totals[:, self.ground_order[::-1]])
+        self.full_totals = self.cumulative(full_totals[:, self.top_order])
+
+    @staticmethod
+    def cumulative(values):
+        return np.concatenate([np.zeros((values.shape[0], 1)), np.cumsum(values, axis=1)], axis=1)
+
+    def geometry(self, level):
+        trees = self.trees
+        wet_count = np.searchsorted(self.ground, level, side='right')  # ground <= level
+        full_count = np.searchsorted(self.top, level, side='left')  # top < level
+        is_full = self.tree_top < level
+        if wet_count - full_count < trees.size // 16:
+            # a few partly wet trees: take them from the trees sorted by ground level
+            partial = self.ground_order[:wet_count]
+            partial = np.sort(partial[~is_full[partial]])
+        else:
+            partial = np.nonzero(~is_full & (trees.ground_level <= level))[0]
+
+        # flow depth of the partly wet trees, as Tree.set_water_level()
+        partial_depth = level - trees.ground_level[partial]
+        partial_depth = np.where(partial_depth > trees.height[partial], trees.height[partial], partial_depth)
+        partial_depth = np.where(partial_depth < 0.001, 0.0001, partial_depth)
+        flow_depth = np.where(is_full, trees.height, 0.0001)
+        flow_depth[partial] = partial_depth
+
+        partial_geometry = trees.subset_geometry(partial, partial_depth)
+        geometry = []
+        for dry, full, partial_values in zip(self.dry, self.full, partial_geometry):
+            values = np.where(is_full, full, dry)
+            values[partial] = partial_values
+            geometry.append(values)
+        totals = (self.dry_totals[:, trees.size - wet_count] + self.full_totals[:, full_count]
+                  + np.sum(DepthGeometry.tree_totals(trees.population[partial], partial_depth,
+                                                     partial_geometry[1], partial_geometry[4]), axis=1))
+        return DepthGeometry(trees, flow_depth, geometry, totals)
+
+
+'''
+The drag of a forest at one flow depth, with the trees sorted by threshold velocity.
+Each tree drags as rigid below its threshold velocity and follows a power law (Vogel
+exponent) above it, so the total drag is a piecewise function of u with a breakpoint
+at every threshold velocity. Prefix sums of the rigid and reconfiguration coefficients
+(one set per Vogel exponent) give the drag at any velocity by binary search. Built
+once per depth in O(N log N).
+'''
+
+
+class SortedDrag:
+    def __init__(self, trees, depth_geometry):
+        coefficient = depth_geometry.rigid_drag * trees.population
+        wet = depth_geometry.wet & (coefficient > 0)
+        vogel_exp = np.broadcast_to(trees.drag_parameters[1], wet.shape)
+        self.vogel_exponents = np.unique(vogel_exp[wet])
+        self.threshold_u = []
+        self.rigid_suffix = []
+        self.reconfiguration_prefix = []
+        for exponent in self.vogel_exponents:
+            group = wet & (vogel_exp == exponent)
+            order = np.argsort(depth_geometry.threshold_u[group], kind='stable')
+            threshold_u = depth_geometry.threshold_u[group][order]
+            group_coefficient = coefficient[group][order]
+            # rigid: sum of c for threshold_u > u, reconfiguration: sum of c*threshold_u^-vogel for threshold_u <= u
+            self.threshold_u.append(threshold_u)
+            self.rigid_suffix.append(np.concatenate([np.cumsum(group_coefficient[::-1])[::-1], [0.0]]))
+            self.reconfiguration_prefix.append(
+                np.concatenate([[0.0], np.cumsum(group_coefficient * threshold_u ** -exponent)]))
+        self.breakpoints = np.unique(np.concatenate(self.threshold_u)) if self.threshold_u else np.zeros(0)
+        self.wet_trees = np.count_nonzero(wet)
+
+    def coefficients(self, u):
+        # the rigid coefficient (of u^2) and the reconfiguration coefficients (of u^(2 + vogel))
+        u = np.asarray(u, dtype=float)
+        rigid = np.zeros(u.shape)
+        reconfiguration = []
+        for threshold_u, rigid_suffix, reconfiguration_prefix in zip(
+                self.threshold_u, self.rigid_suffix, self.reconfiguration_prefix):
+            index = np.searchsorted(threshold_u, u, side='right')
+            rigid = rigid + rigid_suffix[index]
+            reconfiguration.append(reconfiguration_prefix[index])
+        return rigid, reconfiguration
+
+    def drag_and_derivative(self, u):
+        u = np.asarray(u, dtype=float)
+        rigid, reconfiguration = self.coefficients(u)
+        drag = rigid * u ** 2.0
+        derivative = 2.0 * rigid * u
+        for exponent, coefficient in zip(self.vogel_exponents, reconfiguration):
+            drag = drag + coefficient * u ** (2.0 + exponent)
+            derivative = derivative + (2.0 + exponent) * coefficient * u ** (1.0 + exponent)
+        return drag, derivative
+
+    def reconfiguration_count(self, u):
+        u = np.asarray(u, dtype=float)
+        return sum(np.searchsorted(threshold_u, u, side='right') for threshold_u in self.threshold_u)
+
+
+'''
+Bounded least recently used (LRU) cache of DepthGeometry() objects for a Forest(), keyed
+by flow depth (or level) and rupture state. The cache holds at most max_size depths and
+at most max_elements (tree, depth) values over all depths, so its memory is bounded by
+about max_elements x 50 bytes (six per-tree arrays per depth), ~100 MB by default, whatever
+the size of the forest; a geometry larger than max_elements is not stored. Hits and
+misses are counted so the savings can be reported in the log.
+'''
+
+
+class GeometryCache:
+    def __init__(self, max_size=128, max_elements=2**21):
+        self.max_size = max_size
+        self.max_elements = max_elements
+        self.entries = OrderedDict()
+        self.elements = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        value = compute()
+        size = np.size(value.threshold_u)
+        if self.max_size > 0 and size <= self.max_elements:
+            self.entries[key] = value
+            self.elements += size
+            while len(self.entries) > self.max_size or self.elements > self.max_elements:
+                self.elements -= np.size(self.entries.popitem(last=False)[1].threshold_u)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.elements = 0
+
+
+'''
+The allometric and drag parameters of a tree species. The parameters are tuples and
+cannot be changed after the species is made, so one Species() object is shared by every
+tree (and every TreeArrays() column) of the species. The ruptured species has the
+ruptured drag parameters (the same species if these are not given).
+'''
+
+
+class Species:
+    __slots__ = ('name', 'area_parameters', 'area_h_parameters', 'first_area_parameters',
+                 'first_area_h_parameters', 'diameter_parameters', 'diameter_h_parameters',
+                 'modulus_parameters', 'drag_parameters', 'ruptured')
+
+    def __init__(self, name, area_parameters, area_h_parameters, first_area_parameters, first_area_h_parameters,
+                 diameter_parameters, diameter_h_parameters, modulus_parameters, drag_parameters,
+                 ruptured_drag_parameters=None):
+        parameters = {'name': name,
+                      'area_parameters': tuple(area_parameters),
+                      'area_h_parameters': tuple(area_h_parameters),
+                      'first_area_parameters': tuple(first_area_parameters),
+                      'first_area_h_parameters': tuple(first_area_h_parameters),
+                      'diameter_parameters': tuple(diameter_parameters),
+                      'diameter_h_parameters': tuple(diameter_h_parameters),
+                      'modulus_parameters': tuple(modulus_parameters),
+                      'drag_parameters': tuple(drag_parameters)}
+        for key, value in parameters.items():
+            object.__setattr__(self, key, value)
+        ruptured = self
+        if ruptured_drag_parameters is not None:
+            parameters['drag_parameters'] = ruptured_drag_parameters
+            ruptured = Species(**parameters)
+        object.__setattr__(self, 'ruptured', ruptured)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Species parameters cannot be changed: {}.{}'.format(self.name, key))
+
+    def __reduce__(self):
+        # pickled as its constructor arguments (e.g. for the worker processes of a sweep)
+        ruptured_drag_parameters = None if self.ruptured is self else self.ruptured.drag_parameters
+        return (Species, (self.name, self.area_parameters, self.area_h_parameters, self.first_area_parameters,
+                          self.first_area_h_parameters, self.diameter_parameters, self.diameter_h_parameters,
+                          self.modulus_parameters, self.drag_parameters, ruptured_drag_parameters))
+
+    def __repr__(self):
+        return 'Species: {}'.format(self.name)
+
+
+# species parameter file columns, their Species() parameters and number of values
+species_parameter_columns = {'Area': ('area_parameters', 2),
+                             'Area_h': ('area_h_parameters', 5),
+                             'First_area': ('first_area_parameters', 2),
+                             'First_area_h': ('first_area_h_parameters', 2),
+                             'Diameter': ('diameter_parameters', 2),
+                             'Diameter_h': ('diameter_h_parameters', 2),
+                             'Modulus': ('modulus_parameters', 2),
+                             'Drag': ('drag_parameters', 2),
+                             'Ruptured_drag': ('ruptured_drag_parameters', 2)}
+
+# species of the Tree() template class (no parameters)
+no_species = Species('', (0, 0), (0, 0, 0, 0), (0, 0), (0, 0, 0, 0, 0, 0), (0, 0), (0, 0), (0, 0), (0, 0, 0))
+
+# Casuarina overstorey trees
+cas_over = Species('CasOver',
+                   area_parameters=(0.5982, 1.331),
+                   area_h_parameters=(1.274, 5.0, 0.2104, 1.210, 2.137),
+                   first_area_parameters=(0.2557, 2.3311),
+                   first_area_h_parameters=(0.8881, 0.1119),
+                   diameter_parameters=(0.01, 1.15),
+                   diameter_h_parameters=(-0.246, 1.19),
+                   modulus_parameters=(2.437, 3.667),
+                   drag_parameters=(0.1198, -0.8801),  # Cd0 and Vog exp from CY model
+                   ruptured_drag_parameters=(0.084, -0.587))  # Cd0 and Vog exp from CY model
+
+
 '''
 This class is a template (parent) for the tree types/species it is for an individual 
 tree, which is passed to the Forest() class. Drag and allometric parameters are set in 
@@ -177,17 +817,13 @@ child classes.
 
 
 class Tree:
-    def __init__(self, height, number_of_specimens=1, ground_level=0.0, canopy_width=0, tree_id=''):
-        self.species = ''
+    __slots__ = ('species', 'height', 'flow_depth', 'drag_regime', 'ground_level', 'number_of_specimens',
+                 'water_level', 'canopy_width', 'tree_id')
+    logger = LogFile()
+
+    def __init__(self, height, number_of_specimens=1, ground_level=0.0, canopy_width=0, tree_id='', species=None):
+        self.species = species if species is not None else no_species
         self.height = height
-        self.area_parameters = [0, 0]
-        self.area_h_parameters = [0, 0, 0, 0]
-        self.first_area_parameters = [0, 0]
-        self.first_area_h_parameters = [0, 0, 0, 0, 0, 0]
-        self.diameter_parameters = [0, 0]
-        self.diameter_h_parameters = [0, 0]
-        self.modulus_parameters = [0, 0]
-        self.drag_parameters = [0, 0, 0]
         self.flow_depth = 0.0
         self.drag_regime = ''
         self.ground_level = ground_level
@@ -196,6 +832,42 @@ class Tree:
         self.canopy_width = canopy_width
         self.tree_id = tree_id
 
+    # the allometric and drag parameters are shared by all the trees of a species
+    @property
+    def area_parameters(self):
+        return self.species.area_parameters
+
+    @property
+    def area_h_parameters(self):
+        return self.species.area_h_parameters
+
+    @property
+    def first_area_parameters(self):
+        return self.species.first_area_parameters
+
+    @property
+    def first_area_h_parameters(self):
+        return self.species.first_area_h_parameters
+
+    @property
+    def diameter_parameters(self):
+        return self.species.diameter_parameters
+
+    @property
+    def diameter_h_parameters(self):
+        return self.species.diameter_h_parameters
+
+    @property
+    def modulus_parameters(self):
+        return self.species.modulus_parameters
+
+    @property
+    def drag_parameters(self):
+        return self.species.drag_parameters
+
+    def rupture_tree(self):
+        self.species = self.species.ruptured
+
     def power_func(self, a, b):
         return a * self.height ** b
 
@@ -244,7 +916,7 @@ class Tree:
 
         Z_h = z * self.first_area()
         if 0.001 < self.flow_depth < 0.01:
-            print('Shallow depth... modifying first moment of area')
+            self.logger.debug('Shallow depth... modifying first moment of area')
             Z_h = self.area_h() * self.flow_depth/2
 
         if Z_h > 0.001:
@@ -284,6 +956,7 @@ class Tree:
             return 0.0
 
     def drag_force(self, u):
+        instruments.count('tree_drag_evaluations')
         if self.flow_depth > 0.001:
             Cd, vogel_exp = self.drag_parameters
             reconfiguration_term = u / self.threshold_velocity()
@@ -298,42 +971,17 @@ class Tree:
             return 0.0
 
     def bent_height(self, u):
-        col_headers = np.array(['s', 'Area', 'dA', 'dQ', 'Q', 'Trunk_dia', 'I', 'EI', 'Fd', 'Md', 'R'])
-        slices = 1000
-        s_values = np.linspace(0.0, self.flow_depth, slices)
-        data = np.zeros([s_values.shape[0], col_headers.shape[0]], dtype=float)
-        data[:, 0] = s_values
-        delta_s = s_values.item(1)
-
-        df = pd.DataFrame(data, columns=col_headers)
-        bulk_modulus = self.power_func(*self.modulus_parameters)
-        base_dia = self.base_diameter()
-        modulus = bulk_modulus/(math.pi*(base_dia/2)**4/4)  # check the B units aren't MPa??
-        drag_force = self.drag_force(u)
-        area = self.area_h()
-        q = self.first_area_h()
-
-        # get the area and delta Q
-        df['Area'] = self.area_h(df['s'])
-        df.loc[0, 'dA'] = df.loc[0, 'Area']
-        df.loc[1:, 'dA'] = df.loc[2:, 'Area'] - df.loc[1:-2, 'Area']
-        df['dQ'] = df['dA']*df['s']+delta_s/2
-        df['Q'] = df.loc[::-1, 'dQ'].cumsum()[::-1]
-        df['Trunk_dia'] = self.base_diameter_h(df['s'])
-        df['I'] = math.pi*(df['Trunk_dia']/2)**4/4
-        df['EI'] = df['I'] * modulus
-        df['Fd'] = df['dA'] / area * drag_force
-        df['Md'] = df['Fd'] * q/area
-        df['R'] = df['EI'] / df['Md']
+        # height of the tree top bent by the drag at velocity u (see TreeArrays.species_bending())
+        return float(TreeArrays([self], self.logger).bending(u, self.flow_depth)[0][0])
 
     def output_geometry(self):
         self.logger.log(' ')
-        self.logger.log('Output geometry for {} tree at full height ({} m):'.format(self.species, self.height))
+        self.logger.log('Output geometry for {} tree at full height ({} m):'.format(self.species.name, self.height))
         self.logger.log('Projected area is: {0:.2f} m²'.format(self.area()))
         self.logger.log('First moment of area is: {0:.2f} m³'.format(self.first_area()))
         self.logger.log('Trunk base diameter is: {0:.3f} m'.format(self.base_diameter()))
         self.logger.log(' ')
-        self.logger.log('Output geometry for {} tree at partial height ({} m):'.format(self.species, self.flow_depth))
+        self.logger.log('Output geometry for {} tree at partial height ({} m):'.format(self.species.name, self.flow_depth))
         self.logger.log('Projected area is: {0:.2f} m²'.format(self.area_h()))
         self.logger.log('First moment of area is: {0:.2f} m³'.format(self.first_area_h()))
         self.logger.log('Trunk base diameter is: {0:.3f} m'.format(self.base_diameter_h()))
@@ -349,25 +997,18 @@ class Tree:
 
 
 '''
-This class is a child of the Tree() class and contains the parameters for 
-Casuarina overstorey trees.
+This class is a child of the Tree() class for Casuarina overstorey trees. The
+parameters are in the shared cas_over species.
 '''
 
 
 class CasOver(Tree):
+    __slots__ = ()
+
     def __init__(self, height, number_of_specimens=1, ground_level=0.0, canopy_width=0, tree_id=''):
         Tree.__init__(self, height, number_of_specimens, ground_level, canopy_width, tree_id)
-        self.species = 'CasOver'
-        self.area_parameters = [0.5982, 1.331]
-        # self.area_h_parameters = [1.217, - 4.062, 3.518, 0.3299]
-        self.area_h_parameters = [1.274, 5.0, 0.2104, 1.210, 2.137]
-        self.first_area_parameters = [0.2557, 2.3311]
-        # self.first_area_h_parameters = [-1.892, 1.385, 1.598, -0.1013]
-        self.first_area_h_parameters = [0.8881, 0.1119]
-        self.diameter_parameters = [0.01, 1.15]
-        self.diameter_h_parameters = [-0.246, 1.19]
-        self.modulus_parameters = [2.437, 3.667]
-        self.drag_parameters = [0.1198, -0.8801]  # Cd0 and Vog exp from CY model
+        self.species = cas_over
 
-    def rupture_tree(self):
-        self.drag_parameters = [0.084, -0.587]  # Cd0 and Vog exp from CY model
+
+# tree types of the tree database (Type column) and their species
+species_types = {'Casuarina-overstory': cas_over}
@@ -0,0 +1,64 @@
+"""
+This script contains the height class approximation of the reach averaged forest resistance
+model. The trees of each species are grouped into height classes (weighted by population)
+and the model is solved on the classes, so the cost does not depend on the number of trees.
+The number of classes is given, or chosen (doubling from 2) for a target error in Manning's
+n. The error is measured against the individual trees on a probe grid of the flow depths
+and slopes. The class is used in the Hydraulics.py script.
+"""
+import numpy as np
+from Solver import BatchSolver
+
+'''
+Height class approximation of the forest of a RectChannel(). The probe grid is up to
+probe_depths of the flow depths (or levels), spread over the list, with all slopes; the
+individual trees are solved on it once and each number of classes is compared with them.
+'''
+
+
+class HeightClassApproximation:
+    def __init__(self, channel, probe_depths=20, max_classes=4096):
+        self.channel = channel
+        self.probe_depths = probe_depths
+        self.max_classes = max_classes
+        self.classes = 0
+        self.errors = {}
+        self.probe = None
+        self.reference = None
+
+    def set_probe(self, depths, slopes, levels=None):
+        # solve the probe grid with the individual trees
+        channel = self.channel
+        if channel.is_ruptured:
+            channel.rupture_forest()
+        channel.forest.use_height_classes(0)
+        depths = np.asarray(depths, dtype=float)
+        index = np.unique(np.linspace(0, depths.size - 1, min(self.probe_depths, depths.size)).round().astype(int))
+        self.probe = (depths[index], np.asarray(slopes, dtype=float),
+                      None if levels is None else np.asarray(levels, dtype=float)[index])
+        self.reference = BatchSolver(channel, mode='newton').solve(*self.probe)
+
+    def evaluate(self, classes):
+        # use classes per species and return the maximum relative errors on the probe grid
+        forest = self.channel.forest
+        forest.use_height_classes(classes)
+        self.classes = classes
+        results = BatchSolver(self.channel, mode='newton').solve(*self.probe)
+        self.errors = {key: float(np.max(np.abs(results[key] / self.reference[key] - 1)))
+                       for key in ('Mannings_n', 'Velocity')}
+        return self.errors
+
+    def choose(self, max_error):
+        # the fewest classes (doubling from 2) with a Mannings n error within max_error. Classes
+        # of equal population can still hold several trees, so once there are as many classes as
+        # trees in the largest species group the individual trees are used instead (0 classes)
+        largest = max([stop - start for species, start, stop in self.channel.forest.exact_arrays.groups], default=1)
+        classes = 2
+        while True:
+            errors = self.evaluate(classes)
+            if errors['Mannings_n'] <= max_error or classes >= self.max_classes:
+                return classes
+            if classes >= largest:
+                self.evaluate(0)
+                return 0
+            classes *= 2
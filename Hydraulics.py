@@ -3,6 +3,25 @@ This script runs the reach averaged forest resistance model. The model is run fr
 a batch file, and parameterised through a plain text file (*.ufm).
 """
 from Channel import RectChannel
+from Solver import BatchSolver
+from Solver import ParallelSweep
+from Surface import RoughnessSurface
+from HeightClasses import HeightClassApproximation
+from Hydrograph import HydrographStream
+from MultiCell import CellForest
+from MultiCell import MultiCellSolver
+from ResultCache import CachedSweep
+from ResultCache import ResultCache
+from Ensemble import EnsembleSolver
+from Calibration import Calibration
+from Calibration import CalibrationModel
+from Ensemble import ParameterDistributions
+from Results import ResultStore
+from Results import result_columns as store_columns
+from Results import trace_columns
+from Instrumentation import instruments
+import multiprocessing
+import numpy as np
 import pandas as pd
 from Logger import LogFile
 import os
@@ -21,110 +40,356 @@ def main():
     my_channel = RectChannel()
     my_channel.read_ufm_file(ufm_file)
     my_channel.logger = model_logger
-    if my_channel.use_flow_depths:
+    if my_channel.forest.height_classes > 0 or my_channel.forest.height_class_error > 0:
+        hydraulics_height_classes(my_channel, model_logger)
+    if my_channel.cells_file:
+        hydraulics_cells(my_channel, model_logger)
+    elif my_channel.use_flow_depths:
         hydraulics_depths(my_channel, model_logger)
+    if my_channel.use_flow_levels:
+        hydraulics_levels(my_channel, model_logger)
+    if my_channel.surface_file:
+        hydraulics_surface(my_channel, model_logger)
+    if my_channel.hydrograph_file:
+        hydraulics_hydrograph(my_channel, model_logger)
+    if my_channel.ensemble_file:
+        hydraulics_ensemble(my_channel, model_logger)
+    if my_channel.calibration_file:
+        hydraulics_calibration(my_channel, model_logger)
+    if instruments.enabled:
+        instruments.output_summary(model_logger)
+    model_logger.log_event_end()
+
+
+def hydraulics_height_classes(my_channel, model_logger):
+    # solve on height classes of the trees, with the error against the individual trees
+    forest = my_channel.forest
+    approximation = HeightClassApproximation(my_channel)
+    slopes = sweep_slopes(my_channel)
+    if my_channel.use_flow_depths:
+        approximation.set_probe(my_channel.flow_depths, slopes)
+    else:
+        levels = np.asarray(my_channel.flow_levels, dtype=float)
+        approximation.set_probe(levels - my_channel.bed_level, slopes, levels)
+    if forest.height_classes > 0:
+        approximation.evaluate(forest.height_classes)
+    else:
+        forest.height_classes = approximation.choose(forest.height_class_error)
+    depths, slopes, levels = approximation.probe
+    if forest.height_classes > 0:
+        model_logger.summary('Height classes: {} per species ({} classes for {} trees)'
+                             .format(forest.height_classes, forest.tree_arrays().size, forest.exact_arrays.size))
+    else:
+        model_logger.summary('Height classes: none, the {} individual trees are used'.format(forest.exact_arrays.size))
+    model_logger.summary('Height class error against the individual trees ({} depths x {} slopes): '
+                         'Mannings n {:.3%}    velocity {:.3%}'
+                         .format(depths.size, slopes.size, approximation.errors['Mannings_n'],
+                                 approximation.errors['Velocity']))
+    if 0 < forest.height_class_error < approximation.errors['Mannings_n']:
+        model_logger.warning('!!!WARNING: the height class error is above the target of {:.2%}'
+                             .format(forest.height_class_error))
+    model_logger.log(' ')
 
 
 def hydraulics_depths(my_channel, model_logger):
-    # hydraulic metrics containers
-    df = pd.read_csv(my_channel.hydraulics_df_file, index_col=0)
-    velocities = []
-    uf = []
-    us = []
-    mannings = []
-    q_blocked = []
-    q_unblocked = []
-    slopes = []
-    drag_regime = []
-    conversion_errors = []
-    u0 = []
-    bare_u_values = []
-    cwf = []
-    srf = []
-    af = []
-
-    # solve hydraulics
-    for channel_slope in my_channel.all_slopes:
-        model_logger.log('resolving velocity for slope: 1 m in / {} km'.format(channel_slope))
-        my_channel.set_bed_slope(1/(channel_slope*1000))
-        for flow_depth in my_channel.flow_depths:
-            my_channel.set_water_depth(flow_depth)
-            my_channel.resolve_velocity()
-            velocities.append(my_channel.flow_velocity)
-            bare_u_values.append(my_channel.mannings_u())
-            mannings.append(my_channel.get_mannings_n())
-            slopes.append(my_channel.energy_slope)
-            q_unblocked.append(my_channel.get_q_unblocked())
-            q_blocked.append(my_channel.get_q_blocked())
-            drag_regime.append(my_channel.forest.get_reconfiguration_regime_proportion())
-            conversion_errors.append(my_channel.conversion_error())
-            u0.append(my_channel.forest.get_average_threshold_velocity())
-            uf.append(my_channel.forest_velocity)
-            us.append(my_channel.submergence_velocity)
-            cwf.append(my_channel.cell_width_factor())
-            srf.append(my_channel.storage_reduction_factor())
-            af.append(my_channel.forest.total_frontal_area())
-
-            model_logger.log('h: {0:>4.2f}    U: {1:>6.3f}    recon regime: {2:>3}%    Error: {3:>3} %    {4}'
-                             .format(flow_depth,
-                                     my_channel.flow_velocity,
-                                     my_channel.forest.get_reconfiguration_regime_proportion(),
-                                     my_channel.conversion_error(),
-                                     my_channel.submergence))
-
-        # store results
-        df.Flow_Depth = my_channel.flow_depths
-        df.Velocity = velocities
-        df.Bare_U = bare_u_values
-        df.Mannings_n = mannings
-        df.Slope = slopes
-        df.Q_unblocked = q_unblocked
-        df.Q_blocked = q_blocked
-        df.Regime = drag_regime
-        df.Error = conversion_errors
-        df.U0 = u0
-        df.forest_u = uf
-        df.submergence_u = us
-        df.CWF = cwf
-        df.SRF = srf
-        df.Tot_Af = af
-
-        model_logger.log('writing results for slope: 1 m in / {} m'.format(str(round(1000*channel_slope))))
-
-        if my_channel.result_suffix_decimals > 0:
-            split_slope = modf(1000 * channel_slope)
-            left_slope = int(split_slope[1])
-            right_slope = int(split_slope[0] * 10**my_channel.result_suffix_decimals)
-            result_suffix = '_{}pt{}'.format(left_slope, right_slope)
-        else:
-            result_suffix = '_pt{}'.format(int(1000*channel_slope))
-
-        result_file_name = '{}/results/hydraulics_results{}.csv'.format(my_channel.home_path, result_suffix)
-        model_logger.log('Filename...')
-        model_logger.log(os.path.abspath(result_file_name))
+    # solve hydraulics for all depths and slopes in one call
+    if my_channel.adaptive_tolerance > 0:
+        hydraulics_adaptive(my_channel, model_logger)
+        return
+    solver = sweep_solver(my_channel, model_logger)
+    write_results(my_channel, model_logger,
+                  solved_slopes(my_channel, lambda slopes: solver.solve(my_channel.flow_depths, slopes)),
+                  my_channel.hydraulics_df_file, 'hydraulics_results')
+
+
+def hydraulics_adaptive(my_channel, model_logger):
+    # rating curves over the range of the flow depths, refined where Mannings n changes quickly
+    coarse_count, min_spacing = my_channel.adaptive_resolution
+    depths = np.linspace(min(my_channel.flow_depths), max(my_channel.flow_depths), coarse_count)
+    model_logger.log('adaptive flow depths from a coarse grid of {} depths...'.format(coarse_count))
+    depths, results, passes = adaptive_depths(sweep_solver(my_channel, model_logger), depths,
+                                              np.array(sweep_slopes(my_channel)), my_channel.adaptive_tolerance,
+                                              my_channel.adaptive_regime_tolerance, min_spacing)
+    model_logger.summary('Adaptive flow depths: {} depths after {} refinement passes ({} in the flow depths file)'
+                         .format(depths.size, passes, len(my_channel.flow_depths)))
+    df = pd.DataFrame(index=pd.RangeIndex(1, depths.size + 1, name='ID'))
+    write_results(my_channel, model_logger, [results], df, 'hydraulics_adaptive_results')
+
+
+def adaptive_depths(solver, depths, slopes, n_tolerance, regime_tolerance, min_spacing):
+    # solve the depths, then the midpoint of each depth interval that is not resolved yet. An
+    # interval is resolved when (for every slope) Mannings n at its midpoint is within n_tolerance
+    # (relative) of the linear interpolation, the regime proportion changes by no more than
+    # regime_tolerance (%) and the submergence state does not change; the halves of the other
+    # intervals are refined in the next pass, down to min_spacing. Only the new depths are solved
+    # in each pass; returns the depths, results and number of passes
+    depths = np.asarray(depths, dtype=float)
+    results = solver.solve(depths, slopes)
+    active = np.ones(depths.size - 1, dtype=bool)
+    passes = 0
+    while True:
+        active &= np.diff(depths) >= 2 * min_spacing
+        if not np.any(active):
+            return depths, results, passes
+        passes += 1
+        new_depths = ((depths[1:] + depths[:-1]) / 2)[active]
+        new_results = solver.solve(new_depths, slopes)
+
+        # midpoint interpolation error, and the regime and submergence changes of each half
+        n = results['Mannings_n']
+        n_error = np.abs(new_results['Mannings_n'] - (n[1:] + n[:-1])[active] / 2) / new_results['Mannings_n']
+        refine = np.any(n_error > n_tolerance, axis=1)
+        regime, submerged = results['Regime'], results['Submerged']
+        mid_regime, mid_submerged = new_results['Regime'], new_results['Submerged']
+        lower_half = refine | np.any((np.abs(mid_regime - regime[:-1][active]) > regime_tolerance)
+                                     | (mid_submerged != submerged[:-1][active]), axis=1)
+        upper_half = refine | np.any((np.abs(regime[1:][active] - mid_regime) > regime_tolerance)
+                                     | (submerged[1:][active] != mid_submerged), axis=1)
+
+        # insert the midpoints and their halves
+        counts = 1 + active
+        starts = np.cumsum(counts) - counts
+        split_active = np.zeros(np.sum(counts), dtype=bool)
+        split_active[starts[active]] = lower_half
+        split_active[starts[active] + 1] = upper_half
+        order = np.argsort(np.concatenate([depths, new_depths]), kind='stable')
+        depths = np.concatenate([depths, new_depths])[order]
+        results = {key: np.concatenate([results[key], new_results[key]])[order] for key in results}
+        active = split_active
+
+
+def hydraulics_levels(my_channel, model_logger):
+    # solve hydraulics for all water levels and slopes in one call; each tree is wetted from its
+    # ground level and the flow depth is measured from the channel bed level
+    model_logger.summary('resolving flow levels over a bed level of {} m'.format(my_channel.bed_level))
+    solver = sweep_solver(my_channel, model_logger)
+    write_results(my_channel, model_logger,
+                  solved_slopes(my_channel, lambda slopes: solver.solve_levels(my_channel.flow_levels, slopes)),
+                  my_channel.hydraulics_levels_df_file, 'hydraulics_level_results', levels=True)
+
+
+def sweep_slopes(my_channel):
+    return [1/(channel_slope*1000) for channel_slope in my_channel.all_slopes]
+
+
+def solved_slopes(my_channel, solve):
+    # the results of each group of slopes (one per process) as it is solved, so that each group is
+    # written before the next one is solved
+    slopes = sweep_slopes(my_channel)
+    for start in range(0, len(slopes), max(1, my_channel.processes)):
+        yield solve(slopes[start:start + max(1, my_channel.processes)])
+
+
+def sweep_solver(my_channel, model_logger):
+    if my_channel.processes > 1:
+        model_logger.log('solving on {} processes...'.format(my_channel.processes))
+        solver = ParallelSweep(my_channel, my_channel.processes, my_channel.depth_chunk,
+                               multiprocessing.get_context(my_channel.start_method))
+    else:
+        solver = BatchSolver(my_channel)
+    if my_channel.result_cache:
+        # solved slopes are stored as they complete, so an interrupted run resumes from the cache
+        cache = ResultCache('{}/results/cache'.format(my_channel.home_path), my_channel.result_cache_size)
+        return CachedSweep(my_channel, solver, cache, my_channel.processes)
+    return solver
+
+
+def write_results(my_channel, model_logger, slope_results, df_file, file_name, levels=False):
+    # slope_results gives the results of consecutive groups of slopes; each slope is written (and
+    # appended to the binary results file) as soon as its group is solved, so a run that is
+    # stopped keeps the slopes it completed. df_file is a csv file or a template data frame
+    df = df_file.copy() if isinstance(df_file, pd.DataFrame) else pd.read_csv(df_file, index_col=0)
+    os.makedirs('{}/results'.format(my_channel.home_path), exist_ok=True)
+    first_slope = 0
+    for results in slope_results:
+        if first_slope == 0:
+            result_columns, result_store = results_file(my_channel, results, file_name, levels)
+        for k in range(results['Flow_Depth'].shape[1]):
+            write_slope(my_channel, model_logger, {column: values[:, k] for column, values in results.items()},
+                        my_channel.all_slopes[first_slope + k], df, result_columns, result_store, file_name,
+                        levels)
+        first_slope += results['Flow_Depth'].shape[1]
+
+    my_channel.forest.output_cache_summary()
+
+
+def results_file(my_channel, results, file_name, levels):
+    # the result columns, and the consolidated results file (or None)
+    result_columns = ['Flow_Depth', 'Velocity', 'Bare_U', 'Mannings_n', 'Slope', 'Q_unblocked', 'Q_blocked',
+                      'Regime', 'Error', 'U0', 'forest_u', 'submergence_u', 'CWF', 'SRF', 'Tot_Af']
+    columns = store_columns
+    if levels:
+        result_columns = ['Flow_Level'] + result_columns
+        columns = store_columns[:1] + [('Flow_Level', '<f8')] + store_columns[1:]
+    if 'Canopy_Height' in results:
+        result_columns = result_columns + ['Canopy_Height']
+        columns = columns + [('Canopy_Height', '<f8')]
+    if instruments.enabled:
+        result_columns = result_columns + [name for name, dtype in trace_columns]
+        columns = columns + trace_columns
+    result_store = None
+    if my_channel.results_format in ('binary', 'both'):
+        result_store = ResultStore('{}/results/{}.bin'.format(my_channel.home_path, file_name), columns)
+        result_store.create()
+    return result_columns, result_store
+
+
+def write_slope(my_channel, model_logger, results, channel_slope, df, result_columns, result_store, file_name,
+                levels):
+    # log and write the results (one value per depth) of one slope
+    model_logger.summary('resolving velocity for slope: 1 m in / {} km'.format(channel_slope))
+    for i, flow_depth in enumerate(results['Flow_Depth']):
+        model_logger.log('{0}h: {1:>4.2f}    U: {2:>6.3f}    recon regime: {3:>3}%    Error: {4:>3} %    {5}'
+                         .format('WL: {0:>6.2f}    '.format(results['Flow_Level'][i]) if levels else '',
+                                 flow_depth,
+                                 results['Velocity'][i],
+                                 int(results['Regime'][i]),
+                                 int(results['Error'][i]),
+                                 'submerged' if results['Submerged'][i] else 'emergent'))
+
+    model_logger.summary('writing results for slope: 1 m in / {} m'.format(str(round(1000*channel_slope))))
+
+    # store results
+    with instruments.timer('writing'):
+        if my_channel.results_format in ('csv', 'both'):
+            for column in result_columns:
+                df[column] = results[column]
+            df.Regime = df.Regime.astype(int)
+            df.Error = df.Error.astype(int)
+
+            if my_channel.result_suffix_decimals > 0:
+                split_slope = modf(1000 * channel_slope)
+                left_slope = int(split_slope[1])
+                right_slope = int(split_slope[0] * 10**my_channel.result_suffix_decimals)
+                result_suffix = '_{}pt{}'.format(left_slope, right_slope)
+            else:
+                result_suffix = '_pt{}'.format(int(1000*channel_slope))
+
+            result_file_name = '{}/results/{}{}.csv'.format(my_channel.home_path, file_name, result_suffix)
+            model_logger.summary('Filename...')
+            model_logger.summary(os.path.abspath(result_file_name))
+            df.to_csv(result_file_name)
+
+        if result_store is not None:
+            records = {column: results[column] for column in result_columns}
+            records['Channel_Slope'] = channel_slope
+            result_store.append(records)
+            model_logger.summary('Appended to: {}'.format(os.path.abspath(result_store.file_name)))
+
+    model_logger.summary('Done...')
+    model_logger.summary(' ')
+
+
+def hydraulics_surface(my_channel, model_logger):
+    # dense (depth, slope) table of Mannings n over the range of the flow depths and slopes
+    if not my_channel.use_flow_depths:
+        model_logger.log('Error: !!! the roughness surface needs flow depths (Flow depths file ==) !!!')
+        return
+    depth_count, slope_count = my_channel.surface_resolution
+    depths = np.linspace(min(my_channel.flow_depths), max(my_channel.flow_depths), depth_count)
+    slopes = 1/(np.array(my_channel.all_slopes)*1000)
+    slopes = np.geomspace(min(slopes), max(slopes), slope_count)
+    model_logger.log('building roughness surface: {} depths x {} slopes'.format(depth_count, slope_count))
+    surface = RoughnessSurface.build(my_channel, depths, slopes, sweep_solver(my_channel, model_logger))
+    model_logger.summary('Maximum interpolation error (cell centres): Mannings n {0:.3%}    velocity {1:.3%}'
+                         .format(surface.n_error, surface.velocity_error))
+    surface.save(my_channel.surface_file)
+    model_logger.summary('Roughness surface written to: {}'.format(os.path.abspath(my_channel.surface_file)))
+    model_logger.log(' ')
+
+
+def hydraulics_cells(my_channel, model_logger):
+    # Mannings n of each grid cell (its own trees, plan area and bed n) for the flow depths and slopes
+    cell_forest = CellForest.read(my_channel.tree_db_file, my_channel.cells_file, my_channel.forest.species_types,
+                                  model_logger)
+    model_logger.log('solving {} cells ({} trees)...'.format(cell_forest.cells.size, cell_forest.trees.size))
+    slopes = sweep_slopes(my_channel)
+    results = MultiCellSolver(my_channel, cell_forest).solve(my_channel.flow_depths, slopes)
+
+    os.makedirs('{}/results'.format(my_channel.home_path), exist_ok=True)
+    columns = ['{:g}'.format(depth) for depth in my_channel.flow_depths]
+    for j, channel_slope in enumerate(my_channel.all_slopes):
+        # one row per cell and one column per flow depth
+        df = pd.DataFrame(results['Mannings_n'][:, j, :].T, index=pd.Index(cell_forest.cells, name='Cell'),
+                          columns=columns)
+        result_file_name = '{}/results/cells_mannings_n_pt{}.csv'.format(my_channel.home_path,
+                                                                         int(1000*channel_slope))
         df.to_csv(result_file_name)
+        model_logger.summary('Cell Mannings n written to: {}'.format(os.path.abspath(result_file_name)))
+    result_file_name = '{}/results/cells_results.npz'.format(my_channel.home_path)
+    np.savez_compressed(result_file_name, cells=cell_forest.cells, depths=my_channel.flow_depths, slopes=slopes,
+                        **results)
+    model_logger.summary('Cell results (depth, slope, cell) written to: {}'.format(os.path.abspath(result_file_name)))
+    model_logger.log(' ')
 
 
-        # clear the lists
-        velocities.clear()
-        us.clear()
-        uf.clear()
-        mannings.clear()
-        q_blocked.clear()
-        q_unblocked.clear()
-        slopes.clear()
-        drag_regime.clear()
-        conversion_errors.clear()
-        u0.clear()
-        bare_u_values.clear()
-        cwf.clear()
-        srf.clear()
-        af.clear()
-
-        model_logger.log('Done...')
-        model_logger.log(' ')
+def hydraulics_hydrograph(my_channel, model_logger):
+    # Mannings n and velocity series of a flow depth (or level) series, streamed in chunks
+    stream = HydrographStream(my_channel, sweep_solver(my_channel, model_logger), sweep_slopes(my_channel),
+                              my_channel.hydrograph_resolution, my_channel.hydrograph_chunk,
+                              my_channel.hydrograph_interpolation)
+    os.makedirs('{}/results'.format(my_channel.home_path), exist_ok=True)
+    result_file_name = '{}/results/hydrograph_results.csv'.format(my_channel.home_path)
+    model_logger.log('streaming the hydrograph...')
+    stream.run(my_channel.hydrograph_file, result_file_name,
+               ['pt{}'.format(int(1000*channel_slope)) for channel_slope in my_channel.all_slopes])
+    model_logger.summary('Hydrograph: {} time steps from {} solved values ({} m resolution)'
+                         .format(stream.timesteps, stream.solved, stream.resolution))
+    model_logger.summary('Hydrograph results written to: {}'.format(os.path.abspath(result_file_name)))
+    model_logger.log(' ')
 
-    model_logger.log_event_end()
+
+def hydraulics_ensemble(my_channel, model_logger):
+    # percentiles of Mannings n and velocity over a Monte Carlo ensemble of species parameters
+    ensemble = EnsembleSolver(my_channel, ParameterDistributions.read(my_channel.ensemble_file),
+                              my_channel.ensemble_members, my_channel.ensemble_seed,
+                              my_channel.ensemble_percentiles, my_channel.processes,
+                              mp_context=multiprocessing.get_context(my_channel.start_method))
+    model_logger.log('solving an ensemble of {} members...'.format(ensemble.members))
+    slopes = sweep_slopes(my_channel)
+    summary = ensemble.summary(ensemble.solve(my_channel.flow_depths, slopes))
+    model_logger.summary('Ensemble seed: {} (repeat the run with Ensemble seed == {})'
+                         .format(ensemble.seed, ensemble.seed))
+
+    os.makedirs('{}/results'.format(my_channel.home_path), exist_ok=True)
+    for j, channel_slope in enumerate(my_channel.all_slopes):
+        df = pd.DataFrame({'Flow_Depth': my_channel.flow_depths, 'Slope': slopes[j]},
+                          index=pd.RangeIndex(1, len(my_channel.flow_depths) + 1, name='ID'))
+        for column, values in summary.items():
+            df[column] = values[:, j]
+        result_file_name = '{}/results/hydraulics_ensemble_pt{}.csv'.format(my_channel.home_path,
+                                                                            int(1000*channel_slope))
+        df.to_csv(result_file_name)
+        model_logger.summary('Ensemble percentiles written to: {}'.format(os.path.abspath(result_file_name)))
+    model_logger.log(' ')
+
+
+def hydraulics_calibration(my_channel, model_logger):
+    # fit the drag parameters to the observed Mannings n and velocities
+    observations = pd.read_csv(my_channel.calibration_file)
+    model = CalibrationModel(my_channel, observations)
+    bounds = my_channel.calibration_bounds
+    calibration = Calibration(model, bounds[:2], bounds[2:], my_channel.processes, my_channel.calibration_seed,
+                              mp_context=multiprocessing.get_context(my_channel.start_method))
+    model_logger.log('calibrating the drag parameters to {} observations...'.format(len(observations)))
+    fitted = calibration.run()
+    for name, value in fitted.items():
+        model_logger.summary('Calibrated {0}: {1:.4f}'.format(name, value))
+    model_logger.summary('Mean squared relative error: {0:.3e} after {1} generations'
+                         .format(calibration.result.fun, calibration.result.nit))
+
+    os.makedirs('{}/results'.format(my_channel.home_path), exist_ok=True)
+    mannings_n, velocity = model.forward(calibration.result.x)
+    observations['Model_Mannings_n'] = mannings_n[:, 0]
+    observations['Model_Velocity'] = velocity[:, 0]
+    result_file_name = '{}/results/calibration_observations.csv'.format(my_channel.home_path)
+    observations.to_csv(result_file_name, index=False)
+    model_logger.summary('Calibrated model at the observations written to: {}'
+                         .format(os.path.abspath(result_file_name)))
+    species_file_name = '{}/results/calibrated_species_parameters.csv'.format(my_channel.home_path)
+    calibration.species_table(fitted).to_csv(species_file_name, index=False)
+    model_logger.summary('Calibrated species parameters written to: {}'.format(os.path.abspath(species_file_name)))
+    model_logger.log(' ')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,96 @@
+"""
+This script contains the streaming hydrograph mode of the reach averaged forest resistance
+model. A flow depth (or water level) time series, e.g. from a 1D hydraulic model, is read in
+chunks. The values are quantised to a resolution, each quantised value is solved once for
+all slopes (and kept for later chunks), and the Manning's n and velocity series are appended
+to the output file chunk by chunk, so memory use does not grow with the length of the series.
+The class is used in the Hydraulics.py script.
+"""
+import numpy as np
+import pandas as pd
+from Instrumentation import instruments
+
+'''
+Streamed roughness series for a RectChannel(). The input file (csv) has a *Flow_Depth*
+(or *Flow_Level*) column and any other columns (e.g. time), which are copied to the
+output. The flow depths (levels less the bed level) are quantised and solved with the
+sweep solver (solve() or solve_levels()) and stored in a table sorted by depth, which is
+bounded by the range of the series over the resolution. With interpolate, the results are
+interpolated linearly between the quantised depths either side of each value, instead of
+taken at the nearest one.
+'''
+
+
+class HydrographStream:
+    def __init__(self, channel, solver, slopes, resolution=0.001, chunk_size=100000, interpolate=False):
+        self.channel = channel
+        self.solver = solver
+        self.slopes = np.asarray(slopes, dtype=float)
+        self.resolution = resolution
+        self.chunk_size = chunk_size
+        self.interpolate = interpolate
+        # solved quantised depths (as integers) and their (depth, slope) results
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.table = {'Mannings_n': np.zeros((0, self.slopes.size)), 'Velocity': np.zeros((0, self.slopes.size))}
+        self.timesteps = 0
+        self.solved = 0
+
+    def run(self, input_file, output_file, slope_names):
+        # slope_names are the suffixes of the output columns (one per slope)
+        header = True
+        for chunk in pd.read_csv(input_file, chunksize=self.chunk_size):
+            levels = 'Flow_Level' in chunk and 'Flow_Depth' not in chunk
+            values = chunk['Flow_Level' if levels else 'Flow_Depth'].to_numpy(dtype=float)
+            results = self.lookup(values, levels)
+            for key, key_values in results.items():
+                for j, slope_name in enumerate(slope_names):
+                    chunk['{}_{}'.format(key, slope_name)] = key_values[:, j]
+            chunk.to_csv(output_file, mode='w' if header else 'a', header=header, index=False)
+            header = False
+            self.timesteps += values.size
+            instruments.count('hydrograph_timesteps', values.size)
+
+    def lookup(self, values, levels=False):
+        # Mannings n and velocity (value, slope) of each value; dry or missing values give NaN
+        if levels:
+            self.channel.set_default_bed_level()
+        depths = values - self.channel.bed_level if levels else values
+        valid = np.isfinite(depths) & (depths > 0.001)
+        # the depths are quantised (levels are solved at the bed level plus the quantised depth),
+        # from the first step above 0.001 m so no step is dry
+        scaled = depths[valid] / self.resolution
+        first_key = int(np.floor(0.001 / self.resolution)) + 1
+        if self.interpolate:
+            lower = np.maximum(np.floor(scaled).astype(np.int64), first_key)
+            self.solve_keys(np.concatenate([lower, lower + 1]), levels)
+            weight = np.clip(scaled - lower, 0.0, 1.0)[:, None]
+            lower_index = np.searchsorted(self.keys, lower)
+            results = {key: (1 - weight) * table[lower_index] + weight * table[lower_index + 1]
+                       for key, table in self.table.items()}
+        else:
+            nearest = np.maximum(np.rint(scaled).astype(np.int64), first_key)
+            self.solve_keys(nearest, levels)
+            nearest_index = np.searchsorted(self.keys, nearest)
+            results = {key: table[nearest_index] for key, table in self.table.items()}
+        output = {}
+        for key, key_results in results.items():
+            output[key] = np.full((values.size, self.slopes.size), np.nan)
+            output[key][valid] = key_results
+        return output
+
+    def solve_keys(self, keys, levels):
+        # solve the quantised values that are not in the table yet
+        new_keys = np.setdiff1d(keys, self.keys)
+        if new_keys.size == 0:
+            return
+        depths = new_keys * self.resolution
+        if levels:
+            results = self.solver.solve_levels(depths + self.channel.bed_level, self.slopes)
+        else:
+            results = self.solver.solve(depths, self.slopes)
+        keys = np.concatenate([self.keys, new_keys])
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.table = {key: np.concatenate([table, results[key]])[order] for key, table in self.table.items()}
+        self.solved += new_keys.size
+        instruments.count('hydrograph_solves', new_keys.size)
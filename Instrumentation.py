@@ -0,0 +1,80 @@
+"""
+This script contains the opt-in instrumentation for the reach averaged forest resistance model.
+Counters (residual evaluations, tree kernel calls, Newton iterations, bisection fallbacks) and
+timers (parsing, geometry, solving, writing) are collected by the Forest.py, Channel.py,
+Solver.py and Hydraulics.py scripts through the shared instruments object, and reported
+as a run summary in the log file.
+"""
+from collections import defaultdict
+import time
+
+'''
+Counters and timers. When disabled (the default), count() returns straight away and
+timer() returns a shared context manager that does nothing, so the instrumented code
+runs at (almost) full speed.
+'''
+
+
+class Instruments:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = defaultdict(int)
+        self.timers = defaultdict(float)
+        self.null_timer = NullTimer()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        self.counters.clear()
+        self.timers.clear()
+
+    def count(self, name, number=1):
+        if self.enabled:
+            self.counters[name] += number
+
+    def timer(self, name):
+        if self.enabled:
+            return Timer(self, name)
+        return self.null_timer
+
+    def add_time(self, name, seconds):
+        # time measured by hand (e.g. before the instrumentation flag is read)
+        if self.enabled:
+            self.timers[name] += seconds
+
+    def output_summary(self, logger):
+        logger.summary(' ')
+        logger.summary('Instrumentation summary:')
+        for name in sorted(self.counters):
+            logger.summary('    {0:<28} {1:>14,}'.format(name, self.counters[name]))
+        for name in sorted(self.timers):
+            logger.summary('    {0:<28} {1:>14.3f} s'.format(name + ' time', self.timers[name]))
+        logger.summary(' ')
+
+
+class Timer:
+    def __init__(self, instruments, name):
+        self.instruments = instruments
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.instruments.timers[self.name] += time.perf_counter() - self.start
+        return False
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+# instruments shared by all model objects
+instruments = Instruments()
@@ -4,15 +4,111 @@ forest resistance model (Hydraulics.py). Logged lines are printed to the
 console and a plain text log file.
 """
 from datetime import datetime
+import atexit
 import os
+import queue
+import threading
+
+# Log levels
+DEBUG = 10  # per-iteration and per-depth solver diagnostics
+INFO = 20  # model setup and per-depth results
+SUMMARY = 25  # per-slope and run summaries
+WARNING = 30
+LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'SUMMARY': SUMMARY, 'WARNING': WARNING}
+
+'''
+Buffered writer for one log file. Lines are held in memory and appended to the file
+every flush_lines lines (and when flushed explicitly). With background=True the
+appends are done by a writer thread, so the model never waits on file I/O. All
+LogFile() objects for the same file share one writer, which keeps the lines in order.
+'''
+
+
+class LogWriter:
+    def __init__(self, file_name, flush_lines=100, background=False):
+        self.file_name = file_name
+        self.flush_lines = flush_lines
+        self.buffer = []
+        self.queue = None
+        self.thread = None
+        if background:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def write(self, line):
+        self.buffer.append(line)
+        if len(self.buffer) >= self.flush_lines:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        lines, self.buffer = self.buffer, []
+        if self.queue is not None:
+            self.queue.put(lines)
+        else:
+            self.write_lines(lines)
+
+    def write_lines(self, lines):
+        lf = open(self.file_name, 'a')
+        lf.writelines(lines)
+        lf.close()
+
+    def run(self):
+        while True:
+            lines = self.queue.get()
+            if lines is None:
+                break
+            self.write_lines(lines)
+
+    def close(self):
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.queue = None
+            self.thread = None
+
+
+'''
+The log settings are shared by every LogFile() (class attributes), so a model run can
+be silenced from the ufm file: lines below console_level are not printed and lines
+below file_level are not written to the log file.
+'''
 
 
 class LogFile:
+    console_level = DEBUG
+    file_level = INFO
+    flush_lines = 100
+    background = False
+    writers = {}
+
     def __init__(self):
         self.file_name = ''
         self.event_file = ''
         self.ufm = ''
 
+    @classmethod
+    def configure(cls, console_level=None, file_level=None, flush_lines=None, background=None):
+        if console_level is not None:
+            cls.console_level = LEVELS[console_level.upper()] if isinstance(console_level, str) else console_level
+        if file_level is not None:
+            cls.file_level = LEVELS[file_level.upper()] if isinstance(file_level, str) else file_level
+        if flush_lines is not None or background is not None:
+            cls.close_all()
+            if flush_lines is not None:
+                cls.flush_lines = flush_lines
+            if background is not None:
+                cls.background = background
+
+    @classmethod
+    def close_all(cls):
+        for writer in cls.writers.values():
+            writer.close()
+        cls.writers.clear()
+
     def set_log_file_name(self, ufm):
         # set the filename of the log file
         folder = '{}/log/'.format(os.path.dirname(ufm))
@@ -37,16 +133,44 @@ class LogFile:
                  '\nModel home path is: {}\n'.format(os.path.abspath(os.path.dirname(self.ufm)))]
         for line in lines:
             print(line)
+        self.close()
         lf = open(self.file_name, 'w+')
         lf.writelines(lines)
         lf.close()
 
-    def log(self, log_line):
-        print(log_line)
-        log_line = '{}\n'.format(log_line)
-        lf = open(self.file_name, 'a')
-        lf.write(log_line)
-        lf.close()
+    def writer(self):
+        if self.file_name not in LogFile.writers:
+            LogFile.writers[self.file_name] = LogWriter(self.file_name, LogFile.flush_lines, LogFile.background)
+        return LogFile.writers[self.file_name]
+
+    def log(self, log_line, level=INFO):
+        if level >= LogFile.console_level:
+            print(log_line)
+        if level >= LogFile.file_level and self.file_name:
+            self.writer().write('{}\n'.format(log_line))
+            if level >= WARNING:
+                self.flush()
+
+    def enabled(self, level):
+        # check before building an expensive log line
+        return level >= LogFile.console_level or (level >= LogFile.file_level and self.file_name != '')
+
+    def debug(self, log_line):
+        self.log(log_line, DEBUG)
+
+    def summary(self, log_line):
+        self.log(log_line, SUMMARY)
+
+    def warning(self, log_line):
+        self.log(log_line, WARNING)
+
+    def flush(self):
+        if self.file_name in LogFile.writers:
+            LogFile.writers[self.file_name].flush()
+
+    def close(self):
+        if self.file_name in LogFile.writers:
+            LogFile.writers.pop(self.file_name).close()
 
     def log_event_start(self):
         out_line = 'Started: {}    Model file: {}'.format(datetime.now().replace(microsecond=0),
@@ -57,6 +181,7 @@ class LogFile:
         ef.close()
 
     def log_event_end(self):
+        LogFile.close_all()
         out_line = 'Ended: {}    Model file: {}'.format(datetime.now().replace(microsecond=0)
                                                         , os.path.abspath(self.ufm))
         print('\n{}'.format(out_line))
@@ -65,3 +190,5 @@ class LogFile:
         ef.close()
 
 
+# write any buffered lines when the interpreter exits
+atexit.register(LogFile.close_all)
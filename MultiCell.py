@@ -0,0 +1,239 @@
+"""
+This script contains the multi-cell (raster) mode of the reach averaged forest resistance
+model. Each grid cell of a 2D model has its own trees (the *Cell* column of the tree
+database), plan area and bed Manning's n, and all cells are solved together for the flow
+depths and slopes. The trees are stored flat, sorted by cell, with the offset of each cell's
+segment, so the per-cell forest totals and drag are segment sums (numpy reduceat). The output
+is Manning's n for each (depth, slope, cell), e.g. for depth varying roughness in a 2D model.
+The classes are used in the Hydraulics.py script.
+"""
+import numpy as np
+import pandas as pd
+from Forest import DepthGeometry
+from Forest import TreeArrays
+from Solver import bracketed_newton
+from TreeDatabase import TreeDatabase
+from Instrumentation import instruments
+
+# Global variables
+water_density = 998.0  # kg/m3
+g = 9.81  # m2/s - gravitational acceleration
+kappa = 0.41  # von Karman constant
+
+
+def segment_sum(values, offsets):
+    # sums of the last axis of values over the segments offsets[c]:offsets[c + 1] (0 for empty segments)
+    counts = np.diff(offsets)
+    sums = np.zeros(values.shape[:-1] + (counts.size,))
+    filled = counts > 0
+    if np.any(filled):
+        sums[..., filled] = np.add.reduceat(values, offsets[:-1][filled], axis=-1)
+    return sums
+
+
+def segment_min(values, offsets):
+    # minimum of the last axis of values over each segment (inf for empty segments)
+    counts = np.diff(offsets)
+    minimum = np.full(values.shape[:-1] + (counts.size,), np.inf)
+    filled = counts > 0
+    if np.any(filled):
+        minimum[..., filled] = np.minimum.reduceat(values, offsets[:-1][filled], axis=-1)
+    return minimum
+
+
+'''
+Trees of all cells in one TreeArrays() store (grouped by species for the geometry
+kernels), with the permutation that sorts them by cell and the segment offsets of the
+cells in that order. The cells file (csv) has the columns Cell, Plan_Area (m2) and
+Mannings_n (bed); trees in cells that are not in the file are skipped.
+'''
+
+
+class CellForest:
+    def __init__(self, trees, tree_cells, cells, plan_area, bed_n):
+        self.trees = trees
+        self.cells = np.asarray(cells)
+        self.plan_area = np.asarray(plan_area, dtype=float)
+        self.bed_n = np.asarray(bed_n, dtype=float)
+        # tree_cells is the cell index (into cells) of each tree of the store
+        self.order = np.argsort(tree_cells, kind='stable')
+        self.inverse = np.empty_like(self.order)
+        self.inverse[self.order] = np.arange(self.order.size)
+        self.is_ruptured = False
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(tree_cells, minlength=self.cells.size))])
+        self.tree_cells = tree_cells[self.order]
+        self.population = trees.population[self.order]
+        self.height = trees.height[self.order]
+        self.vogel_exp = trees.drag_parameters[1][self.order]
+
+    @classmethod
+    def read(cls, tree_db_file, cells_file, species_types, logger):
+        cell_table = pd.read_csv(cells_file)
+        cells = cell_table['Cell'].to_numpy(dtype=np.int64)
+        database = TreeDatabase(tree_db_file, list(species_types), cells=True)
+        columns = database.read()
+        if database.skipped > 0:
+            logger.log('Error: !!! tree type not recognised !!! ({} trees skipped)'.format(database.skipped))
+        cell_index = pd.Index(cells).get_indexer(columns['cell'])
+        known = cell_index >= 0
+        if not np.all(known):
+            logger.warning('!!!WARNING: {} trees are in cells that are not in the cells file'
+                           .format(np.count_nonzero(~known)))
+        trees = TreeArrays.from_columns(columns['height'][known], columns['population'][known],
+                                        columns['ground_level'][known], np.zeros(np.count_nonzero(known)),
+                                        columns['species'][known], list(species_types.values()), logger)
+        tree_cells = cell_index[known]
+        if trees.order is not None:
+            tree_cells = tree_cells[trees.order]
+        return cls(trees, tree_cells, cells, cell_table['Plan_Area'], cell_table['Mannings_n'])
+
+    def rupture(self):
+        if self.is_ruptured:
+            return
+        self.is_ruptured = True
+        self.trees.rupture()
+        self.vogel_exp = self.trees.drag_parameters[1][self.order]
+
+    def canopy_height(self, is_ruptured):
+        # population weighted average canopy height of each cell (inf for cells without trees,
+        # which are never submerged)
+        top = self.trees.canopy_width[self.order] / 2 if is_ruptured else self.height
+        population = np.where(top > 0.001, self.population, 0.0)
+        total = segment_sum(population, self.offsets)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(total > 0, segment_sum(population * top, self.offsets) / total, np.inf)
+
+    def geometry(self, flow_depth):
+        # the tree geometry (cell order) and the cell totals for (depth, tree) flow depths in cell order
+        wet, area_h, first_area_h, threshold_u, rigid_drag = [
+            values[..., self.order] for values in self.trees.geometry(flow_depth[..., self.inverse])]
+        totals = segment_sum(DepthGeometry.tree_totals(self.population, flow_depth, area_h, rigid_drag),
+                             self.offsets)
+        return wet, threshold_u, rigid_drag * self.population, totals
+
+
+'''
+Batched solver for a CellForest(), following BatchSolver().solve_canopy() for each cell
+(flow depths, no canopy bending). The channel gives the settings shared by all cells
+(blockage, ruptured trees, the Cu constant). The force balance is solved on the
+(depth, slope, cell) grid; the drag of each element is the sum over its cell's segment of trees.
+Depths are processed in chunks so the (depth, slope, tree) arrays stay within max_elements.
+'''
+
+
+class MultiCellSolver:
+    def __init__(self, channel, cell_forest, tolerance=1.48e-8, max_iterations=100, max_elements=2**22):
+        self.channel = channel
+        self.cell_forest = cell_forest
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.max_elements = max_elements
+
+    def solve(self, depths, slopes):
+        # results as (depth, slope, cell) arrays
+        depths = np.asarray(depths, dtype=float)
+        slopes = np.asarray(slopes, dtype=float)
+        cell_forest = self.cell_forest
+        if self.channel.is_ruptured:
+            cell_forest.rupture()
+        results = {}
+        chunk = max(1, self.max_elements // max(1, slopes.size * cell_forest.trees.size))
+        with instruments.timer('solving'):
+            for start in range(0, depths.size, chunk):
+                for key, values in self.solve_chunk(depths[start:start + chunk], slopes).items():
+                    results.setdefault(key, []).append(values)
+        return {key: np.concatenate(values) for key, values in results.items()}
+
+    def solve_chunk(self, depths, slopes):
+        channel = self.channel
+        cell_forest = self.cell_forest
+        offsets = cell_forest.offsets
+        plan_area = cell_forest.plan_area
+        h = depths[:, None, None]
+        s = slopes[None, :, None]
+
+        # emergence state of each (depth, cell) (the geometry is for the full tree height when submerged)
+        canopy_height = cell_forest.canopy_height(channel.is_ruptured)
+        submergence_depth = depths[:, None] - canopy_height
+        submerged = submergence_depth > 0.001
+        tree_depth = np.where(submerged[:, cell_forest.tree_cells] | (cell_forest.height < depths[:, None]),
+                              cell_forest.height, depths[:, None])
+        wet, threshold_u, rigid_drag, totals = cell_forest.geometry(tree_depth)
+        total_plan_area, volume, total_frontal_area, total_rigid_drag = totals
+
+        # depth-only aggregates of each cell, as (depth, 1, cell) arrays
+        forest_depth = np.where(submerged, canopy_height, depths[:, None])[:, None, :]
+        submergence_depth = np.where(submerged, submergence_depth, 0.0)[:, None, :]
+        if channel.blockage:
+            srf = total_plan_area / plan_area
+            if np.any(srf > 0.9):
+                channel.logger.warning('!!!WARNING: Storage reduction factor is large!')
+            srf = np.where(srf > 0.9, 0.9, srf)[:, None, :]
+        else:
+            srf = np.zeros(forest_depth.shape)
+        cwf = np.sqrt(srf)
+        theta = (1.0 - srf) / (1.0 - cwf) ** (4.0 / 3.0)
+        rigid_forest_n = np.sqrt(forest_depth ** (1.0 / 3.0) * total_rigid_drag[:, None, :]
+                                 / (water_density * g * plan_area * theta))
+        rigid_composite_n = np.sqrt(cell_forest.bed_n ** 2 + rigid_forest_n ** 2)
+        hydraulic_radius = forest_depth * (1.0 - cwf) + submergence_depth
+        shear_radius = forest_depth * (1.0 - srf) + submergence_depth
+        bed_coefficient = water_density * g * cell_forest.bed_n ** 2.0 * theta / forest_depth ** (1.0 / 3.0)
+        total_shear = water_density * g * shear_radius * s
+
+        # rigid velocity, then solve the force balance where the trees reconfigure
+        rigid_u = 1 / rigid_composite_n * (forest_depth * (1 - cwf)) ** (2.0 / 3.0) * np.sqrt(s)
+        is_rigid = rigid_u <= 0.001 * segment_min(threshold_u, offsets)[:, None, :]
+        forest_u = np.broadcast_to(rigid_u, total_shear.shape).copy()
+        bed = np.broadcast_to(bed_coefficient, forest_u.shape)
+
+        def residual(u_i, index):
+            drag, drag_du = self.drag(u_i, index, rigid_drag, threshold_u)
+            return (bed[index] * u_i ** 2.0 + drag / plan_area[index[2]] - total_shear[index],
+                    2.0 * bed[index] * u_i + drag_du / plan_area[index[2]])
+
+        converged, iterations, bisections = bracketed_newton(residual, forest_u, forest_u.copy(),
+                                                             np.sqrt(total_shear / bed), ~is_rigid,
+                                                             self.tolerance, self.max_iterations)
+        if not np.all(converged):
+            channel.logger.warning('!!!WARNING: multi-cell velocity solve did not converge for {} of {} cases'
+                                   .format(np.count_nonzero(~converged), converged.size))
+        instruments.count('solves', forest_u.size)
+        instruments.count('newton_iterations', int(np.sum(iterations)))
+
+        # metrics at the solved velocity
+        with np.errstate(divide='ignore', invalid='ignore'):
+            us = h / submergence_depth * np.log(h / forest_depth) - 1
+        shear_u = np.sqrt(g * submergence_depth * s)
+        submergence_u = np.where(submergence_depth > 0, channel.forest.Cu * shear_u / kappa * us + forest_u, 0.0)
+        velocity = np.where(submergence_depth > 0,
+                            (forest_depth * (1 - cwf) * forest_u + submergence_depth * submergence_u) / h,
+                            forest_u)
+        grid = np.ones_like(velocity)
+        return {'Mannings_n': hydraulic_radius ** (2 / 3) * np.sqrt(s) / velocity,
+                'Velocity': velocity,
+                'forest_u': forest_u,
+                'SRF': srf * grid,
+                'Tot_Af': total_frontal_area[:, None, :] * grid,
+                'Submerged': (submergence_depth > 0) & (grid > 0),
+                'Iterations': iterations}
+
+    def drag(self, u, index, rigid_drag, threshold_u):
+        # drag and its derivative (du) for the velocities u of the (depth, slope, cell) elements
+        # index; only the trees of these cells are evaluated, laid out in one segment per element
+        offsets = self.cell_forest.offsets
+        depth_index, slope_index, cell_index = index
+        counts = offsets[cell_index + 1] - offsets[cell_index]
+        element_offsets = np.concatenate([[0], np.cumsum(counts)])
+        trees = np.arange(element_offsets[-1]) - np.repeat(element_offsets[:-1] - offsets[cell_index], counts)
+        depths = np.repeat(depth_index, counts)
+        instruments.count('tree_drag_evaluations', trees.size)
+        tree_u = np.repeat(u, counts)
+        ratio = tree_u / threshold_u[depths, trees]
+        reconfiguration = ratio >= 1
+        vogel_exp = self.cell_forest.vogel_exp[trees]
+        force = rigid_drag[depths, trees] * tree_u ** 2.0 * np.where(reconfiguration, ratio, 1.0) ** vogel_exp
+        exponent = np.where(reconfiguration, 2.0 + vogel_exp, 2.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            derivative = segment_sum(exponent * force, element_offsets) / u
+        return segment_sum(force, element_offsets), derivative
@@ -0,0 +1,148 @@
+"""
+This script contains an on-disk result cache for the reach averaged forest resistance model.
+The results of each slope (for a set of flow depths or levels) are stored in a file named by
+a hash of everything they depend on: the channel and forest settings parsed from the ufm
+file, the tree arrays, the species parameters and the model code. A rerun reuses the slopes
+that are unchanged, and a run that was stopped picks up from the last completed slope. The
+classes are used in the Hydraulics.py script.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+from Instrumentation import instruments
+
+# model code the results depend on (a change invalidates the cache)
+code_files = ['Forest.py', 'Channel.py', 'Solver.py']
+
+
+def model_fingerprint(channel):
+    # sha256 of the solve settings, trees, species parameters and model code of a channel
+    forest = channel.forest
+    trees = forest.tree_arrays()
+    settings = {'width': channel.width, 'length': channel.length, 'n': channel.n, 'sidewalls': channel.sidewalls,
+                'blockage': channel.blockage, 'is_ruptured': channel.is_ruptured,
+                'solver_mode': channel.solver_mode, 'bed_level': channel.bed_level, 'Cu': forest.Cu,
+                'canopy_bending': forest.canopy_bending, 'bending_slices': forest.bending_slices,
+                'canopy_tolerance': forest.canopy_tolerance, 'canopy_iterations': forest.canopy_iterations,
+                'species': [[getattr(species, name) for name in species.__slots__ if name != 'ruptured'] + [start, stop]
+                            for species, start, stop in trees.groups]}
+    digest = hashlib.sha256(json.dumps(settings, default=float).encode())
+    for values in (trees.height, trees.population, trees.ground_level, trees.canopy_width, trees.species):
+        digest.update(np.ascontiguousarray(values).tobytes())
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for file_name in code_files:
+        with open(os.path.join(folder, file_name), 'rb') as cf:
+            digest.update(cf.read())
+    return digest.hexdigest()
+
+
+'''
+Folder of result files (*.npz), one per key. A file is written to a temporary name and
+renamed when complete, so a run that is killed never leaves a partial entry. Reading an
+entry marks it as recently used; when the folder is larger than max_size (MB), the least
+recently used entries are removed.
+'''
+
+
+class ResultCache:
+    def __init__(self, folder, max_size=1024.0):
+        self.folder = folder
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def file_name(self, key):
+        return os.path.join(self.folder, '{}.npz'.format(key))
+
+    def get(self, key):
+        # the stored results (dict of arrays), or None
+        file_name = self.file_name(key)
+        if not os.path.exists(file_name):
+            self.misses += 1
+            return None
+        try:
+            with np.load(file_name) as data:
+                results = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(file_name)
+        self.hits += 1
+        return results
+
+    def put(self, key, results):
+        os.makedirs(self.folder, exist_ok=True)
+        temporary_name = self.file_name(key) + '.tmp'
+        with open(temporary_name, 'wb') as rf:
+            np.savez(rf, **results)
+        os.replace(temporary_name, self.file_name(key))
+        self.evict()
+
+    def evict(self):
+        # remove the least recently used entries until the folder is within max_size
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(entry[1] for entry in entries)
+        for modified, entry_size, path in sorted(entries):
+            if size <= self.max_size * 2**20:
+                break
+            os.remove(path)
+            size -= entry_size
+
+
+'''
+Cached sweep around a BatchSolver() or ParallelSweep(), with the same solve() methods.
+Each slope is looked up in the cache with a key made of the model fingerprint, the slope
+and the flow depths (and levels); the missing slopes are solved in groups of
+slopes_per_task and stored as soon as each group completes.
+'''
+
+
+class CachedSweep:
+    def __init__(self, channel, solver, cache, slopes_per_task=1):
+        self.channel = channel
+        self.solver = solver
+        self.cache = cache
+        self.slopes_per_task = max(1, slopes_per_task)
+        self.fingerprint = None
+
+    def key(self, slope, depths, levels):
+        digest = hashlib.sha256(self.fingerprint.encode())
+        digest.update(np.float64(slope).tobytes())
+        digest.update(np.ascontiguousarray(depths, dtype=float).tobytes())
+        if levels is not None:
+            digest.update(b'levels')
+            digest.update(np.ascontiguousarray(levels, dtype=float).tobytes())
+        return digest.hexdigest()
+
+    def solve(self, depths, slopes, levels=None):
+        depths = np.asarray(depths, dtype=float)
+        slopes = np.asarray(slopes, dtype=float)
+        if self.channel.is_ruptured:
+            self.channel.rupture_forest()
+        if self.fingerprint is None:
+            self.fingerprint = model_fingerprint(self.channel)
+
+        columns = [None] * slopes.size
+        keys = [self.key(slope, depths, levels) for slope in slopes]
+        for j, key in enumerate(keys):
+            columns[j] = self.cache.get(key)
+        missing = [j for j in range(slopes.size) if columns[j] is None]
+        instruments.count('result_cache_hits', slopes.size - len(missing))
+        instruments.count('result_cache_misses', len(missing))
+        for start in range(0, len(missing), self.slopes_per_task):
+            task = missing[start:start + self.slopes_per_task]
+            results = self.solver.solve(depths, slopes[task], levels)
+            for k, j in enumerate(task):
+                columns[j] = {name: values[:, k] for name, values in results.items()}
+                self.cache.put(keys[j], columns[j])
+        self.channel.logger.log('result cache: {} of {} slopes reused'.format(slopes.size - len(missing), slopes.size))
+        return {name: np.stack([column[name] for column in columns], axis=1) for name in columns[0]}
+
+    def solve_levels(self, levels, slopes):
+        levels = np.asarray(levels, dtype=float)
+        return self.solve(levels - self.channel.bed_level, slopes, levels)
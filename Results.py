@@ -0,0 +1,86 @@
+"""
+This script contains a consolidated results store for the reach averaged forest resistance
+model. Every (slope, depth) record of a model run is appended to one typed, columnar binary
+file instead of a csv file per slope, and the whole run is loaded back into numpy arrays
+without any parsing. The class is used in the Hydraulics.py script.
+"""
+import json
+import os
+import numpy as np
+
+# result columns and their types
+result_columns = [('Channel_Slope', '<f8'), ('Flow_Depth', '<f8'), ('Velocity', '<f8'), ('Bare_U', '<f8'),
+                  ('Mannings_n', '<f8'), ('Slope', '<f8'), ('Q_unblocked', '<f8'), ('Q_blocked', '<f8'),
+                  ('Regime', '<i4'), ('Error', '<i4'), ('U0', '<f8'), ('forest_u', '<f8'),
+                  ('submergence_u', '<f8'), ('CWF', '<f8'), ('SRF', '<f8'), ('Tot_Af', '<f8')]
+# per-solve trace columns, stored when the instrumentation is on
+trace_columns = [('Iterations', '<i4'), ('Bisections', '<i4'), ('Drag_evaluations', '<i4')]
+magic = b'TREEHYD1'
+
+'''
+Append-only chunked binary table. The file starts with a magic string and a json header
+listing the columns and their types. Each appended chunk is a row count (int64)
+followed by the values of each column stored contiguously. A chunk is written (and
+flushed) in one go, e.g. for each slope when it completes, and a partly written chunk at
+the end of the file (e.g. from a run that was killed) is ignored when the file is read.
+'''
+
+
+class ResultStore:
+    def __init__(self, file_name, columns=None):
+        self.file_name = file_name
+        self.columns = columns if columns is not None else result_columns
+        self.dtypes = [(name, np.dtype(dtype)) for name, dtype in self.columns]
+
+    def create(self):
+        # start a new file (the folder is created if needed)
+        folder = os.path.dirname(self.file_name)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        header = json.dumps({'columns': self.columns}).encode()
+        rf = open(self.file_name, 'wb')
+        rf.write(magic)
+        rf.write(np.int64(len(header)).tobytes())
+        rf.write(header)
+        rf.close()
+
+    def append(self, records):
+        # records is a dict of equal length arrays (or single values), one per column
+        rows = max(np.size(records[name]) for name, dtype in self.dtypes)
+        chunk = [np.int64(rows).tobytes()]
+        for name, dtype in self.dtypes:
+            chunk.append(np.ascontiguousarray(np.broadcast_to(records[name], (rows,)), dtype=dtype).tobytes())
+        rf = open(self.file_name, 'ab')
+        rf.write(b''.join(chunk))
+        rf.flush()
+        rf.close()
+
+    def read_header(self, data):
+        if bytes(data[:len(magic)]) != magic:
+            raise ValueError('Not a results file: {}'.format(self.file_name))
+        start = len(magic) + 8
+        header_length = int(np.frombuffer(data, np.int64, 1, len(magic))[0])
+        self.columns = [tuple(column) for column in json.loads(bytes(data[start:start + header_length]))['columns']]
+        self.dtypes = [(name, np.dtype(dtype)) for name, dtype in self.columns]
+        return start + header_length
+
+    def chunks(self):
+        # each complete chunk as a dict of column arrays (views on a memory map of the file)
+        data = np.memmap(self.file_name, dtype=np.uint8, mode='r')
+        position = self.read_header(data)
+        row_bytes = sum(dtype.itemsize for name, dtype in self.dtypes)
+        while position + 8 <= data.size:
+            rows = int(np.frombuffer(data, np.int64, 1, position)[0])
+            if position + 8 + rows * row_bytes > data.size:
+                break
+            position += 8
+            chunk = {}
+            for name, dtype in self.dtypes:
+                chunk[name] = np.frombuffer(data, dtype, rows, position)
+                position += rows * dtype.itemsize
+            yield chunk
+
+    def load(self):
+        chunks = list(self.chunks())
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) if chunks else np.zeros(0, dtype)
+                for name, dtype in self.dtypes}
@@ -0,0 +1,497 @@
+"""
+This script contains a batched solver for the reach averaged forest resistance model.
+All flow depths and slopes are resolved together using numpy arrays, instead of calling
+RectChannel.resolve_velocity() for each depth and slope pair. The class is used in the
+Hydraulics.py script.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import math
+import numpy as np
+from Instrumentation import instruments
+
+# Global variables
+water_density = 998.0  # kg/m3
+g = 9.81  # m2/s - gravitational acceleration
+kappa = 0.41  # von Karman constant
+
+
+def bracketed_newton(function, u, lower, upper, active, tolerance, max_iterations):
+    # vectorised Newton solve of an increasing function, kept inside [lower, upper] with
+    # bisection; function(u, index) returns the residual and derivative for u[index].
+    # u is solved in place for the active elements; returns the convergence flags and the
+    # number of iterations and bisection steps of each element
+    converged = ~active
+    iterations = np.zeros(u.shape, dtype=int)
+    bisections = np.zeros(u.shape, dtype=int)
+    for _ in range(max_iterations):
+        index = np.nonzero(~converged)
+        if index[0].size == 0:
+            break
+        u_i = u[index]
+        residual, derivative = function(u_i, index)
+        lower[index] = np.where(residual < 0, u_i, lower[index])
+        upper[index] = np.where(residual > 0, u_i, upper[index])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = u_i - residual / derivative
+        outside = ~((step > lower[index]) & (step < upper[index]))
+        step = np.where(outside, (lower[index] + upper[index]) / 2, step)
+        iterations[index] += 1
+        bisections[index] += outside
+        converged[index] = (np.abs(step - u_i) <= tolerance) | (residual == 0)
+        u[index] = np.where(residual == 0, u_i, step)
+    return converged, iterations, bisections
+
+
+'''
+Scalar velocity solver used by RectChannel.resolve_velocity(). The residual function
+returns the residual and its analytic derivative. Newton steps are kept inside a
+bracket [lower, upper] that is narrowed with every evaluation. A step that leaves the
+bracket is replaced by bisection. The first guess (e.g. the solution at the previous
+depth or slope) is used when it falls inside the bracket. Iteration, evaluation and
+bisection counts are kept, and a RuntimeError is raised if the solve does not converge.
+'''
+
+
+class VelocitySolver:
+    def __init__(self, tolerance=1.48e-8, max_iterations=100):
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.iterations = 0
+        self.solves = 0
+        self.total_iterations = 0
+        self.evaluations = 0
+        self.bisections = 0
+
+    def solve(self, function, lower, upper, guess=None):
+        self.solves += 1
+        self.iterations = 0
+
+        # without a finite upper bound, expand one until it brackets the root
+        if not math.isfinite(upper):
+            upper = max(2 * lower, 1.0)
+            while self.evaluate(function, upper)[0] < 0:
+                lower = upper
+                upper = 2 * upper
+
+        u = guess if guess is not None and lower < guess < upper else lower
+        for self.iterations in range(1, self.max_iterations + 1):
+            residual, derivative = self.evaluate(function, u)
+            if residual == 0:
+                break
+            if residual < 0:
+                lower = u
+            else:
+                upper = u
+            step = u - residual / derivative if derivative > 0 else lower
+            if not lower < step < upper:
+                step = (lower + upper) / 2
+                self.bisections += 1
+            if abs(step - u) <= self.tolerance:
+                u = step
+                break
+            u = step
+        else:
+            self.total_iterations += self.iterations
+            raise RuntimeError('Velocity failed to converge after {} iterations, value is {}'
+                               .format(self.iterations, u))
+        self.total_iterations += self.iterations
+        return u
+
+    def evaluate(self, function, u):
+        self.evaluations += 1
+        return function(u)
+
+
+'''
+Exact root finder for a forest with its trees sorted by threshold velocity (a
+SortedDrag() object). The residual is monotonic, so the segment between two
+consecutive threshold velocities that holds the root is found by binary search on the
+breakpoints. Within the segment every tree stays in one drag regime and the residual is
+smooth, so a bracketed Newton solve converges in a few steps. Each residual evaluation
+costs O(log N) rather than a pass over the forest. Solves a vector of total shear
+stresses (e.g. one per slope) at once.
+'''
+
+
+class PiecewiseSolver:
+    def __init__(self, tolerance=1.48e-8, max_iterations=100):
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.evaluations = 0
+        # per-element Newton iterations, bisections and drag evaluations of the last solve
+        self.iterations = None
+        self.bisections = None
+        self.drag_evaluations = None
+
+    def solve(self, sorted_drag, bed_coefficient, total_shear, plan_area, lower, upper):
+        total_shear = np.atleast_1d(np.asarray(total_shear, dtype=float))
+        lower = np.broadcast_to(lower, total_shear.shape).astype(float)
+        upper = np.broadcast_to(upper, total_shear.shape).astype(float)
+
+        bed = np.broadcast_to(bed_coefficient, total_shear.shape)
+
+        def residual(u, index=slice(None)):
+            self.evaluations += 1
+            drag, drag_du = sorted_drag.drag_and_derivative(u)
+            return (bed[index] * u ** 2.0 + drag / plan_area - total_shear[index],
+                    2.0 * bed[index] * u + drag_du / plan_area)
+
+        # binary search for the number of breakpoints below the root
+        breakpoints = sorted_drag.breakpoints
+        low = np.zeros(total_shear.shape, dtype=int)
+        high = np.full(total_shear.shape, breakpoints.size)
+        search_steps = np.zeros(total_shear.shape, dtype=int)
+        while np.any(low < high):
+            searching = low < high
+            search_steps += searching
+            middle = (low + high) // 2
+            below = residual(breakpoints[np.minimum(middle, breakpoints.size - 1)])[0] < 0
+            low = np.where(searching & below, middle + 1, low)
+            high = np.where(searching & ~below, middle, high)
+
+        # solve within the segment [breakpoint below, breakpoint above]
+        if breakpoints.size > 0:
+            lower = np.maximum(lower, np.where(low > 0, breakpoints[np.maximum(low - 1, 0)], lower))
+            upper = np.minimum(upper, np.where(low < breakpoints.size,
+                                               breakpoints[np.minimum(low, breakpoints.size - 1)], upper))
+        u = lower.copy()
+        converged, self.iterations, self.bisections = bracketed_newton(
+            residual, u, lower, upper, np.ones(u.shape, dtype=bool), self.tolerance, self.max_iterations)
+        self.drag_evaluations = search_steps + self.iterations
+        return u, converged
+
+
+'''
+Batched solver for a RectChannel(). The forest geometry is computed once per flow depth
+(it does not depend on the slope), then the bed shear + drag shear = total shear balance
+is iterated on the whole (depth, slope) grid with a safeguarded Newton method. Each
+element of the grid has its own bracket and convergence flag; if any element does not
+converge a RuntimeError is raised, as in the serial solve. The grid is processed in
+chunks of depths so the (depth, slope, tree) drag arrays stay within max_elements.
+'''
+
+
+class BatchSolver:
+    def __init__(self, channel, tolerance=1.48e-8, max_iterations=100, max_elements=2**22, mode=None):
+        self.channel = channel
+        self.mode = mode if mode is not None else channel.solver_mode
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.max_elements = max_elements
+
+    def solve(self, depths, slopes, levels=None):
+        # with levels, each tree is wetted from its ground level and depths are the flow depths
+        # above the channel bed level
+        depths = np.asarray(depths, dtype=float)
+        slopes = np.asarray(slopes, dtype=float)
+        channel = self.channel
+        if channel.is_ruptured:
+            channel.rupture_forest()
+        trees = channel.forest.tree_arrays()
+
+        results = {}
+        chunk = max(1, self.max_elements // max(1, slopes.size * trees.size))
+        with instruments.timer('solving'):
+            for start in range(0, depths.size, chunk):
+                chunk_results = self.solve_chunk(depths[start:start + chunk], slopes,
+                                                 None if levels is None else levels[start:start + chunk])
+                for key, values in chunk_results.items():
+                    results.setdefault(key, []).append(values)
+        return {key: np.concatenate(values) for key, values in results.items()}
+
+    def solve_levels(self, levels, slopes):
+        levels = np.asarray(levels, dtype=float)
+        return self.solve(levels - self.channel.bed_level, slopes, levels)
+
+    def solve_chunk(self, depths, slopes, levels=None):
+        channel = self.channel
+        forest = channel.forest
+        if levels is None:
+            canopy_height = forest.canopy_height(channel.is_ruptured)
+        else:
+            canopy_height = forest.canopy_level(channel.is_ruptured) - channel.bed_level
+        if levels is not None or channel.is_ruptured or not forest.canopy_bending:
+            return self.solve_canopy(depths, slopes, levels, canopy_height)
+
+        # the bent canopy height of each (depth, slope) is iterated with its forest velocity
+        canopy_height = np.full((depths.size, slopes.size), canopy_height)
+        for iteration in range(forest.canopy_iterations):
+            results = self.solve_canopy(depths, slopes, levels, canopy_height)
+            bent_height = forest.canopy_height(channel.is_ruptured, results['forest_u'], depths[:, None])
+            converged = np.abs(bent_height - canopy_height) < forest.canopy_tolerance
+            canopy_height = bent_height
+            if np.all(converged):
+                break
+        else:
+            channel.logger.warning('!!!WARNING: bent canopy height did not converge for {} of {} cases'
+                                   .format(np.count_nonzero(~converged), converged.size))
+        results['Canopy_Height'] = canopy_height
+        return results
+
+    def solve_canopy(self, depths, slopes, levels, canopy_height, geometries=None):
+        # canopy_height is one value, or one per (depth, slope) for a bent canopy; the geometry of
+        # each depth can be given (e.g. for ensemble members)
+        channel = self.channel
+        forest = channel.forest
+        trees = forest.tree_arrays()
+        h = depths[:, None]
+        s = slopes[None, :]
+
+        # set emergence state (the geometry is for the full tree height when submerged); the
+        # depth aggregates are columns, or (depth, slope) arrays for a bent canopy
+        submergence_depth = h - canopy_height
+        submerged = submergence_depth > 0.001
+        forest_depth = np.where(submerged, canopy_height, h)
+        if geometries is not None:
+            geometry_index = np.arange(depths.size)[:, None]
+        elif levels is not None:
+            geometries = [forest.level_geometry(level) for level in levels]
+            geometry_index = np.arange(depths.size)[:, None]
+        elif np.ndim(canopy_height) == 0:
+            geometries = [forest.depth_geometry(999.0 if is_submerged else depth)
+                          for depth, is_submerged in zip(depths, submerged[:, 0])]
+            geometry_index = np.arange(depths.size)[:, None]
+        else:
+            # emergent geometry of each depth, and the full height geometry (last)
+            geometries = [forest.depth_geometry(depth) for depth in depths] + [forest.depth_geometry(999.0)]
+            geometry_index = np.where(submerged, depths.size, np.arange(depths.size)[:, None])
+        wet = np.stack([geometry.wet for geometry in geometries])
+        threshold_u = np.stack([geometry.threshold_u for geometry in geometries])
+        rigid_drag = np.stack([geometry.rigid_drag for geometry in geometries]) * trees.population
+        vogel_exp = trees.drag_parameters[1]
+        if any(geometry.vogel_exp is not None for geometry in geometries):
+            vogel_exp = np.stack([vogel_exp if geometry.vogel_exp is None else geometry.vogel_exp
+                                  for geometry in geometries])
+
+        # depth-only aggregates
+        if channel.blockage:
+            srf = np.array([geometry.total_plan_area for geometry in geometries])[geometry_index] / channel.plan_area
+            if np.any(srf > 0.9):
+                channel.logger.warning('!!!WARNING: Storage reduction factor is large!')
+            srf = np.where(srf > 0.9, 0.9, srf)
+            cwf = np.sqrt(srf)
+        else:
+            srf = np.zeros(geometry_index.shape)
+            cwf = np.zeros(geometry_index.shape)
+        theta = (1.0 - srf) / (1.0 - cwf) ** (4.0 / 3.0)
+        total_rigid_drag = np.array([geometry.total_rigid_drag for geometry in geometries])[geometry_index]
+        rigid_forest_n = np.sqrt(forest_depth ** (1.0 / 3.0) * total_rigid_drag
+                                 / (water_density * g * channel.plan_area * theta))
+        rigid_composite_n = np.sqrt(channel.n ** 2 + rigid_forest_n ** 2)
+        hydraulic_radius = forest_depth * (1.0 - cwf) + np.where(submerged, submergence_depth, 0.0)
+        shear_radius = forest_depth * (1.0 - srf) + np.where(submerged, submergence_depth, 0.0)
+        bed_coefficient = water_density * g * channel.n ** 2.0 * theta / forest_depth ** (1.0 / 3.0)
+        total_shear = water_density * g * shear_radius * s
+
+        # rigid velocity, then solve the force balance where the trees reconfigure
+        rigid_u = 1 / rigid_composite_n * (forest_depth * (1 - cwf)) ** (2.0 / 3.0) * np.sqrt(s)
+        geometry_index = np.broadcast_to(geometry_index, total_shear.shape)
+        is_rigid = rigid_u <= 0.001 * np.min(threshold_u, axis=1)[geometry_index]
+        forest_u = np.broadcast_to(rigid_u, total_shear.shape).copy()
+        if self.mode == 'piecewise':
+            iterations, bisections, evaluations = self.piecewise(forest_u, ~is_rigid, bed_coefficient,
+                                                                 total_shear, geometries, geometry_index)
+        else:
+            iterations, bisections, evaluations = self.newton(forest_u, ~is_rigid, bed_coefficient, total_shear,
+                                                              rigid_drag, threshold_u, vogel_exp, geometry_index)
+        instruments.count('solves', forest_u.size)
+        instruments.count('newton_iterations', int(np.sum(iterations)))
+        instruments.count('bisections', int(np.sum(bisections)))
+        instruments.count('drag_evaluations', int(np.sum(evaluations)) + forest_u.size)
+
+        # metrics at the solved velocity
+        if self.mode == 'piecewise':
+            drag = np.empty(forest_u.shape)
+            reconfiguration = np.empty(forest_u.shape)
+            for index in np.unique(geometry_index):
+                select = geometry_index == index
+                sorted_drag = forest.sorted_drag(geometries[index])
+                drag[select] = sorted_drag.drag_and_derivative(forest_u[select])[0]
+                reconfiguration[select] = sorted_drag.reconfiguration_count(forest_u[select])
+        else:
+            depth_index = geometry_index.ravel()
+            drag = self.drag(forest_u.ravel(), depth_index, rigid_drag, threshold_u,
+                             vogel_exp)[0].reshape(forest_u.shape)
+            reconfiguration = np.count_nonzero(
+                wet[depth_index] & (forest_u.ravel()[:, None] >= threshold_u[depth_index]), axis=1
+            ).reshape(forest_u.shape)
+        drag_shear = drag / channel.plan_area
+        regime = np.rint(reconfiguration / trees.size * 100)
+        error = np.rint((bed_coefficient * forest_u ** 2.0 + drag_shear - total_shear) / total_shear * 100)
+
+        shear_u = np.sqrt(g * np.where(submerged, submergence_depth, 0.0) * s)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            us = h / submergence_depth * np.log(h / forest_depth) - 1
+        submergence_u = np.where(submerged, forest.Cu * shear_u / kappa * us + forest_u, 0.0)
+        velocity = np.where(submerged,
+                            (forest_depth * (1 - cwf) * forest_u + submergence_depth * submergence_u) / h,
+                            forest_u)
+
+        volume = np.array([geometry.volume for geometry in geometries])[geometry_index]
+        effective_flow_area = (channel.plan_area * h - volume) / channel.length
+        grid = np.ones_like(velocity)
+        results = {
+            'Flow_Depth': h * grid,
+            'Velocity': velocity,
+            'Bare_U': 1 / channel.n * h ** (2.0 / 3.0) * np.sqrt(s) * grid,
+            'Mannings_n': hydraulic_radius ** (2 / 3) * np.sqrt(s) / velocity,
+            'Slope': s * grid,
+            'Q_unblocked': h * velocity,
+            'Q_blocked': effective_flow_area * velocity / channel.width,
+            'Regime': regime,
+            'Error': error,
+            'U0': self.average_threshold_velocity(h, submerged) * grid,
+            'forest_u': forest_u,
+            'submergence_u': submergence_u,
+            'CWF': cwf * grid,
+            'SRF': srf * grid,
+            'Tot_Af': np.array([geometry.total_frontal_area for geometry in geometries])[geometry_index] * grid,
+            'Submerged': submerged & (grid > 0),
+            'Iterations': iterations,
+            'Bisections': bisections,
+            'Drag_evaluations': evaluations + 1,
+        }
+        if levels is not None:
+            results['Flow_Level'] = levels[:, None] * grid
+        return results
+
+    def drag(self, u, depth_index, rigid_drag, threshold_u, vogel_exp):
+        # total drag and its derivative (du) for each velocity, using the geometry of its depth;
+        # vogel_exp is one row for all depths or one row per depth
+        if vogel_exp.ndim == 2:
+            vogel_exp = vogel_exp[depth_index]
+        instruments.count('tree_drag_evaluations', u.size * threshold_u.shape[1])
+        ratio = u[:, None] / threshold_u[depth_index]
+        reconfiguration = ratio >= 1
+        force = rigid_drag[depth_index] * u[:, None] ** 2.0 * np.where(reconfiguration, ratio, 1.0) ** vogel_exp
+        exponent = np.where(reconfiguration, 2.0 + vogel_exp, 2.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            derivative = np.sum(exponent * force, axis=1) / u
+        return np.sum(force, axis=1), derivative
+
+    def newton(self, u, active, bed_coefficient, total_shear, rigid_drag, threshold_u, vogel_exp, geometry_index):
+        # the residual increases with u, the rigid velocity is a lower bound (rigid drag is
+        # the largest drag) and the bed-only velocity is an upper bound
+        plan_area = self.channel.plan_area
+        bed = np.broadcast_to(bed_coefficient, u.shape)
+
+        def residual(u_i, index):
+            drag, drag_du = self.drag(u_i, geometry_index[index], rigid_drag, threshold_u, vogel_exp)
+            return (bed[index] * u_i ** 2.0 + drag / plan_area - total_shear[index],
+                    2.0 * bed[index] * u_i + drag_du / plan_area)
+
+        converged, iterations, bisections = bracketed_newton(residual, u, u.copy(), np.sqrt(total_shear / bed),
+                                                             active, self.tolerance, self.max_iterations)
+        self.check_converged(converged)
+        return iterations, bisections, iterations
+
+    def piecewise(self, u, active, bed_coefficient, total_shear, geometries, geometry_index):
+        # solve all slopes of each geometry with the trees sorted by threshold velocity
+        forest = self.channel.forest
+        solver = PiecewiseSolver(self.tolerance, self.max_iterations)
+        bed = np.broadcast_to(bed_coefficient, u.shape)
+        converged = ~active
+        iterations = np.zeros(u.shape, dtype=int)
+        bisections = np.zeros(u.shape, dtype=int)
+        evaluations = np.zeros(u.shape, dtype=int)
+        for index in np.unique(geometry_index[active]):
+            select = active & (geometry_index == index)
+            sorted_drag = forest.sorted_drag(geometries[index])
+            lower = u[select]
+            upper = np.sqrt(total_shear[select] / bed[select])
+            u[select], converged[select] = solver.solve(sorted_drag, bed[select], total_shear[select],
+                                                        self.channel.plan_area, lower, upper)
+            iterations[select] = solver.iterations
+            bisections[select] = solver.bisections
+            evaluations[select] = solver.drag_evaluations
+        self.check_converged(converged)
+        return iterations, bisections, evaluations
+
+    def check_converged(self, converged):
+        # as the serial VelocitySolver(), a solve that does not converge is an error
+        if not np.all(converged):
+            raise RuntimeError('Velocity failed to converge for {} of {} cases after {} iterations'
+                               .format(np.count_nonzero(~converged), converged.size, self.max_iterations))
+
+    def average_threshold_velocity(self, depths, submerged):
+        # threshold velocity at the average tree height (full height when submerged)
+        return self.channel.forest.average_threshold_velocity(np.where(submerged, 999.0, depths))
+
+
+'''
+Parallel sweep over a process pool. Each task is one slope and one chunk of depths,
+solved with a BatchSolver() in a worker process. The channel (including the forest
+arrays) is sent to each worker once, when the worker starts, and the results are put
+back into the (depth, slope) grid in task order, so the output is identical to a serial
+BatchSolver().solve(). mp_context is the multiprocessing context of the pool (e.g.
+multiprocessing.get_context('spawn'), the default start method on Windows); the pool is also
+used by the ensemble and calibration workers.
+'''
+
+
+class ParallelSweep:
+    def __init__(self, channel, processes=2, depth_chunk=0, mp_context=None):
+        self.channel = channel
+        self.processes = processes
+        self.depth_chunk = depth_chunk
+        self.mp_context = mp_context
+
+    def solve(self, depths, slopes, levels=None):
+        depths = np.asarray(depths, dtype=float)
+        slopes = np.asarray(slopes, dtype=float)
+        depth_chunk = self.depth_chunk if self.depth_chunk > 0 else depths.size
+        tasks = [(start, start + depth_chunk, j)
+                 for j in range(slopes.size) for start in range(0, depths.size, depth_chunk)]
+        task_inputs = [(depths[start:end], slopes[j:j + 1], None if levels is None else levels[start:end])
+                       for start, end, j in tasks]
+
+        results = {}
+        with instruments.timer('solving'), self.pool(init_worker, (self.worker_channel(),)) as executor:
+            for (start, end, j), task_results in zip(tasks, executor.map(solve_task, task_inputs)):
+                for key, values in task_results.items():
+                    if key not in results:
+                        results[key] = np.zeros((depths.size, slopes.size), dtype=values.dtype)
+                    results[key][start:end, j] = values[:, 0]
+
+        # the worker counters are not sent back, so count from the per-solve trace columns
+        instruments.count('solves', depths.size * slopes.size)
+        instruments.count('newton_iterations', int(np.sum(results['Iterations'])))
+        instruments.count('bisections', int(np.sum(results['Bisections'])))
+        instruments.count('drag_evaluations', int(np.sum(results['Drag_evaluations'])))
+        return results
+
+    def solve_levels(self, levels, slopes):
+        levels = np.asarray(levels, dtype=float)
+        return self.solve(levels - self.channel.bed_level, slopes, levels)
+
+    def pool(self, initializer, initargs):
+        # process pool whose workers are started with initializer(*initargs)
+        return ProcessPoolExecutor(max_workers=self.processes, mp_context=self.mp_context, initializer=initializer,
+                                   initargs=initargs)
+
+    def worker_channel(self):
+        # a copy of the channel that only carries the forest arrays (not the Tree() objects)
+        channel = self.channel
+        if channel.is_ruptured:
+            channel.rupture_forest()
+        forest = copy.copy(channel.forest)
+        forest.arrays = channel.forest.tree_arrays()
+        forest.trees = []
+        worker_channel = copy.copy(channel)
+        worker_channel.forest = forest
+        return worker_channel
+
+
+# worker process state for ParallelSweep()
+worker_solver = None
+
+
+def init_worker(channel):
+    global worker_solver
+    worker_solver = BatchSolver(channel)
+
+
+def solve_task(task):
+    depths, slopes, levels = task
+    return worker_solver.solve(depths, slopes, levels)
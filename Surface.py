@@ -0,0 +1,83 @@
+"""
+This script contains a precomputed Manning's n lookup surface for the reach averaged forest
+resistance model. The surface is a dense (depth, slope) table of Manning's n and velocity
+built with the BatchSolver, saved as a compressed numpy archive (*.npz) and queried with
+vectorised bilinear interpolation, e.g. by a 2D hydraulic model.
+"""
+import numpy as np
+from Solver import BatchSolver
+
+'''
+Manning's n and velocity on a (depth, slope) grid. Interpolation is bilinear in depth and
+log(slope), since the slopes span orders of magnitude. The error bounds are measured by
+solving directly at the centre of every grid cell (the furthest point from the grid
+nodes) and are stored with the table.
+'''
+
+
+class RoughnessSurface:
+    def __init__(self, depths, slopes, mannings_n, velocity, n_error=np.nan, velocity_error=np.nan):
+        self.depths = np.asarray(depths, dtype=float)
+        self.slopes = np.asarray(slopes, dtype=float)
+        self.log_slopes = np.log(self.slopes)
+        self.mannings_n = np.asarray(mannings_n, dtype=float)
+        self.velocity = np.asarray(velocity, dtype=float)
+        self.n_error = n_error
+        self.velocity_error = velocity_error
+
+    @classmethod
+    def build(cls, channel, depths, slopes, solver=None):
+        depths = np.sort(np.asarray(depths, dtype=float))
+        slopes = np.sort(np.asarray(slopes, dtype=float))
+        solver = solver if solver is not None else BatchSolver(channel)
+        results = solver.solve(depths, slopes)
+        surface = cls(depths, slopes, results['Mannings_n'], results['Velocity'])
+        surface.check_error(solver)
+        return surface
+
+    def check_error(self, solver):
+        # solve at the cell centres and keep the largest relative interpolation errors
+        mid_depths = (self.depths[1:] + self.depths[:-1]) / 2
+        mid_slopes = np.exp((self.log_slopes[1:] + self.log_slopes[:-1]) / 2)
+        if mid_depths.size == 0 or mid_slopes.size == 0:
+            return self.n_error, self.velocity_error
+        results = solver.solve(mid_depths, mid_slopes)
+        depth_grid, slope_grid = np.meshgrid(mid_depths, mid_slopes, indexing='ij')
+        n, velocity = self.interpolate(depth_grid, slope_grid)
+        self.n_error = np.max(np.abs(n - results['Mannings_n']) / results['Mannings_n'])
+        self.velocity_error = np.max(np.abs(velocity - results['Velocity']) / results['Velocity'])
+        return self.n_error, self.velocity_error
+
+    def interpolate(self, depth, slope):
+        # Manning's n and velocity at each (depth, slope); NaN outside the table
+        depth = np.asarray(depth, dtype=float)
+        log_slope = np.log(np.asarray(slope, dtype=float))
+        i, x = self.locate(self.depths, depth)
+        j, y = self.locate(self.log_slopes, log_slope)
+        outside = ((depth < self.depths[0]) | (depth > self.depths[-1])
+                   | (log_slope < self.log_slopes[0]) | (log_slope > self.log_slopes[-1]))
+        results = []
+        for table in (self.mannings_n, self.velocity):
+            value = ((1 - x) * (1 - y) * table[i, j] + x * (1 - y) * table[i + 1, j]
+                     + (1 - x) * y * table[i, j + 1] + x * y * table[i + 1, j + 1])
+            results.append(np.where(outside, np.nan, value))
+        return tuple(results)
+
+    @staticmethod
+    def locate(nodes, values):
+        # index of the lower grid node and the fractional position within the cell
+        index = np.clip(np.searchsorted(nodes, values, side='right') - 1, 0, nodes.size - 2)
+        fraction = (values - nodes[index]) / (nodes[index + 1] - nodes[index])
+        return index, fraction
+
+    def save(self, file_name):
+        np.savez_compressed(file_name, depths=self.depths, slopes=self.slopes,
+                            mannings_n=self.mannings_n.astype(np.float32),
+                            velocity=self.velocity.astype(np.float32),
+                            n_error=self.n_error, velocity_error=self.velocity_error)
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as data:
+            return cls(data['depths'], data['slopes'], data['mannings_n'], data['velocity'],
+                       float(data['n_error']), float(data['velocity_error']))
@@ -0,0 +1,129 @@
+"""
+This script reads the tree database (*Tree DB ==*) of the reach averaged forest resistance
+model straight into numpy columns. The csv file is read in chunks and the tree types are
+mapped to species codes, so no Tree() objects are made. The parsed columns are written to
+a binary sidecar file next to the csv file, which later runs open with a memory map
+instead of parsing the csv file again. The class is used in the Forest.py script.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# parsed columns and their types
+database_columns = [('height', '<f8'), ('population', '<f8'), ('ground_level', '<f8'), ('species', '<i4')]
+# grid cell of each tree (*Cell* column), for multi-cell runs
+cell_column = ('cell', '<i8')
+magic = b'TREEDB01'
+
+'''
+Chunked reader of a tree database with a binary parse cache. The sidecar file starts
+with a magic string and a json header holding the size, modification time and sha256
+hash of the csv file it was parsed from, followed by each column stored contiguously.
+The sidecar is used when the csv file has the same size and modification time, or the
+same size and hash (e.g. a copied file), and is rewritten otherwise. With cells, the
+*Cell* column is read as well and the sidecar has a separate name.
+'''
+
+
+class TreeDatabase:
+    def __init__(self, file_name, species_names, chunk_size=100000, cells=False):
+        self.file_name = file_name
+        self.species_names = list(species_names)
+        self.chunk_size = chunk_size
+        self.columns = database_columns + [cell_column] if cells else database_columns
+        self.cache_file = '{}_{}.bin'.format(os.path.splitext(file_name)[0], 'cells' if cells else 'trees')
+        self.skipped = 0
+        self.from_cache = False
+
+    def read(self, use_cache=True):
+        # dict of column arrays (height, population, ground_level, species code)
+        if use_cache:
+            columns = self.read_cache()
+            if columns is not None:
+                self.from_cache = True
+                return columns
+        columns = self.parse()
+        if use_cache:
+            self.write_cache(columns)
+        return columns
+
+    def parse(self):
+        codes = {name: code for code, name in enumerate(self.species_names)}
+        parts = {name: [] for name, dtype in self.columns}
+        use_columns = ['Height', 'Population', 'GroundLevel', 'Type'] + (['Cell'] if 'cell' in parts else [])
+        self.skipped = 0
+        for chunk in pd.read_csv(self.file_name, usecols=use_columns, chunksize=self.chunk_size):
+            species = chunk['Type'].map(codes)
+            known = species.notna().to_numpy()
+            self.skipped += int(np.count_nonzero(~known))
+            parts['height'].append(chunk['Height'].to_numpy(dtype=float)[known])
+            parts['population'].append(chunk['Population'].to_numpy(dtype=float)[known])
+            parts['ground_level'].append(chunk['GroundLevel'].to_numpy(dtype=float)[known])
+            parts['species'].append(species.to_numpy()[known].astype(np.int32))
+            if 'cell' in parts:
+                parts['cell'].append(chunk['Cell'].to_numpy(dtype=np.int64)[known])
+        return {name: np.concatenate(parts[name]) if parts[name] else np.zeros(0, dtype)
+                for name, dtype in self.columns}
+
+    def source_hash(self):
+        digest = hashlib.sha256()
+        with open(self.file_name, 'rb') as df:
+            for block in iter(lambda: df.read(2**20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def is_current(self, header):
+        source = header['source']
+        stat = os.stat(self.file_name)
+        if source['size'] != stat.st_size or header['species'] != self.species_names:
+            return False
+        if header['columns'] != [list(column) for column in self.columns]:
+            return False
+        return source['mtime_ns'] == stat.st_mtime_ns or source['sha256'] == self.source_hash()
+
+    def write_cache(self, columns):
+        stat = os.stat(self.file_name)
+        rows = columns['height'].size
+        header = json.dumps({'source': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                        'sha256': self.source_hash()},
+                             'species': self.species_names, 'skipped': self.skipped, 'rows': rows,
+                             'columns': self.columns}).encode()
+        # pad the header so the columns start on an 8 byte boundary
+        header += b' ' * (-(len(magic) + 8 + len(header)) % 8)
+        try:
+            cf = open(self.cache_file, 'wb')
+            cf.write(magic)
+            cf.write(np.int64(len(header)).tobytes())
+            cf.write(header)
+            for name, dtype in self.columns:
+                cf.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+            cf.close()
+        except OSError:
+            # the csv file can still be read without a sidecar (e.g. a read only folder)
+            pass
+
+    def read_cache(self):
+        # the sidecar columns (copy on write memory maps), or None if it is missing or out of date
+        if not os.path.exists(self.cache_file) or os.path.getsize(self.cache_file) < len(magic) + 8:
+            return None
+        data = np.memmap(self.cache_file, dtype=np.uint8, mode='c')
+        if bytes(data[:len(magic)]) != magic:
+            return None
+        start = len(magic) + 8
+        header_length = int(np.frombuffer(data, np.int64, 1, len(magic))[0])
+        header = json.loads(bytes(data[start:start + header_length]))
+        if not self.is_current(header):
+            return None
+        rows = header['rows']
+        position = start + header_length
+        columns = {}
+        for name, dtype in header['columns']:
+            dtype = np.dtype(dtype)
+            if position + rows * dtype.itemsize > data.size:
+                return None
+            columns[name] = data[position:position + rows * dtype.itemsize].view(dtype)
+            position += rows * dtype.itemsize
+        self.skipped = header['skipped']
+        return columns
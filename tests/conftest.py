@@ -0,0 +1,37 @@
+"""
+Shared fixtures of the regression tests: a copy of the Dayboro_WTP sample model and channels
+read from it. The ufm file joins its input files to the model folder with a backslash, so on
+other platforms the inputs are linked under those names as well.
+"""
+import os
+import shutil
+import sys
+import pytest
+
+package_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, package_folder)
+
+from Channel import RectChannel
+from Logger import LogFile, WARNING
+
+LogFile.configure(console_level=WARNING)
+
+
+@pytest.fixture(scope='session')
+def dayboro_ufm(tmp_path_factory):
+    # the ufm file of a copy of the sample model (the runs write logs and parse caches into it)
+    folder = str(tmp_path_factory.mktemp('dayboro') / 'Dayboro_WTP')
+    shutil.copytree(os.path.join(package_folder, 'model', 'Dayboro_WTP'), folder,
+                    ignore=shutil.ignore_patterns('*.txt', '*.bin', '*.npz'))
+    if os.sep != '\\':
+        for file_name in os.listdir(folder):
+            if file_name.endswith('.csv'):
+                os.symlink(os.path.join(folder, file_name), '{}\\{}'.format(folder, file_name))
+    return os.path.join(folder, 'Dayboro_WTP_2009_0p6.ufm')
+
+
+@pytest.fixture
+def dayboro(dayboro_ufm):
+    channel = RectChannel()
+    channel.read_ufm_file(dayboro_ufm)
+    return channel
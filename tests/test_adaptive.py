@@ -0,0 +1,47 @@
+"""
+Regression tests of the adaptive flow depths: the refined depths against a direct solve and
+a fine grid of depths, and the minimum spacing.
+"""
+import numpy as np
+import pytest
+from Hydraulics import adaptive_depths
+from Solver import BatchSolver
+
+slopes = np.array([1 / 250, 1 / 2000])
+coarse = np.linspace(0.1, 12.0, 9)
+
+
+class CountingSolver(BatchSolver):
+    # a batch solver that records the depths it solves
+    def __init__(self, channel):
+        super().__init__(channel)
+        self.solved = []
+
+    def solve(self, depths, slopes, levels=None):
+        self.solved.extend(depths)
+        return super().solve(depths, slopes, levels)
+
+
+@pytest.mark.parametrize('n_tolerance', [0.01, 0.002])
+def test_refined_depths_meet_the_tolerance(dayboro, n_tolerance):
+    solver = CountingSolver(dayboro)
+    depths, results, passes = adaptive_depths(solver, coarse, slopes, n_tolerance, 5.0, 0.02)
+    assert passes > 0 and np.all(np.diff(depths) > 0) and np.all(np.isin(coarse, depths))
+    # each depth is solved once, and as a direct solve of the refined depths
+    assert sorted(solver.solved) == list(depths)
+    direct = BatchSolver(dayboro).solve(depths, slopes)
+    for key in ('Mannings_n', 'Velocity', 'Regime', 'Submerged'):
+        np.testing.assert_array_equal(results[key], direct[key])
+
+    # Mannings n interpolated from the refined depths is within the tolerance between them
+    fine = np.linspace(coarse[0], coarse[-1], 500)
+    n = BatchSolver(dayboro).solve(fine, slopes)['Mannings_n']
+    interpolated = np.stack([np.interp(fine, depths, results['Mannings_n'][:, k]) for k in range(slopes.size)], axis=1)
+    assert np.max(np.abs(interpolated / n - 1)) <= n_tolerance
+
+
+def test_refinement_stops_at_the_minimum_spacing(dayboro):
+    depths, results, passes = adaptive_depths(BatchSolver(dayboro), coarse, slopes, 0.0, 5.0, 0.5)
+    # every interval is refined until its halves would be closer than the minimum spacing
+    assert passes == 1 and depths.size == 2 * coarse.size - 1
+    assert np.all(np.diff(depths) >= 0.5)
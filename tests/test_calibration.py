@@ -0,0 +1,50 @@
+"""
+Regression tests of the drag parameter calibration: observations made with the species
+drag parameters are fitted back to them, on one process and on a (spawned) pool.
+"""
+import multiprocessing
+import numpy as np
+import pandas as pd
+import pytest
+from Calibration import Calibration
+from Calibration import CalibrationModel
+from Solver import BatchSolver
+
+depths = np.array([0.5, 2.0, 6.0, 12.0])
+slopes = np.array([1 / 2000, 1 / 250])
+
+
+def observations(channel):
+    # Mannings n and velocity of a direct solve, one row per depth and slope
+    results = BatchSolver(channel, mode='newton').solve(depths, slopes)
+    return pd.DataFrame({'Flow_Depth': np.repeat(depths, slopes.size), 'Slope': np.tile(slopes, depths.size),
+                         'Mannings_n': results['Mannings_n'].ravel(), 'Velocity': results['Velocity'].ravel()})
+
+
+def test_forward_model_matches_the_solve(dayboro):
+    dayboro.blockage = True
+    model = CalibrationModel(dayboro, observations(dayboro))
+    truth = dayboro.forest.species_types['Casuarina-overstory'].drag_parameters
+    assert model.fitted == [0, 1]
+    mannings_n, velocity = model.forward(np.array([truth, (0.5, -0.5)]))
+    np.testing.assert_allclose(mannings_n[:, 0], model.mannings_n, rtol=1e-9)
+    np.testing.assert_allclose(velocity[:, 0], model.velocity, rtol=1e-9)
+    # more drag (and less reconfiguration) is more resistance
+    assert np.all(mannings_n[:, 1] > mannings_n[:, 0])
+    misfit = model.misfit(np.array([truth, (truth[0] * 1.1, truth[1])]))
+    assert misfit[0] < 1e-18 < misfit[1]
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_calibration_recovers_the_drag_parameters(dayboro, processes):
+    dayboro.blockage = True
+    model = CalibrationModel(dayboro, observations(dayboro))
+    calibration = Calibration(model, processes=processes, seed=1, max_generations=100,
+                              mp_context=multiprocessing.get_context('spawn'))
+    fitted = calibration.run()
+    truth = dayboro.forest.species_types['Casuarina-overstory'].drag_parameters
+    assert fitted['Cd0'] == pytest.approx(truth[0], rel=1e-4)
+    assert fitted['Vogel'] == pytest.approx(truth[1], abs=1e-4)
+    table = calibration.species_table(fitted)
+    assert list(table['Type']) == ['Casuarina-overstory']
+    assert table['Drag'][0] == '{} {}'.format(fitted['Cd0'], fitted['Vogel'])
@@ -0,0 +1,60 @@
+"""
+Regression tests of the Monte Carlo ensemble: repeatable draws, the same members whatever
+the batches or processes, and an ensemble without spread against the BatchSolver().
+"""
+import multiprocessing
+import numpy as np
+from Ensemble import EnsembleSolver
+from Ensemble import ParameterDistributions
+from Solver import BatchSolver
+
+depths = np.array([0.5, 2.0, 6.0, 12.0])
+slopes = np.array([1 / 2000, 1 / 250])
+
+
+def test_seed_repeats_the_ensemble(dayboro):
+    distributions = ParameterDistributions.read(dayboro.ensemble_file)
+    ensemble = EnsembleSolver(dayboro, distributions, members=12, seed=3)
+    results = ensemble.solve(depths, slopes)
+    assert results['Mannings_n'].shape == (depths.size, slopes.size, 12)
+    assert np.ptp(results['Mannings_n'], axis=2).min() > 0
+
+    # the members do not depend on the batches or the processes (spawned, so the channel is pickled)
+    for repeat in (EnsembleSolver(dayboro, distributions, members=12, seed=3, max_elements=1),
+                   EnsembleSolver(dayboro, distributions, members=12, seed=3, processes=2, max_elements=2000,
+                                  mp_context=multiprocessing.get_context('spawn'))):
+        repeat_results = repeat.solve(depths, slopes)
+        for key in results:
+            np.testing.assert_allclose(repeat_results[key], results[key], rtol=1e-12, err_msg=key)
+    other = EnsembleSolver(dayboro, distributions, members=12, seed=4).solve(depths, slopes)
+    assert not np.allclose(other['Mannings_n'], results['Mannings_n'])
+
+    # a random seed is kept so the run can be repeated
+    ensemble = EnsembleSolver(dayboro, distributions, members=4)
+    results = ensemble.solve(depths, slopes)
+    repeat_results = EnsembleSolver(dayboro, distributions, members=4, seed=ensemble.seed).solve(depths, slopes)
+    np.testing.assert_array_equal(repeat_results['Mannings_n'], results['Mannings_n'])
+
+
+def test_ensemble_without_spread_matches_the_batch_solve(dayboro):
+    distributions = ParameterDistributions.read(dayboro.ensemble_file)
+    for row in distributions.rows:
+        row['spread'] = 0.0
+    ensemble = EnsembleSolver(dayboro, distributions, members=3, seed=1)
+    results = ensemble.solve(depths, slopes)
+    direct = BatchSolver(dayboro, mode='newton').solve(depths, slopes)
+    for key in ('Mannings_n', 'Velocity'):
+        np.testing.assert_allclose(results[key], np.repeat(direct[key][..., None], 3, axis=2), rtol=1e-6, err_msg=key)
+
+
+def test_summary_percentiles(dayboro):
+    ensemble = EnsembleSolver(dayboro, ParameterDistributions.read(dayboro.ensemble_file), members=40, seed=5)
+    results = ensemble.solve(depths, slopes)
+    summary = ensemble.summary(results)
+    assert sorted(summary) == sorted('{}_{}'.format(key, name) for key in ('Mannings_n', 'Velocity')
+                                     for name in ('mean', 'p5', 'p50', 'p95'))
+    for key in ('Mannings_n', 'Velocity'):
+        assert np.all(summary['{}_p5'.format(key)] <= summary['{}_p50'.format(key)])
+        assert np.all(summary['{}_p50'.format(key)] <= summary['{}_p95'.format(key)])
+        np.testing.assert_allclose(summary['{}_p50'.format(key)], np.median(results[key], axis=2))
+        np.testing.assert_allclose(summary['{}_mean'.format(key)], np.mean(results[key], axis=2))
@@ -0,0 +1,184 @@
+"""
+Regression tests of the forest: species parameters, and the array engine against the Tree()
+objects of the Dayboro_WTP tree database.
+"""
+import os
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+from Forest import DepthGeometry
+from Forest import GeometryCache
+from Forest import Species
+from Forest import Tree
+from Forest import TreeArrays
+from Solver import BatchSolver
+
+
+def test_species_parameters_cannot_be_changed():
+    species = Species('a', (1, 2), (1, 2, 3, 4, 5), (1, 2), (1, 2), (1, 2), (1, 2), (1, 2), (1, 2), (3, 4))
+    with pytest.raises(AttributeError):
+        species.drag_parameters = (0, 0)
+    assert species.ruptured.drag_parameters == (3, 4)
+
+
+def test_species_and_channel_pickle_round_trip(dayboro):
+    species = list(dayboro.forest.species_types.values())
+    copies = pickle.loads(pickle.dumps(species + species))
+    for original, copy in zip(species, copies):
+        assert [getattr(copy, name) for name in Species.__slots__ if name != 'ruptured'] == \
+               [getattr(original, name) for name in Species.__slots__ if name != 'ruptured']
+        assert copy.ruptured.drag_parameters == original.ruptured.drag_parameters
+    # each species is shared by all its trees, in the copy as well
+    assert all(copy is twin for copy, twin in zip(copies[:len(species)], copies[len(species):]))
+
+    depths, slopes = np.array([0.5, 3.0, 10.0]), np.array([1 / 1000])
+    channel = pickle.loads(pickle.dumps(dayboro))
+    np.testing.assert_array_equal(BatchSolver(channel).solve(depths, slopes)['Mannings_n'],
+                                  BatchSolver(dayboro).solve(depths, slopes)['Mannings_n'])
+
+    dayboro.set_bed_slope(1 / 1000)
+    dayboro.set_water_depth(3.0)
+    result = dayboro.resolve_velocity()
+    assert pickle.loads(pickle.dumps(result)).as_dict() == result.as_dict()
+
+
+def database_trees(dayboro_ufm, species_types):
+    # Tree() objects of the Dayboro_WTP tree database (database order)
+    database = pd.read_csv(os.path.join(os.path.dirname(dayboro_ufm), 'Tree_db_2009_0p6.csv'))
+    return [Tree(row.Height, row.Population, row.GroundLevel, tree_id=str(row.ID), species=species_types[row.Type])
+            for row in database.itertuples()]
+
+
+@pytest.mark.parametrize('depth', [0.005, 0.3, 1.0, 3.0, 50.0])
+def test_arrays_match_the_tree_objects(dayboro, dayboro_ufm, depth):
+    trees = database_trees(dayboro_ufm, dayboro.forest.species_types)
+    arrays = dayboro.forest.tree_arrays()
+    np.testing.assert_array_equal(arrays.height, [tree.height for tree in trees])
+    np.testing.assert_array_equal(arrays.population, [tree.number_of_specimens for tree in trees])
+
+    for tree in trees:
+        tree.flow_depth = min(depth, tree.height)
+    arrays.set_flow_depth(np.minimum(depth, arrays.height))
+    np.testing.assert_allclose(arrays.area_h, [tree.area_h() for tree in trees], rtol=1e-12)
+    np.testing.assert_allclose(arrays.first_area_h, [tree.first_area_h() for tree in trees], rtol=1e-12)
+    np.testing.assert_allclose(arrays.threshold_u, [tree.threshold_velocity() for tree in trees], rtol=1e-12)
+    np.testing.assert_allclose(arrays.rigid_speed_specific_drag(), [tree.rigid_speed_specific_drag() for tree in trees],
+                               rtol=1e-12)
+    for u in (0.05, 0.5, 2.0, 5.0):
+        np.testing.assert_allclose(arrays.drag_force(u), [tree.drag_force(u) for tree in trees], rtol=1e-12)
+        assert list(arrays.reconfiguration) == [tree.drag_regime == 'reconfiguration' for tree in trees]
+
+
+@pytest.mark.parametrize('depth', [0.3, 3.0, 50.0])
+def test_forest_totals_match_the_tree_objects(dayboro, dayboro_ufm, depth):
+    trees = database_trees(dayboro_ufm, dayboro.forest.species_types)
+    for tree in trees:
+        tree.flow_depth = min(depth, tree.height)
+    forest = dayboro.forest
+    forest.set_flow_depth(depth)
+    np.testing.assert_allclose(forest.total_frontal_area(),
+                               sum(tree.area_h() * tree.number_of_specimens for tree in trees), rtol=1e-12)
+    np.testing.assert_allclose(forest.total_plan_area(),
+                               sum(np.pi * (tree.area_h() / tree.flow_depth) ** 2 / 4 * tree.number_of_specimens
+                                   for tree in trees), rtol=1e-12)
+    for u in (0.05, 0.5, 2.0, 5.0):
+        np.testing.assert_allclose(forest.total_drag(u),
+                                   sum(tree.drag_force(u) * tree.number_of_specimens for tree in trees), rtol=1e-12)
+
+
+def test_trees_of_a_database_forest(dayboro, dayboro_ufm):
+    # the forest only holds the arrays; its trees are made from them in database order
+    trees = database_trees(dayboro_ufm, dayboro.forest.species_types)
+    dayboro.forest.set_flow_depth(1.0)
+    assert dayboro.forest.trees == []
+    for index in (0, 7, -1):
+        tree = dayboro.forest.get_tree(index)
+        assert (tree.height, tree.number_of_specimens, tree.ground_level, tree.species) == \
+               (trees[index].height, trees[index].number_of_specimens, trees[index].ground_level, trees[index].species)
+        trees[index].flow_depth = min(1.0, trees[index].height)
+        assert tree.flow_depth == trees[index].flow_depth
+        assert tree.drag_force(1.0) == pytest.approx(trees[index].drag_force(1.0), rel=1e-12)
+    with pytest.raises(IndexError):
+        dayboro.forest.get_tree(len(trees))
+
+
+def test_trees_of_a_mixed_species_store(dayboro, dayboro_ufm):
+    # the store is grouped by species, the trees keep their input order
+    trees = database_trees(dayboro_ufm, dayboro.forest.species_types)
+    other = pickle.loads(pickle.dumps(trees[0].species))
+    for tree in trees[1::2]:
+        tree.species = other
+    arrays = TreeArrays(trees)
+    assert arrays.order is not None
+    for index, tree in enumerate(trees):
+        assert (arrays.tree(index).height, arrays.tree(index).species) == (tree.height, tree.species)
+
+
+def test_geometry_cache_evicts_the_least_recently_used_depths(dayboro):
+    forest = dayboro.forest
+    trees = forest.tree_arrays().size
+    forest.geometry_cache = GeometryCache(max_size=3, max_elements=10 * trees)
+    first = forest.depth_geometry(1.0)
+    for depth in (2.0, 3.0, 1.0, 4.0):
+        forest.depth_geometry(depth)
+    cache = forest.geometry_cache
+    assert [key[1] for key in cache.entries] == [3.0, 1.0, 4.0]
+    assert (cache.hits, cache.misses, cache.elements) == (1, 4, 3 * trees)
+    assert forest.depth_geometry(1.0) is first
+
+    # the element bound holds fewer depths, and a geometry above it is not stored
+    cache = forest.geometry_cache = GeometryCache(max_size=128, max_elements=2 * trees)
+    for depth in (1.0, 2.0, 3.0):
+        forest.depth_geometry(depth)
+    assert [key[1] for key in cache.entries] == [2.0, 3.0] and cache.elements == 2 * trees
+    forest.geometry_cache = GeometryCache(max_elements=trees - 1)
+    forest.depth_geometry(1.0)
+    assert len(forest.geometry_cache.entries) == 0
+    np.testing.assert_array_equal(forest.depth_geometry(5.0).area_h, DepthGeometry(
+        forest.tree_arrays(), np.minimum(5.0, forest.tree_arrays().height)).area_h)
+
+
+@pytest.mark.parametrize('level', [41.0, 41.9, 42.0, 42.8, 43.5, 50.0, 60.0, 75.0])
+def test_level_index_matches_the_level_geometry(dayboro, dayboro_ufm, level):
+    # the wetting index (dry, partly wet and submerged trees) against each tree wetted from its ground level
+    trees = database_trees(dayboro_ufm, dayboro.forest.species_types)
+    for tree in trees:
+        tree.set_water_level(level)
+    arrays = dayboro.forest.tree_arrays()
+    geometry = dayboro.forest.level_geometry(level)
+    np.testing.assert_array_equal(geometry.flow_depth, [tree.flow_depth for tree in trees])
+    direct = DepthGeometry(arrays, geometry.flow_depth)
+    for name in ('wet', 'area_h', 'first_area_h', 'threshold_u', 'rigid_drag'):
+        np.testing.assert_allclose(getattr(geometry, name), getattr(direct, name), rtol=1e-12)
+    for name in ('total_plan_area', 'volume', 'total_frontal_area', 'total_rigid_drag'):
+        np.testing.assert_allclose(getattr(geometry, name), getattr(direct, name), rtol=1e-10)
+
+
+def test_bending_kernel(dayboro, dayboro_ufm):
+    arrays = dayboro.forest.tree_arrays()
+    velocities = np.array([1e-6, 0.5, 1.0, 2.0, 4.0])
+    depths = np.array([1.0, 5.0, 30.0])
+    bent_height, deflection, curvature = arrays.bending(velocities[:, None], depths[None, :])
+    assert bent_height.shape == deflection.shape == curvature.shape == (5, 3, arrays.size)
+
+    # upright in still water, bent further (lower and further over) by faster flows
+    np.testing.assert_allclose(bent_height[0], np.broadcast_to(arrays.height, (3, arrays.size)), rtol=1e-6)
+    assert np.all(deflection[0] < 1e-6 * arrays.height)
+    assert np.all(np.diff(bent_height, axis=0) <= 0) and np.all(np.diff(deflection, axis=0) >= 0)
+    assert np.all(np.diff(curvature, axis=0) >= 0)
+    assert np.all(bent_height[-1, -1] < arrays.height)
+    assert np.all(bent_height ** 2 + deflection ** 2 <= arrays.height ** 2 * (1 + 1e-9))
+
+    # the chunks of trees give the same result as one chunk, and the Tree() objects agree
+    chunked = np.empty_like(bent_height)
+    chunks = arrays.bending_chunks(velocities[:, None, None], depths[None, :, None], 50, max_elements=500)
+    for start, stop, chunk in chunks:
+        chunked[..., start:stop] = chunk[0]
+    np.testing.assert_array_equal(chunked, bent_height)
+    trees = database_trees(dayboro_ufm, dayboro.forest.species_types)
+    for tree in trees[::10]:
+        tree.flow_depth = min(5.0, tree.height)
+        assert tree.bent_height(2.0) == pytest.approx(bent_height[3, 1, int(tree.tree_id) - 1], rel=1e-12)
+    np.testing.assert_allclose(arrays.average_bent_height(velocities, 5.0), np.average(
+        bent_height[:, 1], axis=-1, weights=arrays.population), rtol=1e-12)
@@ -0,0 +1,50 @@
+"""
+Regression tests of the height class approximation: the error against the individual trees
+falls with more classes, and the chosen number of classes meets the target error.
+"""
+import numpy as np
+import pytest
+from HeightClasses import HeightClassApproximation
+from Solver import BatchSolver
+
+slopes = np.array([1 / 2000, 1 / 250])
+
+
+@pytest.fixture
+def approximation(dayboro):
+    approximation = HeightClassApproximation(dayboro)
+    approximation.set_probe(np.linspace(0.2, 30.0, 60), slopes)
+    return approximation
+
+
+def test_error_falls_with_more_classes(dayboro, approximation):
+    errors = [approximation.evaluate(classes)['Mannings_n'] for classes in (1, 2, 4, 16, 64)]
+    assert errors[0] > 0.01 and np.all(np.diff(errors) < 0)
+    # the classes hold the whole population, and the solve is on the classes
+    assert dayboro.forest.tree_arrays().size < dayboro.forest.exact_arrays.size
+    assert np.sum(dayboro.forest.tree_arrays().population) == pytest.approx(
+        np.sum(dayboro.forest.exact_arrays.population))
+    n = BatchSolver(dayboro, mode='newton').solve(*approximation.probe)['Mannings_n']
+    assert np.max(np.abs(n / approximation.reference['Mannings_n'] - 1)) == errors[-1]
+
+    # with a class for every tree the approximation is exact
+    assert approximation.evaluate(10000) == {'Mannings_n': 0.0, 'Velocity': 0.0}
+    assert dayboro.forest.tree_arrays().size == dayboro.forest.exact_arrays.size
+
+
+@pytest.mark.parametrize('max_error', [0.05, 0.01, 0.001])
+def test_chosen_classes_meet_the_error(approximation, max_error):
+    classes = approximation.choose(max_error)
+    assert 0 < classes and approximation.errors['Mannings_n'] <= max_error
+    # half as many classes does not
+    if classes > 2:
+        assert approximation.evaluate(classes // 2)['Mannings_n'] > max_error
+
+
+def test_individual_trees_when_no_classes_meet_the_error(dayboro, approximation):
+    assert approximation.choose(1e-6) == 0
+    assert approximation.errors == {'Mannings_n': 0.0, 'Velocity': 0.0}
+    assert dayboro.forest.tree_arrays() is dayboro.forest.exact_arrays
+    # unless the number of classes is capped
+    approximation.max_classes = 16
+    assert approximation.choose(1e-6) == 16 and approximation.errors['Mannings_n'] > 1e-6
@@ -0,0 +1,73 @@
+"""
+Regression tests of the streaming hydrograph mode: nearest and interpolated lookups against
+a direct solve, levels just above the bed, and the streamed output file.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from Hydrograph import HydrographStream
+from Solver import BatchSolver
+
+slopes = np.array([1 / 250, 1 / 2000])
+depths = np.random.default_rng(1).uniform(0.5, 8.0, 200)
+
+
+@pytest.mark.parametrize('interpolate, rtol', [(False, 5e-3), (True, 5e-5)])
+def test_lookup_matches_the_direct_solve(dayboro, interpolate, rtol):
+    stream = HydrographStream(dayboro, BatchSolver(dayboro), slopes, resolution=0.01, interpolate=interpolate)
+    results = stream.lookup(depths)
+    direct = BatchSolver(dayboro).solve(depths, slopes)
+    np.testing.assert_allclose(results['Mannings_n'], direct['Mannings_n'], rtol=rtol)
+    np.testing.assert_allclose(results['Velocity'], direct['Velocity'], rtol=rtol)
+    # the quantised depths are solved once
+    assert stream.solved == stream.keys.size <= 2 * 750
+
+
+def test_interpolation_is_closer_than_nearest(dayboro):
+    direct = BatchSolver(dayboro).solve(depths, slopes)['Mannings_n']
+    errors = []
+    for interpolate in (False, True):
+        stream = HydrographStream(dayboro, BatchSolver(dayboro), slopes, resolution=0.01, interpolate=interpolate)
+        errors.append(np.max(np.abs(stream.lookup(depths)['Mannings_n'] / direct - 1)))
+    assert errors[1] < errors[0] / 10
+
+
+@pytest.mark.parametrize('interpolate', [False, True])
+def test_levels_just_above_the_bed(dayboro, interpolate):
+    dayboro.bed_level = 42.337
+    values = dayboro.bed_level + np.array([np.nan, -0.5, 0.0, 0.0011, 0.004, 0.3, 2.5])
+    stream = HydrographStream(dayboro, BatchSolver(dayboro), slopes, resolution=0.01, interpolate=interpolate)
+    results = stream.lookup(values, levels=True)
+    assert np.all(np.isnan(results['Mannings_n'][:3]))
+    assert np.all(np.isfinite(results['Mannings_n'][3:])) and np.all(results['Velocity'][3:] > 0)
+    direct = BatchSolver(dayboro).solve_levels(values[5:], slopes)
+    np.testing.assert_allclose(results['Mannings_n'][5:], direct['Mannings_n'], rtol=5e-3)
+
+
+def test_levels_without_a_bed_level(dayboro, tmp_path):
+    # the depths are measured from the lowest ground level, as for a flow levels file
+    dayboro.bed_level = None
+    ground_level = float(np.min(dayboro.forest.tree_arrays().ground_level))
+    levels = ground_level + np.array([0.5, 2.0, 6.0])
+    input_file = str(tmp_path / 'hydrograph.csv')
+    output_file = str(tmp_path / 'hydrograph_results.csv')
+    pd.DataFrame({'Flow_Level': levels}).to_csv(input_file, index=False)
+    HydrographStream(dayboro, BatchSolver(dayboro), slopes, resolution=0.01).run(input_file, output_file, ['1', '2'])
+    assert dayboro.bed_level == ground_level
+    direct = BatchSolver(dayboro).solve_levels(levels, slopes)
+    np.testing.assert_allclose(pd.read_csv(output_file)[['Mannings_n_1', 'Mannings_n_2']].to_numpy(),
+                               direct['Mannings_n'], rtol=5e-3)
+
+
+def test_run_streams_the_series_in_chunks(dayboro, tmp_path):
+    input_file = str(tmp_path / 'hydrograph.csv')
+    output_file = str(tmp_path / 'hydrograph_results.csv')
+    pd.DataFrame({'Time': np.arange(depths.size), 'Flow_Depth': depths}).to_csv(input_file, index=False)
+    stream = HydrographStream(dayboro, BatchSolver(dayboro), slopes, resolution=0.01, chunk_size=64)
+    stream.run(input_file, output_file, ['1', '2'])
+    output = pd.read_csv(output_file)
+    assert stream.timesteps == depths.size
+    assert list(output.columns) == ['Time', 'Flow_Depth', 'Mannings_n_1', 'Mannings_n_2', 'Velocity_1', 'Velocity_2']
+    np.testing.assert_array_equal(output['Time'], np.arange(depths.size))
+    np.testing.assert_allclose(output[['Mannings_n_1', 'Mannings_n_2']].to_numpy(),
+                               stream.lookup(depths)['Mannings_n'])
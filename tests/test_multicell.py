@@ -0,0 +1,47 @@
+"""
+Regression tests of the multi-cell mode: a cell with all the trees matches the channel
+solve, and a cell without trees has the bed Manning's n.
+"""
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from MultiCell import CellForest
+from MultiCell import MultiCellSolver
+from MultiCell import segment_min
+from MultiCell import segment_sum
+from Solver import BatchSolver
+
+depths = np.linspace(0.1, 15.0, 12)
+slopes = np.array([1 / 250, 1 / 1000, 1 / 5000])
+
+
+def test_segment_reductions_with_empty_segments():
+    values = np.array([[1.0, 2.0, 3.0, 4.0], [5.0, 6.0, 7.0, 8.0]])
+    offsets = np.array([0, 0, 3, 3, 4])
+    np.testing.assert_array_equal(segment_sum(values, offsets), [[0, 6, 0, 4], [0, 18, 0, 8]])
+    np.testing.assert_array_equal(segment_min(values, offsets), [[np.inf, 1, np.inf, 4], [np.inf, 5, np.inf, 8]])
+
+
+@pytest.mark.parametrize('blockage', [True, False])
+def test_cells_match_the_channel_solve(dayboro, dayboro_ufm, tmp_path, blockage):
+    dayboro.blockage = blockage
+    folder = str(tmp_path)
+    trees = pd.read_csv(os.path.join(os.path.dirname(dayboro_ufm), 'Tree_db_2009_0p6.csv'))
+    # cell 30 is empty, and the trees of cell 10 are shuffled among the other cells' trees
+    trees['Cell'] = 10
+    other = trees.iloc[:5].assign(Cell=20)
+    tree_db_file = os.path.join(folder, 'cell_trees.csv')
+    cells_file = os.path.join(folder, 'cells.csv')
+    pd.concat([other, trees]).sample(frac=1, random_state=1).to_csv(tree_db_file, index=False)
+    pd.DataFrame({'Cell': [10, 20, 30], 'Plan_Area': [dayboro.plan_area, 100.0, 100.0],
+                  'Mannings_n': [dayboro.n, 0.05, 0.04]}).to_csv(cells_file, index=False)
+
+    cell_forest = CellForest.read(tree_db_file, cells_file, dayboro.forest.species_types, dayboro.logger)
+    results = MultiCellSolver(dayboro, cell_forest, max_elements=5000).solve(depths, slopes)
+    direct = BatchSolver(dayboro).solve(depths, slopes)
+    assert results['Mannings_n'].shape == (depths.size, slopes.size, 3)
+    np.testing.assert_allclose(results['Mannings_n'][:, :, 0], direct['Mannings_n'], rtol=1e-7)
+    np.testing.assert_allclose(results['Velocity'][:, :, 0], direct['Velocity'], rtol=1e-7)
+    assert np.all(results['Mannings_n'][:, :, 1] > 0.05)
+    np.testing.assert_allclose(results['Mannings_n'][:, :, 2], 0.04)
@@ -0,0 +1,29 @@
+"""
+Regression tests of the parallel sweep: the workers are started with the spawn method (the
+default on Windows), so the channel is pickled to them, and the results match a serial
+BatchSolver() solve element by element.
+"""
+import multiprocessing
+import numpy as np
+from Solver import BatchSolver
+from Solver import ParallelSweep
+
+depths = np.array([0.3, 1.0, 2.5, 5.0, 8.0, 12.0, 20.0])
+slopes = np.array([1 / 2000, 1 / 500])
+
+
+def test_spawned_sweep_matches_the_batch_solve(dayboro):
+    dayboro.blockage = True
+    sweep = ParallelSweep(dayboro, processes=2, depth_chunk=3, mp_context=multiprocessing.get_context('spawn'))
+    results = sweep.solve(depths, slopes)
+    direct = BatchSolver(dayboro).solve(depths, slopes)
+    assert sorted(results) == sorted(direct)
+    for key in direct:
+        np.testing.assert_array_equal(results[key], direct[key], err_msg=key)
+
+    dayboro.bed_level = float(np.min(dayboro.forest.tree_arrays().ground_level))
+    levels = dayboro.bed_level + depths
+    results = sweep.solve_levels(levels, slopes)
+    direct = BatchSolver(dayboro).solve_levels(levels, slopes)
+    for key in direct:
+        np.testing.assert_array_equal(results[key], direct[key], err_msg=key)
@@ -0,0 +1,61 @@
+"""
+Regression tests of the result cache: slopes are reused on a rerun, and a change of the
+model settings or of the model code invalidates them.
+"""
+import os
+import numpy as np
+import ResultCache
+from ResultCache import CachedSweep
+from Solver import BatchSolver
+
+depths = np.array([0.5, 2.0, 6.0])
+slopes = np.array([1 / 2000, 1 / 500])
+
+
+def cached_solve(channel, folder, solve_slopes=slopes):
+    cache = ResultCache.ResultCache(folder)
+    results = CachedSweep(channel, BatchSolver(channel), cache).solve(depths, solve_slopes)
+    return results, cache
+
+
+def test_rerun_reuses_the_cached_slopes(dayboro, tmp_path):
+    results, cache = cached_solve(dayboro, str(tmp_path))
+    assert (cache.hits, cache.misses) == (0, 2)
+    rerun, cache = cached_solve(dayboro, str(tmp_path))
+    assert (cache.hits, cache.misses) == (2, 0)
+    for name in results:
+        np.testing.assert_array_equal(rerun[name], results[name])
+    np.testing.assert_array_equal(rerun['Mannings_n'], BatchSolver(dayboro).solve(depths, slopes)['Mannings_n'])
+
+    # only the new slope is solved
+    results, cache = cached_solve(dayboro, str(tmp_path), np.append(slopes, 1 / 1000))
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_changed_settings_are_not_reused(dayboro, tmp_path):
+    cached_solve(dayboro, str(tmp_path))
+    dayboro.n = 0.05
+    results, cache = cached_solve(dayboro, str(tmp_path))
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_changed_code_is_not_reused(dayboro, tmp_path, monkeypatch):
+    code_file = tmp_path / 'Solver.py'
+    code_file.write_text('# version 1\n')
+    monkeypatch.setattr(ResultCache, 'code_files', [str(code_file)])
+    folder = str(tmp_path / 'cache')
+    cached_solve(dayboro, folder)
+    results, cache = cached_solve(dayboro, folder)
+    assert cache.hits == 2
+    code_file.write_text('# version 2\n')
+    results, cache = cached_solve(dayboro, folder)
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResultCache.ResultCache(str(tmp_path), max_size=0.6)
+    values = {'Mannings_n': np.zeros(2**15)}
+    for key in ('a', 'b', 'c'):
+        cache.put(key, values)
+    assert sorted(os.listdir(str(tmp_path))) == ['b.npz', 'c.npz']
+    assert cache.get('a') is None and cache.get('b') is not None
@@ -0,0 +1,49 @@
+"""
+Regression tests of the consolidated results file: the round trip of the typed columns, a
+partly written chunk, and a sweep that is stopped after some slopes.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from Hydraulics import solved_slopes
+from Hydraulics import write_results
+from Results import ResultStore
+from Solver import BatchSolver
+
+
+def test_store_round_trip(tmp_path):
+    file_name = str(tmp_path / 'results.bin')
+    store = ResultStore(file_name, [('Channel_Slope', '<f8'), ('Flow_Depth', '<f8'), ('Regime', '<i4')])
+    store.create()
+    store.append({'Channel_Slope': 2.0, 'Flow_Depth': np.array([0.5, 1.0]), 'Regime': np.array([0, 40])})
+    store.append({'Channel_Slope': 4.0, 'Flow_Depth': np.array([0.5, 1.0]), 'Regime': np.array([10, 100])})
+    with open(file_name, 'ab') as rf:
+        rf.write(np.int64(5).tobytes() + b'partial')  # a chunk of a run that was killed
+
+    results = ResultStore(file_name).load()
+    np.testing.assert_array_equal(results['Channel_Slope'], [2.0, 2.0, 4.0, 4.0])
+    np.testing.assert_array_equal(results['Flow_Depth'], [0.5, 1.0, 0.5, 1.0])
+    np.testing.assert_array_equal(results['Regime'], [0, 40, 10, 100])
+    assert results['Regime'].dtype == np.int32
+
+
+def test_stopped_sweep_keeps_the_completed_slopes(dayboro, tmp_path):
+    dayboro.home_path = str(tmp_path)
+    dayboro.results_format = 'binary'
+    dayboro.flow_depths = [0.5, 2.0, 6.0]
+    solver = BatchSolver(dayboro)
+    solved = []
+
+    def solve(slopes):
+        if len(solved) == 2:
+            raise KeyboardInterrupt
+        solved.append(slopes)
+        return solver.solve(dayboro.flow_depths, slopes)
+
+    df = pd.DataFrame(index=pd.RangeIndex(1, 4, name='ID'))
+    with pytest.raises(KeyboardInterrupt):
+        write_results(dayboro, dayboro.logger, solved_slopes(dayboro, solve), df, 'hydraulics_results')
+    results = ResultStore(str(tmp_path / 'results' / 'hydraulics_results.bin')).load()
+    np.testing.assert_array_equal(results['Channel_Slope'], np.repeat(dayboro.all_slopes[:2], 3))
+    direct = solver.solve(dayboro.flow_depths, np.concatenate(solved))
+    np.testing.assert_array_equal(results['Mannings_n'], direct['Mannings_n'].T.ravel())
@@ -0,0 +1,129 @@
+"""
+Regression tests of the velocity solvers: the serial solve (RectChannel.resolve_velocity()),
+the batched Newton solve and the piecewise solve agree on the Dayboro_WTP sample.
+"""
+import numpy as np
+import pytest
+from Channel import DepthAggregates
+from Solver import BatchSolver
+from Solver import VelocitySolver
+from Solver import bracketed_newton
+
+depths = np.array([0.3, 1.0, 2.5, 5.0, 8.0, 12.0])
+slopes = np.array([1 / 2000, 1 / 500])
+
+
+def serial_solve(channel):
+    mannings_n = np.zeros((depths.size, slopes.size))
+    velocity = np.zeros((depths.size, slopes.size))
+    for j, slope in enumerate(slopes):
+        channel.set_bed_slope(slope)
+        for i, depth in enumerate(depths):
+            channel.set_water_depth(depth)
+            result = channel.resolve_velocity()
+            mannings_n[i, j] = result.Mannings_n
+            velocity[i, j] = result.Velocity
+    return mannings_n, velocity
+
+
+@pytest.mark.parametrize('blockage', [True, False])
+def test_serial_batch_and_piecewise_agree(dayboro, blockage):
+    dayboro.blockage = blockage
+    newton = BatchSolver(dayboro, mode='newton').solve(depths, slopes)
+    piecewise = BatchSolver(dayboro, mode='piecewise').solve(depths, slopes)
+    mannings_n, velocity = serial_solve(dayboro)
+    np.testing.assert_allclose(mannings_n, newton['Mannings_n'], rtol=1e-7)
+    np.testing.assert_allclose(velocity, newton['Velocity'], rtol=1e-7)
+    np.testing.assert_allclose(piecewise['Mannings_n'], newton['Mannings_n'], rtol=1e-7)
+    assert np.all(newton['Mannings_n'] > dayboro.n)
+
+
+def test_serial_and_batch_agree_with_canopy_bending(dayboro):
+    dayboro.forest.canopy_bending = True
+    batch = BatchSolver(dayboro).solve(depths, slopes)
+    mannings_n, velocity = serial_solve(dayboro)
+    np.testing.assert_allclose(mannings_n, batch['Mannings_n'], rtol=1e-7)
+
+
+@pytest.mark.parametrize('blockage', [True, False])
+def test_serial_and_batch_agree_for_flow_levels(dayboro, blockage):
+    # levels below and above the average canopy level
+    dayboro.blockage = blockage
+    dayboro.bed_level = float(np.min(dayboro.forest.tree_arrays().ground_level))
+    canopy_level = dayboro.forest.canopy_level(False)
+    levels = np.concatenate([canopy_level - np.array([4.0, 1.0]), canopy_level + np.array([0.5, 3.0, 10.0])])
+    batch = BatchSolver(dayboro).solve_levels(levels, slopes)
+    assert np.any(batch['Submerged']) and not np.all(batch['Submerged'])
+    for j, slope in enumerate(slopes):
+        dayboro.set_bed_slope(slope)
+        for i, level in enumerate(levels):
+            dayboro.set_water_level(level)
+            result = dayboro.resolve_velocity()
+            np.testing.assert_allclose(result.Mannings_n, batch['Mannings_n'][i, j], rtol=1e-7)
+            np.testing.assert_allclose(result.Velocity, batch['Velocity'][i, j], rtol=1e-7)
+
+
+@pytest.mark.parametrize('mode', ['newton', 'piecewise'])
+def test_batch_raises_when_not_converged(dayboro, mode):
+    dayboro.blockage = True
+    with pytest.raises(RuntimeError):
+        BatchSolver(dayboro, max_iterations=1, mode=mode).solve(depths, slopes)
+
+
+def test_serial_raises_when_not_converged(dayboro):
+    dayboro.blockage = True
+    dayboro.velocity_solver = VelocitySolver(max_iterations=1)
+    with pytest.raises(RuntimeError):
+        serial_solve(dayboro)
+
+
+def test_bracketed_newton_converges_inside_the_bracket():
+    # u ** 3 = target, from a first guess far outside the root (the first steps are bisections)
+    target = np.array([1.0, 8.0, 27.0, 1e-6])
+    u = np.full(target.shape, 50.0)
+    active = np.array([True, True, True, False])
+
+    def function(u_i, index):
+        return u_i ** 3 - target[index], 3 * u_i ** 2
+
+    converged, iterations, bisections = bracketed_newton(function, u, np.zeros(target.shape),
+                                                         np.full(target.shape, 100.0), active, 1e-12, 100)
+    assert np.all(converged)
+    np.testing.assert_allclose(u[active], [1.0, 2.0, 3.0])
+    assert u[3] == 50.0 and iterations[3] == 0
+
+
+def aggregate_values(aggregates):
+    return [aggregates.srf, aggregates.hydraulic_radius, aggregates.shear_radius, aggregates.bed_coefficient,
+            aggregates.rigid_composite_n]
+
+
+@pytest.mark.parametrize('depth', [2.0, 40.0])
+def test_depth_aggregates_follow_the_channel_state(dayboro, depth):
+    dayboro.set_water_depth(depth)
+    dayboro.set_bed_slope(1 / 1000)
+    dayboro.resolve_velocity()
+    aggregates = dayboro.depth_aggregates()
+    # reused for other slopes at the same depth
+    dayboro.set_bed_slope(1 / 250)
+    dayboro.resolve_velocity()
+    assert dayboro.depth_aggregates() is aggregates
+
+    # recomputed when the roughness, blockage or plan area change, even without a new depth
+    for change in (lambda: setattr(dayboro, 'n', 0.03), lambda: setattr(dayboro, 'blockage', True),
+                   lambda: setattr(dayboro, 'plan_area', dayboro.plan_area / 2)):
+        change()
+        result = dayboro.resolve_velocity()
+        assert dayboro.depth_aggregates() is not aggregates
+        aggregates = dayboro.depth_aggregates()
+        assert aggregate_values(aggregates) == aggregate_values(DepthAggregates(dayboro))
+        # as a solve of the changed channel from scratch
+        dayboro.set_water_depth(depth)
+        assert dayboro.resolve_velocity().as_dict() == pytest.approx(result.as_dict(), rel=1e-12, nan_ok=True)
+        aggregates = dayboro.depth_aggregates()
+    assert aggregates.srf > 0
+
+    dayboro.set_water_depth(depth + 1.0)
+    dayboro.resolve_velocity()
+    assert dayboro.depth_aggregates() is not aggregates
+    assert aggregate_values(dayboro.depth_aggregates()) == aggregate_values(DepthAggregates(dayboro))
@@ -0,0 +1,34 @@
+"""
+Regression tests of the roughness surface: interpolation against a direct solve, the
+measured error bound, and the saved table.
+"""
+import numpy as np
+from Solver import BatchSolver
+from Surface import RoughnessSurface
+
+depths = np.linspace(0.1, 12.0, 40)
+slopes = np.geomspace(1 / 5000, 1 / 250, 10)
+
+
+def test_interpolation_matches_the_solve(dayboro, tmp_path):
+    dayboro.blockage = True
+    surface = RoughnessSurface.build(dayboro, depths, slopes)
+    assert 0 < surface.n_error < 0.05
+
+    # exact at the grid nodes, within about the measured bound inside the cells, NaN outside
+    n, velocity = surface.interpolate(*np.meshgrid(depths, slopes, indexing='ij'))
+    np.testing.assert_allclose(n, surface.mannings_n, rtol=1e-12)
+    rng = np.random.default_rng(2)
+    query_depths = rng.uniform(depths[0], depths[-1], 300)
+    query_slopes = np.exp(rng.uniform(np.log(slopes[0]), np.log(slopes[-1]), 300))
+    n, velocity = surface.interpolate(query_depths, query_slopes)
+    direct = np.array([BatchSolver(dayboro).solve([depth], [slope])['Mannings_n'][0, 0]
+                       for depth, slope in zip(query_depths, query_slopes)])
+    assert np.max(np.abs(n / direct - 1)) <= 1.5 * surface.n_error
+    assert np.all(np.isnan(surface.interpolate([0.05, 13.0, 1.0], [1 / 1000, 1 / 1000, 1 / 100])[0]))
+
+    file_name = str(tmp_path / 'surface.npz')
+    surface.save(file_name)
+    loaded = RoughnessSurface.load(file_name)
+    np.testing.assert_allclose(loaded.interpolate(query_depths, query_slopes)[0], n, rtol=1e-6)
+    assert loaded.n_error == surface.n_error
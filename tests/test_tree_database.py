@@ -0,0 +1,64 @@
+"""
+Regression tests of the tree database reader and its binary sidecar file: the sidecar is
+reused while the csv file is unchanged and rebuilt when it changes.
+"""
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from TreeDatabase import TreeDatabase
+
+species_names = ['Casuarina-overstory', 'Other']
+
+
+def tree_database(dayboro_ufm, folder):
+    # a copy of the Dayboro_WTP tree database with an unknown tree type
+    file_name = os.path.join(folder, 'trees.csv')
+    shutil.copyfile(os.path.join(os.path.dirname(dayboro_ufm), 'Tree_db_2009_0p6.csv'), file_name)
+    with open(file_name, 'a') as df:
+        df.write('99,3.0,5,42.0,Unknown\n')
+    return file_name
+
+
+def test_columns_match_the_csv_file(dayboro_ufm, tmp_path):
+    file_name = tree_database(dayboro_ufm, str(tmp_path))
+    database = TreeDatabase(file_name, species_names, chunk_size=10)
+    columns = database.read()
+    csv = pd.read_csv(file_name)
+    known = csv['Type'] != 'Unknown'
+    np.testing.assert_array_equal(columns['height'], csv['Height'][known])
+    np.testing.assert_array_equal(columns['population'], csv['Population'][known])
+    np.testing.assert_array_equal(columns['ground_level'], csv['GroundLevel'][known])
+    assert np.all(columns['species'] == 0) and database.skipped == 1
+    assert os.path.exists(str(tmp_path / 'trees_trees.bin'))
+
+
+def test_sidecar_is_reused_until_the_csv_file_changes(dayboro_ufm, tmp_path):
+    file_name = tree_database(dayboro_ufm, str(tmp_path))
+    parsed = TreeDatabase(file_name, species_names).read()
+
+    database = TreeDatabase(file_name, species_names)
+    columns = database.read()
+    assert database.from_cache and database.skipped == 1
+    for name in parsed:
+        np.testing.assert_array_equal(columns[name], parsed[name])
+
+    # a touched file (new modification time, same content) still uses the sidecar
+    stat = os.stat(file_name)
+    os.utime(file_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    database = TreeDatabase(file_name, species_names)
+    database.read()
+    assert database.from_cache
+
+    # an edited file (same size) and a changed species list are parsed again
+    csv = open(file_name).read()
+    with open(file_name, 'w') as df:
+        df.write(csv.replace('\n1,2,23,', '\n1,3,23,', 1))
+    database = TreeDatabase(file_name, species_names)
+    assert database.read()['height'][0] == 3.0 and not database.from_cache
+    database = TreeDatabase(file_name, species_names[:1])
+    database.read()
+    assert not database.from_cache
+    database = TreeDatabase(file_name, species_names[:1])
+    database.read()
+    assert database.from_cache